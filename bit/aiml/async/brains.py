@@ -0,0 +1,56 @@
+"""This module implements the BrainRegistry class, which holds the base
+brains shared by the Kernels of a process.
+
+Bots built on the same AIML set can share one copy of its brain: each
+Kernel matches against a shared base brain through a small private
+overlay holding its bot-specific categories (see Kernel.setBaseBrain()).
+
+    registry = BrainRegistry()
+    base = registry.load("alice", learnFiles="alice/*.aiml")
+    for name in (u"Ann", u"Bob"):
+        kernel = Kernel()
+        kernel.setBotPredicate("name", name)
+        kernel.setBaseBrain(base)
+        kernel.learn("%s.aiml" % name.lower())
+
+The base brains must not be changed once registered.
+
+"""
+
+
+class BrainRegistry(object):
+    """Base brains, by name."""
+
+    def __init__(self):
+        self._brains = {}
+
+    def load(self, name, brainFile=None, learnFiles=[]):
+        """Return the base brain name, learning it from the brain file
+        and AIML files of Kernel.bootstrap() if it is not registered yet.
+
+        """
+        brain = self._brains.get(name)
+        if brain is None:
+            from bit.aiml.async.kernel import Kernel
+            kernel = Kernel()
+            kernel.verbose(False)
+            kernel.bootstrap(brainFile, learnFiles)
+            brain = self._brains[name] = kernel._brain
+        return brain
+
+    def register(self, name, brain):
+        """Register the PatternMgr brain as the base brain name."""
+        if name in self._brains:
+            raise KeyError("brain %r is already registered" % (name,))
+        self._brains[name] = brain
+
+    def get(self, name):
+        """Return the base brain name, or None."""
+        return self._brains.get(name)
+
+    def drop(self, name):
+        """Forget the base brain name.  The Kernels sharing it keep it."""
+        self._brains.pop(name, None)
+
+    def names(self):
+        return self._brains.keys()
@@ -0,0 +1,89 @@
+"""This module implements the file format of Kernel checkpoints (see
+Kernel.checkpoint() and Kernel.restore()).
+
+A checkpoint file starts with the magic string "AIKC" and a version
+byte, followed by named sections, each as its name (8 bytes, padded with
+NUL bytes), its length (8 bytes, big-endian) and its contents.  Files
+are written to a temporary file in the same directory, synced, and then
+renamed over the destination, so that a checkpoint is never seen half
+written.  They are read through a memory map, so that sections are only
+read from the disk when they are used.
+
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+
+_MAGIC = "AIKC"
+VERSION = 2
+_HEADER = _MAGIC + chr(VERSION)
+_SECTION = struct.Struct(">8sQ")
+
+
+class CheckpointError(ValueError):
+    """The file is not a valid checkpoint."""
+
+
+def writeCheckpoint(path, sections):
+    """Write the (name, contents) pairs of sections to the checkpoint file
+    path, atomically.
+
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp = tempfile.mkstemp(prefix=".checkpoint-", dir=directory)
+    try:
+        f = os.fdopen(fd, "wb")
+        try:
+            f.write(_HEADER)
+            for name, contents in sections:
+                f.write(_SECTION.pack(name, len(contents)))
+                f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(temp, path)
+    except:
+        os.unlink(temp)
+        raise
+
+
+class CheckpointFile(object):
+    """A checkpoint file, mapped in memory."""
+
+    def __init__(self, path):
+        f = open(path, "rb")
+        try:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        if self.data[:len(_MAGIC)] != _MAGIC:
+            raise CheckpointError("%s is not a checkpoint" % path)
+        if ord(self.data[len(_MAGIC)]) != VERSION:
+            raise CheckpointError("unsupported checkpoint version %d"
+                                  % ord(self.data[len(_MAGIC)]))
+        # name -> (start, end) of the contents of each section
+        self._sections = {}
+        pos = len(_HEADER)
+        while pos < len(self.data):
+            name, length = _SECTION.unpack(
+                self.data[pos:pos + _SECTION.size])
+            pos += _SECTION.size
+            self._sections[name.rstrip("\0")] = (pos, pos + length)
+            pos += length
+        if pos != len(self.data):
+            raise CheckpointError("%s is truncated" % path)
+
+    def bounds(self, name):
+        """Return the (start, end) offsets of the section name in data."""
+        try:
+            return self._sections[name]
+        except KeyError:
+            raise CheckpointError("no %s section in the checkpoint" % name)
+
+    def section(self, name):
+        """Return the contents of the section name."""
+        start, end = self.bounds(name)
+        return self.data[start:end]
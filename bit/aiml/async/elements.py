@@ -0,0 +1,122 @@
+"""This module implements the compact, immutable representation of the
+elements of learned templates.
+
+An element is an Element tuple (tag, attrs, child...), where tag is the
+interned name of the element, attrs an Attrs mapping of its attributes,
+and each child an element, except for "text" elements, whose only child
+is their text.  The parser builds elements as lists, and freeze()s each
+template when its category ends.
+
+Frozen elements cost less memory than lists and dictionaries, and are
+never changed while they are evaluated, so that templates can be shared
+by Kernels in several threads, and by forked processes without their
+pages being copied.  To that end, freeze() collapses the whitespace of
+text elements with the "default" whitespace behavior once and for all,
+and marks them "preserve".
+
+"""
+
+import re
+
+_whitespaceRE = re.compile(r"\s+")
+
+
+class Attrs(tuple):
+    """The attributes of an element: an immutable mapping, stored as the
+    flat tuple (name, value, name, value...).
+
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, name):
+        it = tuple.__iter__(self)
+        for key in it:
+            value = it.next()
+            if key == name:
+                return value
+        raise KeyError(name)
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        return name in tuple.__getitem__(self, slice(None, None, 2))
+
+    has_key = __contains__
+
+    def keys(self):
+        return list(tuple.__getitem__(self, slice(None, None, 2)))
+
+    def values(self):
+        return list(tuple.__getitem__(self, slice(1, None, 2)))
+
+    def items(self):
+        return zip(tuple.__getitem__(self, slice(None, None, 2)),
+                   tuple.__getitem__(self, slice(1, None, 2)))
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def __repr__(self):
+        return "Attrs(%r)" % dict(self.items())
+
+
+class Element(tuple):
+    """An element of a template: the tuple (tag, attrs, child...)."""
+
+    __slots__ = ()
+
+
+_noAttrs = Attrs()
+
+
+def attributes(items):
+    """Return the Attrs of items, a dictionary, an Attrs or a flat
+    sequence of names and values.
+
+    """
+    if isinstance(items, dict) or isinstance(items, Attrs):
+        items = items.items()
+    else:
+        items = zip(items[::2], items[1::2])
+    if not items:
+        return _noAttrs
+    flat = []
+    for name, value in sorted(items):
+        flat.append(intern(str(name)))
+        flat.append(value)
+    return Attrs(flat)
+
+
+def freeze(elem):
+    """Return the Element of elem, an element as a list or a tuple (tag,
+    attrs, child...), such as the parser builds, or plain() and JSON
+    return.
+
+    """
+    tag = intern(str(elem[0]))
+    attrs = attributes(elem[1])
+    if tag == "text":
+        text = elem[2]
+        if attrs.get("xml:space") == "default":
+            text = _whitespaceRE.sub(" ", text)
+            items = dict(attrs.items())
+            items["xml:space"] = "preserve"
+            attrs = attributes(items)
+        return Element((tag, attrs, text))
+    return Element([tag, attrs] + [freeze(child) for child in elem[2:]])
+
+
+def plain(elem):
+    """Return elem as nested plain tuples, which marshal can write, and
+    which freeze() reads back.
+
+    """
+    if elem[0] == "text":
+        return (elem[0], tuple(elem[1]), elem[2])
+    return (elem[0], tuple(elem[1])) + tuple([plain(child)
+                                              for child in elem[2:]])
@@ -0,0 +1,177 @@
+"""This module implements the EventDispatcher class, which delivers the
+PersonSpeaksEvent and BotRespondsEvent events of the Kernel to the
+zope.event subscribers.
+
+In the "sync" mode, events are delivered as soon as they are sent, like
+zope.event.notify() does.  In the "queued" mode, they are put on a bounded
+queue, and delivered in batches once the response they belong to is
+complete, so that slow subscribers do not delay responses.  When the
+queue is full, the overflow policy decides what happens to a new event:
+
+  "drop"    the new event is dropped.
+  "block"   the queued events are delivered right away, to make room.
+  "sample"  the new event replaces the oldest queued one with a
+            probability of sampleRate, and is dropped otherwise.
+
+"""
+
+import collections
+import random
+import time
+
+import zope.event
+from twisted.python import log
+
+from stats import Histogram
+
+
+_modes = ("sync", "queued")
+_policies = ("drop", "block", "sample")
+
+
+def _subscriberName(subscriber):
+    name = getattr(subscriber, "__name__", type(subscriber).__name__)
+    return "%s.%s" % (getattr(subscriber, "__module__", "?"), name)
+
+
+class EventDispatcher(object):
+    """Deliver events to the zope.event subscribers, synchronously or in
+    batches.
+
+    """
+
+    def __init__(self, mode="sync", maxQueue=1024, overflow="drop",
+                 batchSize=64, sampleRate=0.1, reactor=None):
+        self._reactor = reactor
+        self._queue = collections.deque()
+        self._flushing = None
+        self.configure(mode, maxQueue, overflow, batchSize, sampleRate)
+        # statistics
+        self.sent = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.replaced = 0
+        self.blocked = 0
+        self.errors = 0
+        self.batches = 0
+        # subscriber name -> Histogram of its delivery times
+        self._timings = {}
+
+    def configure(self, mode=None, maxQueue=None, overflow=None,
+                  batchSize=None, sampleRate=None):
+        """Change the dispatch mode and the queue's settings.
+
+        Arguments left as None keep their current value.  Switching to the
+        "sync" mode delivers the queued events first.
+
+        """
+        if mode is not None:
+            if mode not in _modes:
+                raise ValueError("unknown event dispatch mode: %r" % mode)
+            self.mode = mode
+        if overflow is not None:
+            if overflow not in _policies:
+                raise ValueError("unknown overflow policy: %r" % overflow)
+            self.overflow = overflow
+        if maxQueue is not None:
+            self.maxQueue = maxQueue
+        if batchSize is not None:
+            self.batchSize = batchSize
+        if sampleRate is not None:
+            self.sampleRate = sampleRate
+        if self.mode == "sync":
+            self.flush()
+
+    def notify(self, event):
+        """Send event to the subscribers, now or later depending on the
+        mode.
+
+        """
+        self.sent += 1
+        if self.mode == "sync":
+            self._deliver(event, True)
+            return
+        if len(self._queue) >= self.maxQueue:
+            if self.overflow == "drop":
+                self.dropped += 1
+                return
+            elif self.overflow == "block":
+                self.blocked += 1
+                self.flush()
+            elif random.random() < self.sampleRate:
+                self._queue.popleft()
+                self.replaced += 1
+            else:
+                self.dropped += 1
+                return
+        self._queue.append(event)
+
+    def schedule(self):
+        """Deliver the queued events, in batches of batchSize events per
+        reactor iteration, starting with the next one.
+
+        The Kernel calls this once a response is complete.
+
+        """
+        if self._flushing is not None or len(self._queue) == 0:
+            return
+        reactor = self._reactor
+        if reactor is None:
+            from twisted.internet import reactor
+        self._flushing = reactor.callLater(0, self._flushBatch)
+
+    def _flushBatch(self):
+        self._flushing = None
+        self.batches += 1
+        for i in xrange(min(self.batchSize, len(self._queue))):
+            self._deliver(self._queue.popleft(), False)
+        self.schedule()
+
+    def flush(self):
+        """Deliver all the queued events now."""
+        while self._queue:
+            self._deliver(self._queue.popleft(), False)
+
+    def _deliver(self, event, sync):
+        """Call every subscriber with event, and time them.
+
+        The errors of subscribers are raised in the "sync" mode, as
+        zope.event.notify() does, and logged otherwise.
+
+        """
+        for subscriber in zope.event.subscribers:
+            start = time.time()
+            try:
+                subscriber(event)
+            except:
+                self.errors += 1
+                if sync:
+                    raise
+                log.err(None, "event subscriber %s failed"
+                        % _subscriberName(subscriber))
+            finally:
+                name = _subscriberName(subscriber)
+                try:
+                    timing = self._timings[name]
+                except KeyError:
+                    timing = self._timings[name] = Histogram()
+                timing.add(time.time() - start)
+        self.delivered += 1
+
+    def stats(self):
+        """Return the dispatcher's statistics as a dictionary, including
+        the delivery times of each subscriber.
+
+        """
+        return {"mode": self.mode,
+                "queued": len(self._queue),
+                "sent": self.sent,
+                "delivered": self.delivered,
+                "dropped": self.dropped,
+                "replaced": self.replaced,
+                "blocked": self.blocked,
+                "errors": self.errors,
+                "batches": self.batches,
+                "subscribers": dict((name, timing.snapshot())
+                                    for name, timing
+                                    in self._timings.items())}
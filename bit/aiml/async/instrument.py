@@ -0,0 +1,181 @@
+"""This module implements the Instrumentation class, the optional timing
+layer of the Kernel.
+
+When enabled, it replaces the methods of the Kernel and of its parts
+that make up a response with timed wrappers:
+
+  respond      Kernel._respond (each sentence, and each srai reduction)
+  normalize    Kernel._normalize
+  match        PatternMgr.matchPath and PatternMgr.iterMatch (cooperative
+               mode), the matches made in the threads (threaded matching),
+               or ShardedBrain.matchPath
+  star         PatternMgr.star (<star>, <thatstar> and <topicstar>), or
+               ShardedBrain.star
+  sub          WordSub.sub, for every subber
+  macro        MacroRunner.run
+  events       EventDispatcher.notify
+  tag:<name>   the processor of each AIML element
+
+Each phase gets a call counter and a latency Histogram.  Times are
+inclusive: the time of a <srai> element includes the reduction of its
+input, for instance.  When a call returns a Deferred, the time until it
+fires is counted, but the pauses of a cooperative match are not, and the
+matches made in the threads are timed there.  When disabled, the original methods are restored, so
+that instrumentation costs nothing.
+
+"""
+
+import time
+
+from twisted.internet import defer
+
+from stats import Histogram
+
+
+class Instrumentation(object):
+    """Timing instrumentation of a Kernel."""
+
+    def __init__(self, kernel):
+        self._kernel = kernel
+        self.enabled = False
+        # phase name -> Histogram
+        self._timings = {}
+        # (object, attribute name) of every method replaced
+        self._wrapped = []
+        self._processors = None
+
+    def _timing(self, phase):
+        try:
+            return self._timings[phase]
+        except KeyError:
+            timing = self._timings[phase] = Histogram()
+            return timing
+
+    def _timed(self, phase, func):
+        timing = self._timing(phase)
+
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            result = func(*args, **kwargs)
+            if isinstance(result, defer.Deferred):
+                def _fired(result):
+                    timing.add(time.time() - start)
+                    return result
+                return result.addBoth(_fired)
+            timing.add(time.time() - start)
+            return result
+        wrapper.instrumented = True
+        return wrapper
+
+    def _timedIterator(self, phase, func):
+        """Like _timed(), for PatternMgr.iterMatch(): only the time spent
+        in the generator is counted, until it yields the match.
+
+        """
+        timing = self._timing(phase)
+
+        def wrapper(*args, **kwargs):
+            elapsed = 0.0
+            iterator = func(*args, **kwargs)
+            while True:
+                start = time.time()
+                try:
+                    item = iterator.next()
+                except StopIteration:
+                    return
+                elapsed += time.time() - start
+                if item is not None:
+                    timing.add(elapsed)
+                yield item
+        wrapper.instrumented = True
+        return wrapper
+
+    def _timedThreaded(self, phase, func):
+        """Like _timed(), for Kernel._matchedThreaded(): count the
+        duration of the match measured in the thread, if any.
+
+        """
+        timing = self._timing(phase)
+
+        def wrapper(result, *args, **kwargs):
+            duration = result[3]
+            if duration is not None:
+                timing.add(duration)
+            return func(result, *args, **kwargs)
+        wrapper.instrumented = True
+        return wrapper
+
+    def _wrap(self, obj, name, phase, timed=None):
+        if timed is None:
+            timed = self._timed
+        method = getattr(obj, name)
+        if getattr(method, "instrumented", False):
+            return
+        setattr(obj, name, timed(phase, method))
+        self._wrapped.append((obj, name))
+
+    def enable(self):
+        """Start timing.
+
+        This may be called again after the Kernel's parts changed (the
+        subbers are replaced by loadSubs(), the brain whenever it
+        changes, for instance), to time the new ones too.
+
+        """
+        kernel = self._kernel
+        self.enabled = True
+        # forget the parts which were replaced, so that they can be freed
+        parts = set(id(part) for part in
+                    [kernel, kernel._brain, kernel._shards,
+                     kernel._macroRunner, kernel._events]
+                    + kernel._subbers.values())
+        self._wrapped = [(obj, name) for obj, name in self._wrapped
+                         if id(obj) in parts]
+        self._wrap(kernel, "_respond", "respond")
+        self._wrap(kernel, "_normalize", "normalize")
+        self._wrap(kernel, "_matchedThreaded", "match", self._timedThreaded)
+        # PatternMgr.match() calls matchPath()
+        self._wrap(kernel._brain, "matchPath", "match")
+        self._wrap(kernel._brain, "iterMatch", "match", self._timedIterator)
+        self._wrap(kernel._brain, "star", "star")
+        if kernel._shards is not None:
+            self._wrap(kernel._shards, "matchPath", "match")
+            self._wrap(kernel._shards, "star", "star")
+        for subber in kernel._subbers.values():
+            self._wrap(subber, "sub", "sub")
+        self._wrap(kernel._macroRunner, "run", "macro")
+        self._wrap(kernel._events, "notify", "events")
+        if self._processors is None:
+            self._processors = kernel._elementProcessors
+            kernel._elementProcessors = dict(
+                (tag, self._timed("tag:" + tag, processor))
+                for tag, processor in self._processors.items())
+
+    def disable(self):
+        """Stop timing, and restore the original methods."""
+        kernel = self._kernel
+        self.enabled = False
+        for obj, name in self._wrapped:
+            # the wrappers are instance attributes hiding the methods
+            try:
+                delattr(obj, name)
+            except AttributeError:
+                pass
+        self._wrapped = []
+        if self._processors is not None:
+            kernel._elementProcessors = self._processors
+            self._processors = None
+
+    def reset(self):
+        """Forget the timings collected so far."""
+        for timing in self._timings.values():
+            timing.__init__(timing.bounds)
+
+    def stats(self):
+        """Return the call count and latency of each phase as a
+        dictionary.
+
+        """
+        return dict((phase, timing.snapshot())
+                    for phase, timing in self._timings.items()
+                    if timing.count > 0)
@@ -0,0 +1,92 @@
+"""This module implements the TemplateInterner class, which makes the
+templates learned by a Kernel share their identical parts.
+
+Large AIML sets repeat the same templates (stock replies, <srai>
+redirects to the same input) and the same elements, attributes and
+strings over and over.  The interner replaces every element of a frozen
+template (see bit.aiml.async.elements) by a canonical element, shared by
+all the identical elements it has seen, so that each is only stored
+once.
+
+"""
+
+import sys
+
+from elements import Attrs, Element
+
+
+def sizeOf(obj, seen=None):
+    """Return the number of bytes used by obj, an element or a template,
+    and the objects it holds, counting the objects whose ids are in seen
+    only once.
+
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += sizeOf(key, seen) + sizeOf(value, seen)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            size += sizeOf(item, seen)
+    return size
+
+
+class TemplateInterner(object):
+    """Canonical elements, attributes and strings."""
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """Forget the canonical objects.  The templates already interned
+        keep sharing them.
+
+        """
+        self._strings = {}
+        self._attrs = {}
+        self._elements = {}
+        # the number of bytes of the canonical objects
+        self.size = 0
+
+    def intern(self, template):
+        """Return the canonical template identical to template."""
+        return self._element(template)
+
+    def _string(self, s):
+        # str and unicode strings are equal, but not interchangeable
+        key = (type(s), s)
+        canonical = self._strings.get(key)
+        if canonical is None:
+            canonical = self._strings[key] = s
+            self.size += sys.getsizeof(s)
+        return canonical
+
+    def _attributes(self, attrs):
+        canonical = self._attrs.get(attrs)
+        if canonical is None:
+            canonical = self._attrs[attrs] = Attrs(
+                [self._string(s) for s in attrs])
+            self.size += sys.getsizeof(canonical)
+        return canonical
+
+    def _element(self, elem):
+        children = []
+        for child in elem[2:]:
+            if isinstance(child, basestring):
+                children.append(self._string(child))
+            else:
+                children.append(self._element(child))
+        attrs = self._attributes(elem[1])
+        signature = (elem[0], id(attrs),
+                     tuple([id(child) for child in children]))
+        canonical = self._elements.get(signature)
+        if canonical is None:
+            canonical = self._elements[signature] = Element(
+                [self._string(elem[0]), attrs] + children)
+            self.size += sys.getsizeof(canonical)
+        return canonical
@@ -5,6 +5,8 @@ import os
 import sys
 import copy
 import glob
+import itertools
+import marshal
 import random
 import re
 import string
@@ -14,20 +16,43 @@ import xml.sax
 from ConfigParser import ConfigParser
 
 from zope.interface import implements
-from zope.component import queryMultiAdapter
-from zope.event import notify
 
-from twisted.python import log
-from twisted.internet import defer
+from twisted.python import failure, log
+from twisted.internet import defer, task
 
 import parser as aiml_parser
+import sessions
 import subs
 import utils
-from pattern import PatternMgr
+from checkpoint import CheckpointFile, writeCheckpoint
+from elements import Attrs, Element, freeze, plain
+from events import EventDispatcher
+from instrument import Instrumentation
+from interner import TemplateInterner, sizeOf
+from pattern import OverlayPatternMgr, PatternMgr
+from pools import WorkerPool
+from process import CommandRunner
+from sessions import (LazySessions, SessionReader, SessionWriter,
+                      decodeSession, encodeBody, encodeSession)
+from macrocache import MacroCache
+from macrorunner import MacroRunner
+from memo import SraiMemo
+from slowlog import SlowRequestLog
+from sraigraph import SraiGraph
+from stats import Histogram
+from trace import RequestTrace
+from watchdog import StallWatchdog
 from wordsub import WordSub
 
 from bit.bot.base.events import BotRespondsEvent, PersonSpeaksEvent
-from bit.aiml.async.interfaces import IAIMLKernel, IAIMLMacro
+from bit.aiml.async.interfaces import IAIMLKernel
+
+
+# the template of a reduction is not matched yet
+_unmatched = object()
+# <star/>
+_star = Element(("star", Attrs()))
+_preserve = Attrs(("xml:space", "preserve"))
 
 
 class Kernel(object):
@@ -43,6 +68,8 @@ class Kernel(object):
     # maximum number of recursive <srai>/<sr> tags
     # before the response is aborted.
     _maxRecursionDepth = 100
+    # maximum number of entries in each of the respond_many() caches
+    _maxBatchCacheSize = 10000
 
     # special predicate keys
 
@@ -52,6 +79,13 @@ class Kernel(object):
     _outputHistory = "_outputHistory"
     # Should always be empty in between calls to respond()
     _inputStack = "_inputStack"
+    # the special keys, which are not predicates
+    _specialKeys = frozenset([_inputHistory, _outputHistory, _inputStack])
+    # element processors which accept Deferred results from the elements
+    # they contain, and so may pause in the cooperative mode, or wait for
+    # threaded matching
+    _pausingTags = frozenset(["template", "li", "condition", "random",
+                              "srai", "sr", "system"])
 
     def __init__(self):
         self._verboseMode = True
@@ -60,6 +94,54 @@ class Kernel(object):
         self._brain = PatternMgr()
         self._respondLock = threading.RLock()
         self._textEncoding = "utf-8"
+        # caches used while respond_many() processes a batch
+        self._normalCache = None
+        self._matchCache = None
+        # results of the last analyzeSrai()
+        self._sraiLinks = {}
+        self._sraiLoops = set()
+        # bumped whenever the contents of the brain change
+        self._brainGeneration = 0
+        # makes the templates learned share their identical parts, and
+        # what it saved for each file learned
+        self._interner = TemplateInterner()
+        self._learnStats = {}
+        # statistics of respond() and of matching
+        self._responseLatency = Histogram()
+        self._responseFailures = 0
+        self._matchCounts = {"linked": 0, "cached": 0, "matched": 0}
+        self._memoHits = 0
+        self._memoMisses = 0
+        # the IAIMLMacro factories and shell commands of <system> elements
+        self._macros = MacroCache(self)
+        self._macroRunner = MacroRunner()
+        self._commands = CommandRunner()
+        # delivers PersonSpeaksEvent and BotRespondsEvent
+        self._events = EventDispatcher()
+        # optional timing of the phases of a response
+        self._instruments = Instrumentation(self)
+        # fraction of the requests traced
+        self._traceRate = 0.0
+        # the SlowRequestLog, if enabled
+        self._slowLog = None
+        # the request being reduced, and the StallWatchdog if started
+        self._inFlight = None
+        self._watchdog = None
+        # the cooperative mode: whether it is on, the length of its time
+        # slices, when the current one ends, and the number of element
+        # processors running which cannot pause
+        self._cooperative = False
+        self._sliceTime = 0.005
+        self._sliceEnd = 0.0
+        self._pinned = 0
+        # threaded matching: the WorkerPool matching inputs, if enabled,
+        # and the snapshot of the brain it matches against, with the
+        # generation of the brain it was taken from
+        self._matchPool = None
+        self._snapshot = None
+        self._snapshotGeneration = None
+        # the ShardedBrain matching inputs, if any
+        self._shards = None
 
         # set up the sessions
         self._sessions = {}
@@ -125,7 +207,8 @@ class Kernel(object):
         specified AIML files.
 
         Finally, each of the input strings in the commands list is
-        passed to respond().
+        passed to respond(), in the global session, and its response is
+        printed.
 
         """
         start = time.clock()
@@ -141,6 +224,9 @@ class Kernel(object):
             pass
         for file in learns:
             self.learn(file)
+        self.analyzeSrai()
+        # the templates learned keep sharing what they share
+        self._interner.clear()
 
         # ditto for commands
         cmds = commands
@@ -149,7 +235,8 @@ class Kernel(object):
         except:
             pass
         for cmd in cmds:
-            print self._respond(cmd, self._globalSessionID)
+            d = self.respond(_Request(self._globalSessionID), cmd)
+            d.addCallback(_printResponse)
 
         if self._verboseMode:
             print "Kernel bootstrap completed in %.2f seconds" % (
@@ -170,6 +257,8 @@ class Kernel(object):
     def numCategories(self):
         """Return the number of categories the Kernel has learned."""
         # there's a one-to-one mapping between templates and categories
+        if self._shards is not None:
+            return self._shards.numTemplates()
         return self._brain.numTemplates()
 
     def resetBrain(self):
@@ -180,6 +269,9 @@ class Kernel(object):
             kern = aiml.Kernel()
 
         """
+        # restore the methods the instrumentation replaced, which would
+        # hold on to the old brain
+        self._instruments.disable()
         del(self._brain)
         self.__init__()
 
@@ -194,6 +286,7 @@ class Kernel(object):
             print "Loading brain from %s..." % filename,
         start = time.clock()
         self._brain.restore(filename)
+        self._brainChanged()
         if self._verboseMode:
             end = time.clock() - start
             print "done (%d categories in %.2f seconds)" % (
@@ -208,6 +301,91 @@ class Kernel(object):
         if self._verboseMode:
             print "done (%.2f seconds)" % (time.clock() - start)
 
+    def checkpoint(self, path):
+        """Save the state of the Kernel to the file path: the brain, the
+        analysis of its srai elements, the substitutions, the bot
+        predicates and the sessions (see bit.aiml.async.checkpoint).
+
+        The file is replaced atomically.  Restoring it with restore() is
+        much faster than bootstrapping the Kernel again.
+
+        """
+        if self._verboseMode:
+            print "Saving checkpoint to %s..." % path,
+        start = time.clock()
+        brain = self._brain
+        # the templates linked by the srai analysis, by category key
+        keys = {}
+        if self._sraiLinks or self._sraiLoops:
+            keys = dict((id(template), key)
+                        for key, template in brain.categories())
+        meta = {"textEncoding": self._textEncoding,
+                "botPredicates": self._botPredicates,
+                "subbers": dict((name, subber.table())
+                                for name, subber in self._subbers.items()),
+                "links": dict((input, keys[id(template)])
+                              for input, template
+                              in self._sraiLinks.items()),
+                "loops": [keys[loop] for loop in self._sraiLoops],
+                "sessions": sessions.VERSION}
+        bodies = []
+        index = []
+        offset = 0
+        for sessionID, session in self._sessions.items():
+            body = encodeBody(sessionID, *self._sessionParts(session))
+            index.append((sessionID, offset, offset + len(body)))
+            bodies.append(body)
+            offset += len(body)
+        writeCheckpoint(path, [("meta", marshal.dumps(meta, 2)),
+                               ("brain", brain.dumps(plain)),
+                               ("index", marshal.dumps(index, 2)),
+                               ("sessions", "".join(bodies))])
+        if self._verboseMode:
+            print "done (%.2f seconds)" % (time.clock() - start)
+
+    def restore(self, path):
+        """Restore the state saved by checkpoint() to the file path.
+
+        The current brain, substitutions, bot predicates and sessions are
+        replaced.  The file is mapped in memory, and each session is only
+        decoded when it is first used; the regexes of the substitutions
+        are compiled when they are first used too.
+
+        """
+        if self._verboseMode:
+            print "Restoring checkpoint from %s..." % path,
+        start = time.clock()
+        checkpoint = CheckpointFile(path)
+        meta = marshal.loads(checkpoint.section("meta"))
+        if meta["sessions"] != sessions.VERSION:
+            raise sessions.SessionFormatError(
+                "unsupported session data version %d" % meta["sessions"])
+        brain = self._brain
+        brain.loads(checkpoint.section("brain"), freeze)
+        self._brainChanged()
+        self._sraiLinks = dict((input, brain.template(key))
+                               for input, key in meta["links"].items())
+        self._sraiLoops = set(id(brain.template(key))
+                              for key in meta["loops"])
+        self._textEncoding = meta["textEncoding"]
+        self._botPredicates = meta["botPredicates"]
+        self._subbers = dict((name, WordSub.fromTable(table))
+                             for name, table in meta["subbers"].items())
+        if self._instruments.enabled:
+            # time the new subbers too
+            self._instruments.enable()
+        # the offsets of the sessions in the file
+        base = checkpoint.bounds("sessions")[0]
+        encoded = dict((sessionID, (base + low, base + high))
+                       for sessionID, low, high
+                       in marshal.loads(checkpoint.section("index")))
+        self._sessions = LazySessions(checkpoint.data, encoded,
+                                      self._newSession)
+        if self._verboseMode:
+            print "done (%d categories, %d sessions in %.2f seconds)" % (
+                brain.numTemplates(), len(self._sessions),
+                time.clock() - start)
+
     def getPredicate(self, name, sessionID=_globalSessionID):
         """Retrieve the current value of the predicate 'name' from the
         specified session.
@@ -256,12 +434,280 @@ class Kernel(object):
         # name in the brain as well
         if name == "name":
             self._brain.setBotName(self.getBotPredicate("name"))
+            self._brainChanged()
 
     def setTextEncoding(self, encoding):
         """Set the text encoding used when loading
         AIML files (Latin-1, UTF-8, etc.)."""
         self._textEncoding = encoding
 
+    def setSystemLimits(self, maxConcurrent=None, timeout=None,
+                        maxOutput=None):
+        """Set the limits applied to the shell commands run by <system>
+        elements.
+
+        maxConcurrent is the number of commands which may run at once
+        (others wait for their turn), timeout the number of seconds after
+        which a command is killed, and maxOutput the number of bytes of
+        output kept.  Arguments left as None keep their current value.
+
+        """
+        self._commands.setLimits(maxConcurrent, timeout, maxOutput)
+
+    def setMacroTimeout(self, name, seconds, fallback=""):
+        """Set the deadline of the IAIMLMacro adapter called name.
+
+        If the macro's result is not ready after seconds, its Deferred
+        is cancelled and fallback is used instead (the macro's complete()
+        method is still called).  If name is None, the deadline applies
+        to every macro without one of its own; if seconds is None, the
+        deadline is removed.
+
+        """
+        self._macroRunner.setTimeout(name, seconds, fallback)
+
+    def setMacroCacheSize(self, size):
+        """Set the number of results of idempotent IAIMLMacro adapters
+        kept in the cache.
+
+        """
+        self._macroRunner.setCacheSize(size)
+
+    def setMacroPoolSize(self, group, size):
+        """Set the number of threads in which the blocking IAIMLMacro
+        adapters of group may run at once.
+
+        """
+        self._macroRunner.setPoolSize(group, size)
+
+    def macroStats(self):
+        """Return the statistics of the IAIMLMacro adapters used by
+        <system> elements: cache hits, registry lookups and the time they
+        took, the number of command names bound at learn time, under
+        "macros" the latency, timeouts and failures of each macro name,
+        under "results" the hits, misses and merged invocations of the
+        cache of idempotent macro results, and under "pools" the queue
+        depth and saturation of the thread pool of each group of blocking
+        macros.
+
+        """
+        stats = self._macros.stats()
+        stats["macros"] = self._macroRunner.stats()
+        stats["results"] = self._macroRunner.cacheStats()
+        stats["pools"] = self._macroRunner.poolStats()
+        return stats
+
+    def systemStats(self):
+        """Return the statistics of the shell commands run by <system>
+        elements: how many are running and waiting, how many timed out,
+        were truncated or failed to start, and their latency.
+
+        """
+        return self._commands.stats()
+
+    def setEventMode(self, mode=None, maxQueue=None, overflow=None,
+                     batchSize=None, sampleRate=None):
+        """Set how PersonSpeaksEvent and BotRespondsEvent are delivered.
+
+        In the "sync" mode (the default) the zope.event subscribers are
+        called as soon as an event is sent.  In the "queued" mode, events
+        wait in a queue of at most maxQueue events, and are delivered
+        batchSize at a time once the response is complete.  overflow is
+        the policy applied when the queue is full: "drop", "block" or
+        "sample" (see bit.aiml.async.events).  Arguments left as None
+        keep their current value.
+
+        """
+        self._events.configure(mode, maxQueue, overflow, batchSize,
+                               sampleRate)
+
+    def eventStats(self):
+        """Return the statistics of the delivery of events: how many were
+        sent, delivered, dropped or are queued, and the time each
+        subscriber took.
+
+        """
+        return self._events.stats()
+
+    def setTraceSampling(self, rate):
+        """Trace the given fraction (between 0 and 1) of the requests.
+
+        The RequestTrace of a sampled request is attached to it as its
+        aiml_trace attribute (see bit.aiml.async.trace).  A request can
+        also be traced explicitly by attaching a new RequestTrace to it
+        before calling respond().
+
+        """
+        self._traceRate = rate
+
+    def setSlowRequestLog(self, threshold, path=None, rotateLength=1000000,
+                          maxRotatedFiles=5, sampleRate=0.01):
+        """Log the exchanges which take longer than threshold seconds.
+
+        The exchanges are written as JSON lines to the file path, rotated
+        every rotateLength bytes and keeping maxRotatedFiles old files,
+        or else sent to the Twisted log observers (see
+        bit.aiml.async.slowlog).  A threshold of None disables the log.
+
+        Every exchange records the categories it matched, its srai depth
+        and the <system> macros it ran, but only the sampleRate fraction
+        of them is traced in detail, with the time spent matching, since
+        that slows matching down.
+
+        """
+        if self._slowLog is not None:
+            self._slowLog.close()
+            self._slowLog = None
+        if threshold is not None:
+            self._slowLog = SlowRequestLog(threshold, path, rotateLength,
+                                           maxRotatedFiles, sampleRate)
+
+    def setCooperative(self, enabled, sliceTime=None):
+        """Enable or disable the cooperative mode.
+
+        In the cooperative mode, matching and template evaluation give
+        the reactor back once they have run for sliceTime seconds, and
+        carry on in a later reactor iteration, so that one heavy input
+        cannot delay the other conversations for long.  Responses are
+        then Deferreds more often, but are otherwise unchanged: the
+        sentences of an input and the contents of an element are still
+        evaluated in order.  Evaluation only pauses outside of the
+        elements which need synchronous results (<person>, <think>,
+        <set>...).
+
+        """
+        self._cooperative = enabled
+        if sliceTime is not None:
+            self._sliceTime = sliceTime
+
+    def setThreadedMatching(self, enabled, threads=4):
+        """Enable or disable threaded matching.
+
+        When enabled, inputs are normalized and matched by a pool of at
+        most threads threads, against a read-only snapshot of the brain
+        taken the first time it is needed after the brain changed, so
+        that heavy matching does not hold up the reactor.  Templates are
+        still evaluated in the reactor thread.  The <srai> inputs of
+        elements which need synchronous results (<person>, <set>...) are
+        matched in the reactor thread, against the same snapshot.  The
+        respond_many() caches are not used.
+
+        """
+        if not enabled:
+            if self._matchPool is not None:
+                self._matchPool.stop()
+            self._matchPool = None
+            self._snapshot = self._snapshotGeneration = None
+        elif self._matchPool is None:
+            self._matchPool = WorkerPool("match", threads,
+                                         prefix="aiml-match")
+        else:
+            self._matchPool.resize(threads)
+
+    def setShardedBrain(self, shards):
+        """Match inputs with shards, a started ShardedBrain (see
+        bit.aiml.async.shards), instead of the Kernel's own brain; None
+        goes back to the Kernel's brain.
+
+        Matches then return Deferreds, like threaded matching.  The
+        elements which need the results of their contents right away
+        (<person>, <set>...) are processed once their contents are.  The
+        Kernel cannot learn while the brain is sharded: learn() raises
+        RuntimeError, and <learn> elements are skipped.
+
+        """
+        self._shards = shards
+        if self._instruments.enabled:
+            # time the shards too
+            self._instruments.enable()
+
+    def setBaseBrain(self, base):
+        """Share base, a PatternMgr (usually from a BrainRegistry, see
+        bit.aiml.async.brains), with other Kernels; None goes back to a
+        brain of the Kernel's own.
+
+        The Kernel's brain is replaced by a private overlay of base,
+        which holds the categories the Kernel learns from then on; they
+        take precedence over the categories of base with the same
+        pattern, that and topic.  base itself is never changed, and
+        <bot name="name"/> in patterns matches the Kernel's own bot name.
+        Checkpoints only hold the overlay, and must be restored by a
+        Kernel sharing the same base.
+
+        """
+        if base is None:
+            brain = PatternMgr()
+        else:
+            brain = OverlayPatternMgr(base)
+        brain.setBotName(self.getBotPredicate("name"))
+        self._brain = brain
+        self._brainChanged()
+
+    def startWatchdog(self, threshold=0.25, interval=0.05):
+        """Report the stalls of the reactor thread longer than threshold
+        seconds, with the stack of the reactor thread and the exchange
+        being processed (see bit.aiml.async.watchdog).
+
+        The reactor is checked every interval seconds, by a separate
+        thread.
+
+        """
+        self.stopWatchdog()
+        self._watchdog = StallWatchdog(self, threshold, interval)
+        self._watchdog.start()
+
+    def stopWatchdog(self):
+        """Stop reporting the stalls of the reactor thread."""
+        if self._watchdog is not None:
+            self._watchdog.stop()
+            self._watchdog = None
+
+    def setInstrumentation(self, enabled):
+        """Enable or disable the timing of the phases of each response
+        (see bit.aiml.async.instrument).
+
+        Instrumentation is disabled by default, and costs nothing then.
+
+        """
+        if enabled:
+            self._instruments.enable()
+        else:
+            self._instruments.disable()
+
+    def stats(self):
+        """Return the Kernel's statistics as a dictionary.
+
+        "responses" holds the latency histogram and failure count of
+        respond(), "matches" how many matches were answered by srai
+        links, by the respond_many() cache or by the brain, "memo" the
+        srai memo hits and misses, "sessions" the number of sessions,
+        and "brain" the number of categories and the generation of the
+        brain (bumped whenever its contents change).
+
+        "phases" holds the call count and latency histogram of each
+        instrumented phase (empty unless instrumentation is enabled), and
+        "macros", "system" and "events" hold the results of macroStats(),
+        systemStats() and eventStats().  "stalls" holds the number of
+        reactor stalls, the longest and the most recent ones, if the
+        watchdog was started, and "matchPool" the statistics of the
+        WorkerPool of threaded matching, if enabled.
+
+        """
+        return {"responses": {"latency": self._responseLatency.snapshot(),
+                              "failures": self._responseFailures},
+                "matches": dict(self._matchCounts),
+                "memo": {"hits": self._memoHits,
+                         "misses": self._memoMisses},
+                "sessions": len(self._sessions),
+                "brain": {"categories": self.numCategories(),
+                          "generation": self._brainGeneration},
+                "phases": self._instruments.stats(),
+                "macros": self.macroStats(),
+                "system": self.systemStats(),
+                "events": self.eventStats(),
+                "stalls": self._watchdog and self._watchdog.stats(),
+                "matchPool": self._matchPool and self._matchPool.stats()}
+
     def loadSubs(self, filename):
         """Load a substitutions file.
 
@@ -284,6 +730,9 @@ class Kernel(object):
             # iterate over the key,value pairs and add them to the subber
             for k, v in parser.items(s):
                 self._subbers[s][k] = v
+        if self._instruments.enabled:
+            # time the new subbers too
+            self._instruments.enable()
 
     def _addSession(self, sessionID):
         """Create a new session with the specified ID string."""
@@ -320,14 +769,96 @@ class Kernel(object):
             s = self._sessions
         return copy.deepcopy(s)
 
+    def exportSession(self, sessionID, remove=False):
+        """Return the compact encoding of the session sessionID (see
+        bit.aiml.async.sessions), or None if there is no such session.
+
+        If remove is True, the session is deleted, as when it moves to
+        another Kernel.
+
+        """
+        try:
+            session = self._sessions[sessionID]
+        except KeyError:
+            return None
+        data = encodeSession(sessionID, *self._sessionParts(session))
+        if remove:
+            self._deleteSession(sessionID)
+        return data
+
+    def importSession(self, data):
+        """Add the session encoded by exportSession(), replacing any
+        session with the same id, and return its id.
+
+        The session must not be in the middle of an exchange.
+
+        """
+        sessionID, predicates, inputs, outputs = decodeSession(data)
+        self._restoreSession(sessionID, predicates, inputs, outputs)
+        return sessionID
+
+    def exportSessions(self, f, sessionIDs=None):
+        """Write the sessions sessionIDs (by default, all of them) to the
+        file-like object f, and return the number of sessions written.
+
+        """
+        writer = SessionWriter(f)
+        if sessionIDs is None:
+            sessionIDs = self._sessions.keys()
+        for sessionID in sessionIDs:
+            session = self._sessions.get(sessionID)
+            if session is not None:
+                writer.write(sessionID, *self._sessionParts(session))
+        return writer.count
+
+    def importSessions(self, f):
+        """Add the sessions written by exportSessions() to the file-like
+        object f, like importSession(), and return their number.
+
+        """
+        count = 0
+        for sessionID, predicates, inputs, outputs in SessionReader(f):
+            self._restoreSession(sessionID, predicates, inputs, outputs)
+            count += 1
+        return count
+
+    def _sessionParts(self, session):
+        """Return the predicates, inputs and outputs of session."""
+        predicates = dict((name, value) for name, value in session.items()
+                          if name not in self._specialKeys)
+        return (predicates, session[self._inputHistory],
+                session[self._outputHistory])
+
+    def _restoreSession(self, sessionID, predicates, inputs, outputs):
+        self._sessions[sessionID] = self._newSession(predicates, inputs,
+                                                     outputs)
+
+    def _newSession(self, predicates, inputs, outputs):
+        """Return a session with the predicates, input history and output
+        history given.
+
+        """
+        session = dict(predicates)
+        session[self._inputHistory] = inputs
+        session[self._outputHistory] = outputs
+        session[self._inputStack] = []
+        return session
+
     def learn(self, filename):
         """Load and learn the contents of the specified AIML file.
 
         If filename includes wildcard characters, all matching files
-        will be loaded and learned.
+        will be loaded and learned.  The identical parts of the templates
+        learned are shared (see bit.aiml.async.interner and learnStats()).
+
+        Raises RuntimeError while the Kernel matches with a ShardedBrain,
+        which would never see the categories learned.
 
         """
         log.err('bit.aiml.async.kernel: Kernel.learn')
+        if self._shards is not None:
+            raise RuntimeError("cannot learn %s: the brain is sharded"
+                               % filename)
         for f in glob.glob(filename):
             if self._verboseMode:
                 print "Loading %s..." % f,
@@ -342,14 +873,114 @@ class Kernel(object):
                 err = "\nFATAL PARSE ERROR in file %s:\n%s\n" % (f, msg)
                 sys.stderr.write(err)
                 continue
-            # store the pattern/template pairs in the PatternMgr.
+            # store the pattern/template pairs in the PatternMgr, sharing
+            # the identical parts of the templates.
+            commands = set()
+            interner = self._interner
+            size = interner.size
+            parsed = 0
+            seen = set()
+            templates = set()
             for key, tem in handler.categories.items():
+                parsed += sizeOf(tem, seen)
+                tem = interner.intern(tem)
+                templates.add(id(tem))
                 self._brain.add(key, tem)
+                for elem, command in utils.literalElements(tem, "system"):
+                    commands.add(command)
                 if self._debugMode:
                     print "\nk: ", key, "\nt: ", tem
+            self._brainChanged()
+            # resolve the macros of literal <system> commands now
+            self._macros.bind(commands)
+            stats = self._learnStats[f] = {
+                "templates": len(handler.categories),
+                "distinct": len(templates),
+                "bytes": parsed,
+                "saved": parsed - (interner.size - size)}
             # Parsing was successful.
             if self._verboseMode:
-                print "done (%.2f seconds)" % (time.clock() - start)
+                print "done (%d templates, %d distinct, %d of %d bytes " \
+                    "saved, %.2f seconds)" % (
+                        stats["templates"], stats["distinct"],
+                        stats["saved"], stats["bytes"],
+                        time.clock() - start)
+
+    def learnStats(self):
+        """Return what the interning of templates saved for each file
+        learned, as a dictionary mapping file names to dictionaries with
+        the number of templates, how many were distinct, their size in
+        bytes as parsed, and the number of bytes saved.
+
+        """
+        return dict((f, dict(stats))
+                    for f, stats in self._learnStats.items())
+
+    def minimizeBrain(self):
+        """Merge the identical parts of the brain, such as the <that> and
+        <topic> patterns and the templates repeated by many categories,
+        to save memory (see PatternMgr.minimize()).
+
+        The srai analysis is run again if there was one.  Returns the
+        tuple (before, after) of the numbers of nodes of the brain.
+
+        """
+        if self._verboseMode:
+            print "Minimizing brain...",
+        start = time.clock()
+        analyzed = bool(self._sraiLinks or self._sraiLoops)
+        before, after = self._brain.minimize()
+        self._brainChanged()
+        if self._verboseMode:
+            print "done (%d nodes, down from %d, in %.2f seconds)" % (
+                after, before, time.clock() - start)
+        if analyzed:
+            self.analyzeSrai()
+        return (before, after)
+
+    def analyzeSrai(self):
+        """Analyze the literal <srai> elements of the learned categories.
+
+        Literal srai inputs which match the same category whatever the
+        context are linked to its template, so that responding to them
+        needs no pattern matching, and templates which start an endless
+        chain of srai reductions are answered at once with the empty
+        string.  In verbose mode, every srai cycle found is reported.
+
+        The analysis is discarded whenever the brain changes, so it should
+        be run again after learning; bootstrap() runs it automatically.
+        Returns the SraiGraph.
+
+        """
+        if self._verboseMode:
+            print "Analyzing srai targets...",
+        start = time.clock()
+        graph = SraiGraph(self)
+        self._sraiLinks = graph.links
+        self._sraiLoops = graph.loops
+        if self._verboseMode:
+            cycles = graph.cycles()
+            print "done (%d links, %d cycles in %.2f seconds)" % (
+                len(graph.links), len(cycles), time.clock() - start)
+            for cycle in cycles:
+                patterns = [pattern for pattern, that, topic in cycle]
+                err = "WARNING: srai cycle: %s\n" % string.join(
+                    patterns + patterns[:1], " -> ").encode(
+                    self._textEncoding, 'replace')
+                sys.stderr.write(err)
+        return graph
+
+    def _brainChanged(self):
+        """Discard everything derived from the contents of the brain."""
+        # matches cached by respond_many() may now be stale
+        if self._matchCache is not None:
+            self._matchCache.clear()
+        self._sraiLinks = {}
+        self._sraiLoops = set()
+        self._brainGeneration += 1
+        if self._instruments.enabled:
+            # the brain may have been replaced: time the new one too
+            self._instruments.enable()
 
     def _createCategory(self, filename):
         """Load and learn the contents of the specified AIML file.
@@ -376,6 +1007,7 @@ class Kernel(object):
             self._brain.add(key, tem)
             if self._debugMode:
                 print "\nk: ", key, "\nt: ", tem
+        self._brainChanged()
         # Parsing was successful.
         if self._verboseMode:
             print "done (%.2f seconds)" % (time.clock() - start)
@@ -387,7 +1019,129 @@ class Kernel(object):
         if len(input) == 0:
             return ""
 
-        notify(PersonSpeaksEvent(self).update(request, input))
+        start = time.time()
+        # prevent other threads from stomping all over us.
+        self._respondLock.acquire()
+        try:
+            response = self._exchange(request, input)
+        except:
+            self._respondLock.release()
+            raise
+        if not isinstance(response, defer.Deferred):
+            response = defer.succeed(response)
+
+        def _gotResponse(resp):
+            # release the lock and return
+            self._respondLock.release()
+            self._responseLatency.add(time.time() - start)
+            return resp
+
+        def _failed(resp):
+            print 'FAILED'
+            print resp
+            self._respondLock.release()
+            self._responseFailures += 1
+            self._events.schedule()
+
+        return response.addCallbacks(_gotResponse, _failed)
+
+    def respond_many(self, pairs, events=True, chunkSize=256):
+        """Respond to a batch of (request, input) pairs.
+
+        This is the bulk counterpart of respond(), meant for replays and
+        offline classification jobs.  It returns a generator which yields
+        a (request, response) tuple for each pair, in input order.  The
+        response is a string, or a Deferred if it could not be computed
+        synchronously (for instance because of an asynchronous <system>
+        macro).
+
+        The pairs are consumed in chunks of chunkSize.  The respond lock is
+        taken once per chunk, and normalized strings and pattern matches
+        are cached for the whole batch.  Responses for the same session are
+        always computed in input order, even when one of them is pending.
+        If events is False, no PersonSpeaksEvent or BotRespondsEvent is
+        sent.
+
+        """
+        pairs = iter(pairs)
+        normalCache = {}
+        matchCache = {}
+        # Deferreds for sessions with a response still pending.
+        pending = {}
+        while True:
+            chunk = list(itertools.islice(pairs, chunkSize))
+            if len(chunk) == 0:
+                break
+            results = []
+            self._respondLock.acquire()
+            self._normalCache = normalCache
+            self._matchCache = matchCache
+            try:
+                for request, input in chunk:
+                    results.append((request, self._batchExchange(
+                                request, input, events, pending)))
+            finally:
+                self._normalCache = self._matchCache = None
+                self._respondLock.release()
+            for result in results:
+                yield result
+
+    def _batchExchange(self, request, input, events, pending):
+        """Run one exchange of a respond_many() batch.
+
+        If an earlier exchange for the same session is still pending, this
+        one is chained after it, so that the session's histories are
+        updated in order.
+
+        """
+        if len(input) == 0:
+            return ""
+        sessionID = request.session_id
+        if sessionID in pending:
+            response = defer.Deferred()
+            # fired when this exchange settles, so that the next one for
+            # the session waits for this one, not for the previous one
+            after = defer.Deferred()
+
+            def _next(ignored):
+                self._respondLock.acquire()
+                try:
+                    d = defer.maybeDeferred(
+                        self._exchange, request, input, events)
+                finally:
+                    self._respondLock.release()
+                d.chainDeferred(response)
+                d.addBoth(lambda ignored: after.callback(None))
+            pending[sessionID].addCallback(_next)
+        else:
+            response = self._exchange(request, input, events)
+            if not isinstance(response, defer.Deferred):
+                return response
+            after = defer.Deferred()
+
+            def _fire(result):
+                after.callback(None)
+                return result
+            response.addBoth(_fire)
+        pending[sessionID] = after
+
+        def _settled(ignored):
+            if pending.get(sessionID) is after:
+                del pending[sessionID]
+        after.addCallback(_settled)
+        return response
+
+    def _exchange(self, request, input, events=True):
+        """Respond to one input, updating the session histories.
+
+        This does the work of respond() and respond_many(); the caller must
+        hold the respond lock.  Returns the encoded response, or a Deferred
+        if some sentence of the input could not be answered synchronously.
+
+        """
+        if events:
+            self._events.notify(
+                PersonSpeaksEvent(self).update(request, input))
 
         #ensure that input is a unicode string
         try:
@@ -397,71 +1151,131 @@ class Kernel(object):
         except AttributeError:
             pass
 
-        # prevent other threads from stomping all over us.
-        self._respondLock.acquire()
-
         # FIX: get the session id from the request
 
         # Add the session, if it doesn't already exist
-        self._addSession(request.session_id or _globalSessionID)
+        self._addSession(request.session_id)
+        session = self._sessions[request.session_id]
+        inputHistory = session[self._inputHistory]
+        # the memo belongs to the exchange: other exchanges of the session
+        # may be in progress too
+        memo = request.aiml_memo = SraiMemo()
+        paths = None
+        if self._shards is not None:
+            # the paths matched by the shards, for the stars
+            paths = request.aiml_paths = {}
+        trace = self._startTrace(request, input)
 
         # split the input into discrete sentences
         sentences = utils.sentences(input)
 
-        _responses = []
-
-        def _gotResponses(responses):
-            finalResponse = ""
-            for ret, response in responses:
-                # add the data from this exchange to the history lists
-                outputHistory = self.getPredicate(
-                    self._outputHistory, request.session_id)
-                outputHistory.append(response)
-                while len(outputHistory) > self._maxHistorySize:
-                    outputHistory.pop(0)
-                    self.setPredicate(
-                        self._outputHistory, outputHistory, request.session_id)
-                # append this response to the final response.
-                finalResponse += (response + "  ")
-            finalResponse = finalResponse.strip()
-            assert(len(self.getPredicate(
-                        self._inputStack, request.session_id)) == 0)
-
-            # release the lock and return
-            self._respondLock.release()
-            notify(BotRespondsEvent(self).update(request, finalResponse))
-            try:
-                return finalResponse.encode(self._textEncoding)
-            except UnicodeError:
-                return finalResponse
-
-        def _failed(resp):
-            print 'FAILED'
-            print resp
-            self._respondLock.release()
-
-        for s in sentences:
+        def _sentence(s):
             # Add the input to the history list before fetching the
             # response, so that <input/> tags work properly.
-            inputHistory = self.getPredicate(
-                self._inputHistory, request.session_id)
             inputHistory.append(s)
             while len(inputHistory) > self._maxHistorySize:
                 inputHistory.pop(0)
-            self.setPredicate(
-                self._inputHistory, inputHistory, request.session_id)
 
             # Fetch the response
-            _responses.append(self._respond(request, s))
-        return defer.DeferredList(
-            _responses).addCallback(_gotResponses).addErrback(_failed)
+            return self._respond(request, s)
+
+        def _gotResponses(responses):
+            if paths is not None \
+                    and getattr(request, "aiml_paths", None) is paths:
+                del request.aiml_paths
+            return self._finishExchange(
+                request, responses, events, memo, trace)
+
+        # answer the sentences one after the other, each waiting for the
+        # response to the previous one, and in the cooperative mode,
+        # pausing when the time slice is used up
+        self._newSlice()
+        responses = self._inSequence(
+            request, [lambda s=s: _sentence(s) for s in sentences])
+        if isinstance(responses, defer.Deferred):
+            return responses.addCallback(_gotResponses)
+        return _gotResponses(responses)
+
+    def _startTrace(self, request, input):
+        """Return the RequestTrace of the exchange starting, or None.
+
+        The request is traced if the caller attached a new RequestTrace
+        to it as aiml_trace, or else if it is sampled.  While the slow
+        request log is enabled, every exchange is timed, and a sample of
+        them is traced in detail.  The trace is kept in the aiml_trace
+        of the request, where the exchange records what it does.
+
+        """
+        trace = getattr(request, "aiml_trace", None)
+        if trace is not None and trace.finished:
+            # left over from an earlier exchange
+            del request.aiml_trace
+            trace = None
+        if trace is None:
+            if self._traceRate > 0 and random.random() < self._traceRate:
+                trace = RequestTrace()
+            elif self._slowLog is not None:
+                sampleRate = self._slowLog.sampleRate
+                # untraced matches take the fast paths
+                trace = RequestTrace(detailed=sampleRate > 0
+                                     and random.random() < sampleRate)
+            else:
+                return None
+            request.aiml_trace = trace
+        trace.begin(input)
+        return trace
+
+    def _finishExchange(self, request, responses, events, memo, trace):
+        """Record the responses to the sentences of one input in the
+        output history, and return the final (encoded) response.
+
+        """
+        session = self._sessions[request.session_id]
+        if getattr(request, "aiml_memo", None) is memo:
+            del request.aiml_memo
+        self._memoHits += memo.hits
+        self._memoMisses += memo.misses
+        if self._debugMode:
+            print "srai memo: %d hits, %d misses" % (memo.hits, memo.misses)
+        outputHistory = session[self._outputHistory]
+        finalResponse = ""
+        for response in responses:
+            # add the data from this exchange to the history lists
+            outputHistory.append(response)
+            while len(outputHistory) > self._maxHistorySize:
+                outputHistory.pop(0)
+            # append this response to the final response.
+            finalResponse += (response + "  ")
+        finalResponse = finalResponse.strip()
+        assert(len(session[self._inputStack]) == 0)
+        if trace is not None:
+            trace.finish(finalResponse)
+            if self._slowLog is not None:
+                self._slowLog.check(request.session_id, trace, self._pathOf)
+            if self._debugMode and trace.detailed:
+                print trace.format().encode(self._textEncoding, 'replace')
+
+        if events:
+            self._events.notify(
+                BotRespondsEvent(self).update(request, finalResponse))
+            # queued events are delivered once the response is returned
+            self._events.schedule()
+        try:
+            return finalResponse.encode(self._textEncoding)
+        except UnicodeError:
+            return finalResponse
 
     # This version of _respond() just fetches the response for some input.
     # It does not mess with the input and output histories.  Recursive calls
     # to respond() spawned from tags like <srai> should call this function
     # instead of respond().
     def _respond(self, request, input):
-        """Private version of respond(), does the real work."""
+        """Private version of respond(), does the real work.
+
+        Returns the response string, or a Deferred if the response could
+        not be computed synchronously.
+
+        """
         if len(input) == 0:
             return ""
 
@@ -469,8 +1283,9 @@ class Kernel(object):
             print "topic =",
             self.getPredicate("topic", request.session_id), "star =",
             self.getPredicate("star", request.session_id)
+        session = self._sessions[request.session_id]
         # guard against infinite recursion
-        inputStack = self.getPredicate(self._inputStack, request.session_id)
+        inputStack = session[self._inputStack]
         if len(inputStack) > self._maxRecursionDepth:
             if self._verboseMode:
                 err = "WARNING: maximum recursion depth exceeded (input='%s')"\
@@ -478,66 +1293,503 @@ class Kernel(object):
                 sys.stderr.write(err)
             return ""
 
+        trace = getattr(request, "aiml_trace", None)
+        hop = None
+        if trace is not None:
+            hop = trace.enter(input, len(inputStack))
+
         # push the input onto the input stack
-        inputStack = self.getPredicate(self._inputStack, request.session_id)
         inputStack.append(input)
-        self.setPredicate(self._inputStack, inputStack, request.session_id)
+        inFlight = self._inFlight
+        self._inFlight = request
+        try:
+            response = self._reduce(request, session, inputStack, hop)
+        finally:
+            # pop the top entry off the input stack.
+            inputStack.pop()
+            self._inFlight = inFlight
+
+        if isinstance(response, defer.Deferred):
+
+            def _failed(resp):
+                resp.printTraceback()
+                resp.raiseException()
+            response.addCallback(_stripResponse).addErrback(_failed)
+            if hop is not None:
+                def _left(result):
+                    trace.leave(hop)
+                    return result
+                response.addBoth(_left)
+            return response
+        if hop is not None:
+            trace.leave(hop)
+        return _stripResponse(response)
+
+    def _respondMemo(self, request, input):
+        """Version of _respond() for <srai> inputs, using the SraiMemo of
+        the current request.
+
+        Results are keyed by the normalized input and the 'that' and
+        'topic' context.  Only results computed synchronously, without
+        evaluating anything with side effects or an unrepeatable result,
+        are stored.
+
+        """
+        session = self._sessions[request.session_id]
+        memo = getattr(request, "aiml_memo", None)
+        if memo is None or len(input) == 0:
+            return self._respond(request, input)
+        try:
+            that = session[self._outputHistory][-1]
+        except IndexError:
+            that = ""
+        key = (self._normalize(input), that, session.get("topic", ""))
+        response = memo.get(key)
+        if response is not None:
+            trace = getattr(request, "aiml_trace", None)
+            if trace is not None:
+                trace.enter(input, len(session[self._inputStack]), memo=True)
+            return response
+        mark = memo.mark()
+        response = self._respond(request, input)
+        if not isinstance(response, defer.Deferred):
+            memo.store(key, response, mark)
+        return response
+
+    def _noteSideEffect(self, request, volatile=False):
+        """Record that the element being processed has side effects, or
+        an unrepeatable result if volatile is true, so that the srai memo
+        of the current request doesn't reuse results which depend on it.
+
+        """
+        memo = getattr(request, "aiml_memo", None)
+        if memo is not None:
+            if volatile:
+                memo.volatile()
+            else:
+                memo.write()
+
+    def _reduce(self, request, session, inputStack, hop=None, depth=None,
+                elem=_unmatched):
+        """Match and evaluate the input at the top of the input stack.
+
+        <srai> reductions are evaluated iteratively.  When the matched
+        template consists of a lone <srai> or <sr> element, that element is
+        a tail call: its new input replaces the current one at the top of
+        the input stack and the loop matches again, instead of recursing
+        through _processSrai() and _respond().  Every reduction still
+        counts towards _maxRecursionDepth.
+
+        If the request is traced, its matches are recorded in hop.
+
+        In the cooperative mode, the reduction may pause (between
+        reductions, or while matching) and return a Deferred.  It then
+        resumes with the number of reductions so far as depth, and the
+        template already matched for the input as elem, if any.
+
+        """
+        input = inputStack[-1]
+        if depth is None:
+            depth = len(inputStack)
+        while True:
+            if elem is _unmatched:
+                elem = self._matchInput(request, session, input, hop)
+                if isinstance(elem, defer.Deferred):
+                    return self._resumeLater(
+                        elem, request, session,
+                        lambda elem: self._reduce(
+                            request, session, inputStack, hop, depth, elem))
+            if elem is None:
+                if self._verboseMode:
+                    err = "WARNING: No match found for input: %s\n"\
+                        % input.encode(self._textEncoding)
+                    sys.stderr.write(err)
+                return ""
+            if id(elem) in self._sraiLoops:
+                if self._verboseMode:
+                    err = "WARNING: endless srai loop (input='%s')\n"\
+                        % input.encode(self._textEncoding, 'replace')
+                    sys.stderr.write(err)
+                return ""
+
+            tail = self._tailSrai(elem)
+            if tail is None:
+                return self._processElement(elem, request)
+            if tail[0] == "sr":
+                newInput = self._processStar(_star, request)
+            else:
+                newInput = self._processContents(tail, request)
+            if isinstance(newInput, defer.Deferred):
+                if self._cooperative:
+                    return self._resumeLater(
+                        newInput, request, session, self._reduceTail,
+                        request, session, hop, depth)
+                # The new input isn't ready yet, so the reduction carries
+                # on as an ordinary (asynchronous) <srai>.
+                return newInput.addCallback(
+                    lambda newInput: self._respond(request, newInput))
+            if len(newInput) == 0:
+                return ""
+
+            depth += 1
+            if self._tooDeep(depth, newInput):
+                return ""
+            input = inputStack[-1] = newInput
+            elem = _unmatched
+            if self._cooperative and self._mustPause():
+                return self._resumeLater(
+                    self._pause(), request, session,
+                    lambda ignored: self._reduce(
+                        request, session, inputStack, hop, depth))
+
+    def _reduceTail(self, newInput, request, session, hop, depth):
+        """Carry on with a reduction paused while computing the input of
+        a tail <srai> or <sr> element (cooperative mode).
+
+        """
+        if len(newInput) == 0:
+            return ""
+        depth += 1
+        if self._tooDeep(depth, newInput):
+            return ""
+        inputStack = session[self._inputStack]
+        inputStack[-1] = newInput
+        return self._reduce(request, session, inputStack, hop, depth)
+
+    def _tooDeep(self, depth, input):
+        """Return True, with a warning, if a reduction of depth is too
+        deep.
+
+        """
+        if depth <= self._maxRecursionDepth + 1:
+            return False
+        if self._verboseMode:
+            err = "WARNING: maximum recursion depth exceeded "\
+                "(input='%s')"\
+                % input.encode(self._textEncoding, 'replace')
+            sys.stderr.write(err)
+        return True
+
+    def _newSlice(self, result=None):
+        """Start a new time slice of the cooperative mode."""
+        self._sliceEnd = time.time() + self._sliceTime
+        return result
 
-        # run the input through the 'normal' subber
-        subbedInput = self._subbers['normal'].sub(input)
+    def _mustPause(self):
+        """Return True if the cooperative mode should give the reactor
+        back now: the time slice is used up, and no element processor
+        which needs synchronous results is running.
 
+        """
+        return self._pinned == 0 and time.time() >= self._sliceEnd
+
+    def _pause(self):
+        """Return a Deferred firing in a later reactor iteration, with a
+        new time slice.
+
+        """
+        from twisted.internet import reactor
+        return task.deferLater(reactor, 0, self._newSlice)
+
+    def _resumeLater(self, d, request, session, func, *args):
+        """Call func(result, *args) once d fires, with the input stack of
+        session as it is now, and return d.
+
+        This carries on a paused evaluation: the input stack has been
+        popped (and maybe used by other exchanges) in the meantime.
+
+        """
+        stack = list(session[self._inputStack])
+
+        def _resume(result):
+            inputStack = session[self._inputStack]
+            saved = inputStack[:]
+            inputStack[:] = stack
+            inFlight = self._inFlight
+            self._inFlight = request
+            self._newSlice()
+            try:
+                return func(result, *args)
+            finally:
+                inputStack[:] = saved
+                self._inFlight = inFlight
+        return d.addCallback(_resume)
+
+    def _inSequence(self, request, steps, results=None, start=0):
+        """Call the functions in steps one after the other, and return
+        the list of their results.
+
+        When a step returns a Deferred, or when the time slice of the
+        cooperative mode is used up between two steps, the next steps
+        wait, and a Deferred firing with the list is returned instead.
+
+        """
+        if results is None:
+            results = []
+        session = self._sessions[request.session_id]
+        for i in xrange(start, len(steps)):
+            if i > start and self._cooperative and self._mustPause():
+                return self._resumeLater(
+                    self._pause(), request, session,
+                    lambda ignored, i=i: self._inSequence(
+                        request, steps, results, i))
+            result = steps[i]()
+            if isinstance(result, defer.Deferred):
+                def _next(result, i=i):
+                    results.append(result)
+                    return self._inSequence(request, steps, results, i + 1)
+                return self._resumeLater(result, request, session, _next)
+            results.append(result)
+        return results
+
+    def _matchInput(self, request, session, input, hop=None):
+        """Return the template matching input in the context of session
+        (its last response and current topic), or None.
+
+        If hop is not None, the match is recorded in it.  The matches of
+        detailed traces go through PatternMgr.matchPath(), bypassing the
+        srai links and the batch cache; the others only record what was
+        matched, and the slow request log looks the path up if needed.
+
+        With threaded matching, a Deferred firing with the template may
+        be returned instead.
+
+        """
         # fetch the bot's previous response, to pass to the match()
         # function as 'that'.
-        outputHistory = self.getPredicate(
-            self._outputHistory, request.session_id)
+        outputHistory = session[self._outputHistory]
         try:
             that = outputHistory[-1]
         except IndexError:
             that = ""
 
-        subbedThat = self._subbers['normal'].sub(that)
-
         # fetch the current topic
-        topic = self.getPredicate("topic", request.session_id)
-        subbedTopic = self._subbers['normal'].sub(topic)
+        topic = session.get("topic", "")
 
-        # Determine the final response.
-        response = []
-        elem = self._brain.match(subbedInput, subbedThat, subbedTopic)
+        if self._shards is not None:
+            return self._matchSharded(request, input, that, topic, hop)
+        if self._matchPool is not None:
+            return self._matchThreaded(request, input, that, topic, hop)
+
+        # run the input, 'that' and the topic through the 'normal' subber
+        subbedInput = self._normalize(input)
+        subbedThat = self._normalize(that)
+        subbedTopic = self._normalize(topic)
 
         if self._debugMode:
             print "key =", subbedInput, subbedThat, subbedTopic
 
-        if elem is None:
-            response = defer.maybeDeferred(lambda x: x, None)
-            if self._verboseMode:
-                err = "WARNING: No match found for input: %s\n"\
-                    % input.encode(self._textEncoding)
-                sys.stderr.write(err)
+        if hop is None or not request.aiml_trace.detailed:
+            if self._cooperative and self._pinned == 0:
+                elem = self._matchCooperatively(
+                    subbedInput, subbedThat, subbedTopic)
+            else:
+                elem = self._match(subbedInput, subbedThat, subbedTopic)
+            if hop is not None:
+                request.aiml_trace.matched(
+                    hop, subbedInput, subbedThat, subbedTopic, None, None)
+            return elem
+        start = time.time()
+        path, elem = self._brain.matchPath(
+            subbedInput, subbedThat, subbedTopic)
+        request.aiml_trace.matched(
+            hop, subbedInput, subbedThat, subbedTopic,
+            self._brain.pathString(path), time.time() - start)
+        return elem
+
+    def _matchThreaded(self, request, input, that, topic, hop):
+        """Version of _matchInput() for threaded matching.
+
+        Returns a Deferred firing with the template, or the template
+        itself if an element processor which needs synchronous results
+        is running.
 
+        """
+        brain = self._brainSnapshot()
+        normal = self._subbers['normal']
+        # the matches of detailed traces bypass the srai links
+        links = self._sraiLinks
+        if hop is not None and request.aiml_trace.detailed:
+            links = None
+        if self._pinned:
+            return self._matchedThreaded(
+                _matchSnapshot(brain, normal, links, input, that, topic),
+                request, hop)
+        d = self._matchPool.run(_matchSnapshot, brain, normal, links,
+                                input, that, topic)
+        return d.addCallback(self._matchedThreaded, request, hop)
+
+    def _matchedThreaded(self, result, request, hop):
+        """Account for the result of _matchSnapshot(), and return the
+        template.
+
+        """
+        (input, that, topic), path, elem, duration = result
+        if self._debugMode:
+            print "key =", input, that, topic
+        if duration is None:
+            self._matchCounts["linked"] += 1
         else:
+            self._matchCounts["matched"] += 1
+        if hop is not None:
+            if path is not None:
+                path = self._brain.pathString(path)
+            request.aiml_trace.matched(hop, input, that, topic, path,
+                                       duration)
+        return elem
 
-            def _gotResponse(resp):
-                return (resp.strip() + ' ').strip()
+    def _matchSharded(self, request, input, that, topic, hop):
+        """Version of _matchInput() matching with the ShardedBrain.
 
-            def _getResponse(elem, session):
-                return self._processElement(elem, request)
+        Returns a Deferred firing with the template.  The path matched is
+        kept in the aiml_paths of the request, for _star().
+
+        """
+        subbedInput = self._normalize(input)
+        subbedThat = self._normalize(that)
+        subbedTopic = self._normalize(topic)
+        if self._debugMode:
+            print "key =", subbedInput, subbedThat, subbedTopic
+        self._matchCounts["matched"] += 1
+        start = time.time()
+        d = self._shards.matchPath(subbedInput, subbedThat, subbedTopic)
+
+        def _matched((path, elem)):
+            paths = getattr(request, "aiml_paths", None)
+            if paths is not None and path is not None:
+                paths[(subbedInput, subbedThat, topic)] = path
+            if hop is not None:
+                request.aiml_trace.matched(
+                    hop, subbedInput, subbedThat, subbedTopic,
+                    self._brain.pathString(path), time.time() - start)
+            return elem
+        return d.addCallback(_matched)
+
+    def _pathOf(self, input, that, topic):
+        """Return the path of the pattern matching the normalized input,
+        that and topic, as a string (see PatternMgr.pathString()).
 
-            response = defer.maybeDeferred(
-                _getResponse, elem,
-                request.session_id).addCallback(_gotResponse)
+        """
+        path, elem = self._brain.matchPath(input, that, topic)
+        return self._brain.pathString(path)
 
-        # pop the top entry off the input stack.
-        inputStack = self.getPredicate(self._inputStack, request.session_id)
-        inputStack.pop()
-        self.setPredicate(self._inputStack, inputStack, request.session_id)
+    def _star(self, starType, request, input, that, topic, index):
+        """Return the star of starType (see PatternMgr.star()) matched in
+        the normalized input and that, and the topic.
 
-        def _failed(resp):
-            resp.printTraceback()
-            resp.raiseException()
+        With a ShardedBrain, the star is taken from the path of the match
+        made for the request, or is empty if there was none.
 
-        response.addErrback(_failed)
-        return response
+        """
+        if self._shards is None:
+            return self._brain.star(starType, input, that, topic, index)
+        path = getattr(request, "aiml_paths", {}).get((input, that, topic))
+        if path is None:
+            return ""
+        return self._shards.star(starType, path, input, that, topic, index)
+
+    def _brainSnapshot(self):
+        """Return the snapshot of the brain used by threaded matching,
+        taking a new one if the brain changed since the last one.
+
+        """
+        if self._snapshotGeneration != self._brainGeneration:
+            self._snapshot = self._brain.snapshot()
+            self._snapshotGeneration = self._brainGeneration
+        return self._snapshot
+
+    def _tailSrai(self, elem):
+        """Return the <srai> or <sr> element making up the whole of the
+        template elem, or None.
+
+        Whitespace text around the element is ignored, as responses are
+        stripped anyway.
+
+        """
+        tail = None
+        for e in elem[2:]:
+            if e[0] == "text" and len(e[2].strip()) == 0:
+                continue
+            if tail is not None or e[0] not in ("srai", "sr"):
+                return None
+            tail = e
+        return tail
+
+    def _normalize(self, text):
+        """Run text through the 'normal' subber.
+
+        While respond_many() is processing a batch, the results are cached
+        for the rest of the batch.
+
+        """
+        cache = self._normalCache
+        if cache is None:
+            return self._subbers['normal'].sub(text)
+        try:
+            return cache[text]
+        except KeyError:
+            if len(cache) >= self._maxBatchCacheSize:
+                cache.clear()
+            subbed = cache[text] = self._subbers['normal'].sub(text)
+            return subbed
+
+    def _match(self, input, that, topic):
+        """Return the template matching the normalized input, that and
+        topic, or None.
+
+        Inputs linked by analyzeSrai() skip matching altogether.  While
+        respond_many() is processing a batch, matches are cached for the
+        rest of the batch.
+
+        """
+        # literal srai targets found by analyzeSrai()
+        counts = self._matchCounts
+        elem = self._sraiLinks.get(input)
+        if elem is not None:
+            counts["linked"] += 1
+            return elem
+        cache = self._matchCache
+        if cache is None:
+            counts["matched"] += 1
+            return self._brain.match(input, that, topic)
+        key = (input, that, topic)
+        try:
+            elem = cache[key]
+        except KeyError:
+            if len(cache) >= self._maxBatchCacheSize:
+                cache.clear()
+            counts["matched"] += 1
+            elem = cache[key] = self._brain.match(input, that, topic)
+            return elem
+        counts["cached"] += 1
+        return elem
+
+    def _matchCooperatively(self, input, that, topic):
+        """Version of _match() for the cooperative mode.
+
+        Returns the template, or a Deferred firing with it if matching
+        paused because the time slice was used up.  The respond_many()
+        batch cache is not used.
+
+        """
+        elem = self._sraiLinks.get(input)
+        if elem is not None:
+            self._matchCounts["linked"] += 1
+            return elem
+        self._matchCounts["matched"] += 1
+        return self._driveMatch(self._brain.iterMatch(input, that, topic))
+
+    def _driveMatch(self, matcher):
+        """Run the PatternMgr.iterMatch() generator matcher until it is
+        done or the time slice is used up.
+
+        """
+        for item in matcher:
+            if item is not None:
+                return item[1]
+            if self._mustPause():
+                return self._pause().addCallback(
+                    lambda ignored: self._driveMatch(matcher))
 
     def _processElement(self, elem, request):
         """Process an AIML element.
@@ -560,8 +1812,80 @@ class Kernel(object):
                     % elem[0].encode(self._textEncoding, 'replace')
                 sys.stderr.write(err)
             return ""
+        if elem[0] not in self._pausingTags and elem[0] != "text" \
+                and len(elem) > 2:
+            # The contents may return Deferreds (<system> commands,
+            # threaded or sharded matches...), which this processor
+            # cannot take.
+            return self._processAfterContents(elem, request, handlerFunc)
+        if (self._cooperative or self._matchPool is not None
+                or self._shards is not None) \
+                and elem[0] not in self._pausingTags:
+            # This processor needs the results of the elements it
+            # contains right away.
+            self._pinned += 1
+            try:
+                return handlerFunc(elem, request)
+            finally:
+                self._pinned -= 1
         return handlerFunc(elem, request)
 
+    def _processAfterContents(self, elem, request, handlerFunc):
+        """Process elem, whose processor needs the results of the elements
+        it contains right away, once these results are known.
+
+        The contained elements are processed first, in order, and may
+        return Deferreds.  The processor is then called with a copy of
+        elem in which each of them is replaced by a text element holding
+        its result.  Returns the result of the processor, or a Deferred
+        firing with it.
+
+        """
+        def _process(results):
+            resolved = Element([elem[0], elem[1]] +
+                               [Element(("text", _preserve, result))
+                                for result in results])
+            self._pinned += 1
+            try:
+                return handlerFunc(resolved, request)
+            finally:
+                self._pinned -= 1
+        results = self._inSequence(
+            request, [lambda e=e: self._processElement(e, request)
+                      for e in elem[2:]])
+        if isinstance(results, defer.Deferred):
+            return results.addCallback(_process)
+        return _process(results)
+
+    def _processContents(self, elem, request):
+        """Process the contents of an element, and return the results
+        concatenated.
+
+        Returns a string if every child element was processed
+        synchronously, or else a Deferred which fires with the string.
+        Errors in child elements are printed, and their output skipped.
+
+        The contents are processed in order, each element waiting for the
+        results of the previous ones, so that a <system> command, a
+        threaded or sharded match, or a pause of the cooperative mode
+        does not change the order of side effects.
+
+        """
+        def _step(e):
+            try:
+                result = self._processElement(e, request)
+            except:
+                failure.Failure().printTraceback()
+                return ""
+            if isinstance(result, defer.Deferred):
+                return result.addErrback(_printFailure)
+            return result
+        results = self._inSequence(
+            request, [lambda e=e: _step(e) for e in elem[2:]])
+        if isinstance(results, defer.Deferred):
+            return results.addCallback("".join)
+        return "".join(results)
+
     ######################################################
     ### Individual element-processing functions follow ###
     ######################################################
@@ -612,27 +1936,16 @@ class Kernel(object):
 
         """
         attr = None
+        # the <li> element chosen in cases #2 and #3
         response = []
         attr = elem[1]
 
-        def _gotResponses(responses):
-            _response = ''
-            for result, resp in responses:
-                if result:
-                    _response += resp
-                else:
-                    resp.printTraceback()
-            return _response
-
         # Case #1: test the value of a specific predicate for a
         # specific value.
         if 'name' in attr and 'value' in attr:
             val = self.getPredicate(attr['name'], request.session_id)
             if val == attr['value']:
-                for e in elem[2:]:
-                    response.append(
-                        defer.maybeDeferred(self._processElement, e, request))
-                return defer.DeferredList(response).addCallback(_gotResponses)
+                return self._processContents(elem, request)
         else:
             # Case #2 and #3: Cycle through <li> contents, testing a
             # name and value pair for each one.
@@ -669,9 +1982,7 @@ class Kernel(object):
                         if self.getPredicate(
                             liName, request.session_id) == liValue:
                             foundMatch = True
-                            response.append(
-                                defer.maybeDeferred(
-                                    self._processElement, li, request))
+                            response.append(li)
                             break
                     except:
                         # No attributes, no name/value attributes, no
@@ -686,9 +1997,7 @@ class Kernel(object):
                         li = listitems[-1]
                         liAttr = li[1]
                         if not ('name' in liAttr or 'value' in liAttr):
-                            response.append(
-                                defer.maybeDeferred(
-                                    self._processElement, li, request))
+                            response.append(li)
                     except:
                         # listitems was empty, no attributes, missing
                         # name/value attributes, or processing error.
@@ -700,7 +2009,9 @@ class Kernel(object):
                 if self._verboseMode:
                     print "catastrophic condition failure"
                 raise
-        return defer.DeferredList(response).addCallback(_gotResponses)
+        if len(response) == 0:
+            return ""
+        return self._processElement(response[0], request)
 
     # <date>
     def _processDate(self, elem, request):
@@ -711,6 +2022,7 @@ class Kernel(object):
         this information, so I go with whatever's simplest.
 
         """
+        self._noteSideEffect(request, volatile=True)
         return time.asctime()
 
     # <formal>
@@ -792,6 +2104,7 @@ class Kernel(object):
         the current session.
 
         """
+        self._noteSideEffect(request, volatile=True)
         inputHistory = self.getPredicate(
             self._inputHistory, request.session_id)
         try:
@@ -829,6 +2142,11 @@ class Kernel(object):
         treat the result as an AIML file to open and learn.
 
         """
+        if self._shards is not None:
+            if self._verboseMode:
+                sys.stderr.write("WARNING: cannot learn while the brain "
+                                 "is sharded\n")
+            return ""
         filename = ""
         for e in elem[2:]:
             filename += self._processElement(e, request)
@@ -836,6 +2154,7 @@ class Kernel(object):
             self.learn(filename)
         else:
             self._createCategory(filename)
+        self._noteSideEffect(request)
         return ""
 
     # <li>
@@ -852,20 +2171,7 @@ class Kernel(object):
         _processRandom() for details of their usage.
 
         """
-
-        def _gotResponses(responses):
-            _response = ''
-            for result, resp in responses:
-                if result:
-                    _response += resp
-                else:
-                    resp.printTraceback()
-            return _response
-        response = []
-        for e in elem[2:]:
-            response.append(
-                defer.maybeDeferred(self._processElement, e, request))
-        return defer.DeferredList(response).addCallback(_gotResponses)
+        return self._processContents(elem, request)
 
     # <lowercase>
     def _processLowercase(self, elem, request):
@@ -897,7 +2203,7 @@ class Kernel(object):
         for e in elem[2:]:
             response += self._processElement(e, request)
         if len(elem[2:]) == 0:  # atomic <person/> = <person><star/></person>
-            response = self._processElement(['star', {}], request)
+            response = self._processElement(_star, request)
         return self._subbers['person'].sub(response)
 
     # <person2>
@@ -918,7 +2224,7 @@ class Kernel(object):
             response += self._processElement(e, request)
         if len(elem[2:]) == 0:
             # atomic <person2/> = <person2><star/></person2>
-            response = self._processElement(['star', {}], request)
+            response = self._processElement(_star, request)
         return self._subbers['person2'].sub(response)
 
     # <random>
@@ -933,6 +2239,7 @@ class Kernel(object):
         contents are ignored.
 
         """
+        self._noteSideEffect(request, volatile=True)
         listitems = []
         for e in elem[2:]:
             if e[0] == 'li':
@@ -981,6 +2288,7 @@ class Kernel(object):
         for e in elem[2:]:
             value += self._processElement(e, request)
         self.setPredicate(elem[1]['name'], value, request.session_id)
+        self._noteSideEffect(request)
         return value
 
     # <size>
@@ -1000,8 +2308,8 @@ class Kernel(object):
         <sr> elements are shortcuts for <srai><star/></srai>.
 
         """
-        star = self._processElement(['star', {}], request)
-        response = self._respond(star, request)
+        star = self._processElement(_star, request)
+        response = self._respond(request, star)
         return response
 
     # <srai>
@@ -1014,20 +2322,11 @@ class Kernel(object):
         returned.
 
         """
-
-        def _gotResponses(responses):
-            _response = ''
-            for result, resp in responses:
-                if result:
-                    _response += resp
-                else:
-                    resp.printTraceback()
-            return self._respond(request, _response)
-        newInput = []
-        for e in elem[2:]:
-            newInput.append(
-                defer.maybeDeferred(self._processElement, e, request))
-        return defer.DeferredList(newInput).addCallback(_gotResponses)
+        newInput = self._processContents(elem, request)
+        if isinstance(newInput, defer.Deferred):
+            return newInput.addCallback(
+                lambda newInput: self._respond(request, newInput))
+        return self._respondMemo(request, newInput)
 
     # <star>
     def _processStar(self, elem, request):
@@ -1060,8 +2359,7 @@ class Kernel(object):
             # there might not be any output yet
             that = ""
         topic = self.getPredicate("topic", request.session_id)
-        response = self._brain.star(
-            "star", input, that, topic, index)
+        response = self._star("star", request, input, that, topic, index)
         return response
 
     # <template>
@@ -1073,21 +2371,7 @@ class Kernel(object):
         response tree.
 
         """
-        response = []
-
-        def _gotResponses(responses):
-            _response = ''
-            for result, resp in responses:
-                if result:
-                    _response += resp
-                else:
-                    resp.printTraceback()
-            return _response
-
-        for e in elem[2:]:
-            response.append(
-                defer.maybeDeferred(self._processElement, e, request))
-        return defer.DeferredList(response).addCallback(_gotResponses)
+        return self._processContents(elem, request)
 
     # text
     def _processText(self, elem, request):
@@ -1107,11 +2391,10 @@ class Kernel(object):
 
         # If the the whitespace behavior for this element is "default",
         # we reduce all stretches of >1 whitespace characters to a single
-        # space.  To improve performance, we do this only once for each
-        # text element encountered, and save the results for the future.
+        # space.  The parser already does it for the elements it freezes
+        # (see bit.aiml.async.elements), which must not be changed.
         if elem[1]["xml:space"] == "default":
-            elem[2] = re.sub("\s+", " ", elem[2])
-            elem[1]["xml:space"] = "preserve"
+            return re.sub("\s+", " ", elem[2])
         return elem[2]
 
     # <that>
@@ -1178,7 +2461,8 @@ class Kernel(object):
             # there might not be any output yet
             that = ""
         topic = self.getPredicate("topic", request.session_id)
-        response = self._brain.star("thatstar", input, that, topic, index)
+        response = self._star("thatstar", request, input, that, topic,
+                              index)
         return response
 
     # <think>
@@ -1225,7 +2509,8 @@ class Kernel(object):
             # there might not be any output yet
             that = ""
         topic = self.getPredicate("topic", request.session_id)
-        response = self._brain.star("topicstar", input, that, topic, index)
+        response = self._star("topicstar", request, input, that, topic,
+                              index)
         return response
 
     # <uppercase>
@@ -1304,8 +2589,9 @@ class Kernel(object):
 
         <system> elements process their contents recursively, and then
         attempt to execute the results as a shell command on the
-        server.  The AIML interpreter blocks until the command is
-        complete, and then returns the command's output.
+        server.  The command runs asynchronously, within the limits set
+        by setSystemLimits(), and the command's output is returned
+        (through a Deferred) once it is complete.
 
         For cross-platform compatibility, any file paths inside
         <system> tags should use Unix-style forward slashes ("/") as a
@@ -1313,11 +2599,16 @@ class Kernel(object):
 
         """
         # build up the command string
-        command = ""
+        command = self._processContents(elem, request)
+        if isinstance(command, defer.Deferred):
+            return command.addCallback(self._runSystem, elem, request)
+        return self._runSystem(command, elem, request)
 
-        for e in elem[2:]:
-            command += self._processElement(e, request.session_id)
+    def _runSystem(self, command, elem, request):
+        """Run the command of a <system> element: either the IAIMLMacro
+        adapter named after it, or else a shell command.
 
+        """
         #HACK
 
         #inputStack = self.getPredicate(self._inputStack, request.session_id)
@@ -1328,15 +2619,17 @@ class Kernel(object):
         #try: that = self._subbers['normal'].sub(outputHistory[-1])
         #except: that = "" # there might not be any output yet
         #topic = self.getPredicate("topic", request.session_id)
-        
-        command = queryMultiAdapter([self, request], IAIMLMacro, name=command)
 
-        if command:
-            def _complete(result):
-                command.complete()
+        self._noteSideEffect(request)
+        macro = self._macros.query(command, request)
+
+        if macro:
+            def _gotResult(result):
                 return result or ''
-            return defer.maybeDeferred(
-                command.parse, elem).addCallback(_complete)
+            return self._traceSystem(request, command, "macro",
+                                     self._macroRunner.run(
+                                         command, macro, elem)
+                                     ).addCallback(_gotResult)
 
         #/HACK
 
@@ -1349,22 +2642,83 @@ class Kernel(object):
         #command = executable + " " + args
         command = os.path.normpath(command)
 
-        # execute the command.
-        response = ""
-        try:
-            out = os.popen(command)
-        except RuntimeError, msg:
+        def _gotOutput(response):
+            return string.join(response.splitlines()).strip()
+
+        def _failed(failure):
             if self._verboseMode:
-                err = "WARNING: RuntimeError while processing "
-                + " \"system\" element:\n%s\n" \
-                    % msg.encode(self._textEncoding, 'replace')
+                err = "WARNING: %s while processing \"system\" element:"\
+                    "\n%s\n" % (failure.type.__name__,
+                                 failure.getErrorMessage())
                 sys.stderr.write(err)
             return """ There was an error while computing my response.
  Please inform my botmaster."""
-        for line in out:
-            response += line + "\n"
-        response = string.join(response.splitlines()).strip()
-        return response
+
+        # execute the command.
+        if isinstance(command, unicode):
+            command = command.encode(self._textEncoding, 'replace')
+        return self._traceSystem(request, command, "command",
+                                 self._commands.run(command)
+                                 ).addCallbacks(_gotOutput, _failed)
+
+    def _traceSystem(self, request, name, kind, d):
+        """Record the macro or shell command run by a <system> element in
+        the trace of the request, if any, once the Deferred d fires.
+
+        """
+        trace = getattr(request, "aiml_trace", None)
+        if trace is None:
+            return d
+        start = time.time()
+
+        def _done(result):
+            trace.macro(name, kind, time.time() - start,
+                        not isinstance(result, failure.Failure))
+            return result
+        return d.addBoth(_done)
+
+
+def _stripResponse(response):
+    """Strip the whitespace surrounding a response."""
+    return (response.strip() + ' ').strip()
+
+
+def _matchSnapshot(brain, normal, links, input, that, topic):
+    """Normalize input, that and topic with the subber normal, and match
+    them in brain, a snapshot of the brain (threaded matching).
+
+    Inputs found in the srai links are not matched, unless links is None.
+    Returns a tuple ((input, that, topic), path, template, duration), with
+    the normalized input, that and topic, and a duration of None for the
+    inputs linked.
+
+    """
+    key = (normal.sub(input), normal.sub(that), normal.sub(topic))
+    if links is not None:
+        elem = links.get(key[0])
+        if elem is not None:
+            return key, None, elem, None
+    start = time.time()
+    path, elem = brain.matchPath(*key)
+    return key, path, elem, time.time() - start
+
+
+class _Request(object):
+    """A request of the Kernel itself, such as the bootstrap commands."""
+
+    def __init__(self, sessionID):
+        self.session_id = sessionID
+
+
+def _printResponse(response):
+    print response
+    return response
+
+
+def _printFailure(failure):
+    """Print the traceback of failure, and skip its output."""
+    failure.printTraceback()
+    return ""
 
 
 ##################################################
@@ -1488,6 +2842,8 @@ if __name__ == "__main__":
              "test that", ["I just said: The system says hello!"])
     _testTag(k, 'that test #2',
              "test that", ["I have already answered this question"])
+    _testTag(k, 'system in uppercase',
+             "test system uppercase", ["THE SYSTEM SAYS HELLO!"])
     _testTag(k, 'thatstar test #1',
              "test thatstar", ["I say beans"])
     _testTag(k, 'thatstar test #2',
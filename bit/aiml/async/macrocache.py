@@ -0,0 +1,125 @@
+"""This module implements the MacroCache class, which caches the
+IAIMLMacro factories the Kernel looks up for <system> elements.
+
+The command of a <system> element names an IAIMLMacro multi-adapter of
+the kernel and the request.  Instead of querying the component registry
+every time, the factory found for each (name, request specification) is
+kept until the registry changes: any adapter registration or
+unregistration (which bumps the generation of the adapter registry), or a
+different site manager, empties the cache.
+
+"""
+
+import time
+
+from zope.component import getSiteManager
+from zope.interface import providedBy
+
+from bit.aiml.async.interfaces import IAIMLMacro
+
+
+class MacroCache(object):
+    """Cache of the IAIMLMacro factories of a Kernel."""
+
+    def __init__(self, kernel):
+        self._kernel = kernel
+        # (name, request specification) -> factory or None
+        self._factories = {}
+        # command names bound at learn time
+        self._names = set()
+        # request specifications seen so far
+        self._specs = set()
+        self._generation = None
+        self._siteManager = None
+        # statistics
+        self.hits = 0
+        self.lookups = 0
+        self.lookupTime = 0.0
+
+    def query(self, name, request):
+        """Return the IAIMLMacro adapter of the kernel and request called
+        name, or None.
+
+        This is equivalent to queryMultiAdapter([kernel, request],
+        IAIMLMacro, name=name).
+
+        """
+        factory = self.factory(name, providedBy(request))
+        if factory is None:
+            return None
+        return factory(self._kernel, request)
+
+    def factory(self, name, spec):
+        """Return the factory of the IAIMLMacro adapter called name for
+        requests providing spec, or None.
+
+        """
+        siteManager = self._checkRegistry()
+        try:
+            factory = self._factories[(name, spec)]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return factory
+        if spec not in self._specs:
+            # bind the learned command names for this kind of request too
+            self._specs.add(spec)
+            for bound in self._names:
+                self._lookup(siteManager, bound, spec)
+            if (name, spec) in self._factories:
+                return self._factories[(name, spec)]
+        return self._lookup(siteManager, name, spec)
+
+    def bind(self, names):
+        """Resolve the factories of the command names in advance.
+
+        The Kernel calls this with the literal <system> commands of the
+        templates it learns.  The names are resolved for every kind of
+        request seen so far, and for each new kind of request when it is
+        first seen.
+
+        """
+        siteManager = self._checkRegistry()
+        names = set(names) - self._names
+        self._names.update(names)
+        for spec in self._specs:
+            for name in names:
+                if (name, spec) not in self._factories:
+                    self._lookup(siteManager, name, spec)
+
+    def _checkRegistry(self):
+        """Empty the cache if the registry changed, and return the current
+        site manager.
+
+        """
+        siteManager = getSiteManager()
+        # Adapter registries count their changes, like the lookup caches
+        # of zope.interface itself.
+        generation = siteManager.adapters._generation
+        if generation != self._generation \
+                or siteManager is not self._siteManager:
+            self._factories.clear()
+            self._generation = generation
+            self._siteManager = siteManager
+            for spec in self._specs:
+                for name in self._names:
+                    self._lookup(siteManager, name, spec)
+        return siteManager
+
+    def _lookup(self, siteManager, name, spec):
+        start = time.time()
+        factory = siteManager.adapters.lookup(
+            (providedBy(self._kernel), spec), IAIMLMacro, name=name)
+        self.lookupTime += time.time() - start
+        self.lookups += 1
+        self._factories[(name, spec)] = factory
+        return factory
+
+    def stats(self):
+        """Return the cache's statistics as a dictionary."""
+        return {"hits": self.hits,
+                "lookups": self.lookups,
+                "lookupTime": self.lookupTime,
+                "bound": len(self._names),
+                "size": len(self._factories)}
@@ -0,0 +1,256 @@
+"""This module implements the MacroRunner class, which runs the
+IAIMLMacro adapters of <system> elements under a deadline.
+
+The Deferred returned by a macro's parse() method may never fire, and the
+Kernel waits for it before answering.  A deadline can be set for each
+macro name (or for all macros): when it expires, the macro's Deferred is
+cancelled and a fallback string is used as the macro's result.  The
+macro's complete() method is called in every case.
+
+Macros may also declare themselves idempotent, with a time to live (see
+AIMLMacro).  Concurrent invocations of an idempotent macro with the same
+name and arguments, in the same session, are then merged into one, and
+its results are kept in a bounded cache until their time to live
+expires.  Shared macros, whose results do not depend on the session,
+are merged and cached across sessions.
+
+Macros which block (on files, sockets or computations) can declare it,
+and name the group they belong to: they are then called in the bounded
+thread pool of their group instead of the reactor thread, once their
+prepare() method has read what they need from the Kernel in the reactor
+thread.
+
+"""
+
+import collections
+import time
+
+from twisted.internet import defer
+from twisted.python import failure
+
+from pools import WorkerPool
+from stats import Histogram
+
+
+class _MacroStats(object):
+    """The statistics of one macro name."""
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.timeouts = 0
+        self.failures = 0
+
+    def snapshot(self):
+        return {"timeouts": self.timeouts,
+                "failures": self.failures,
+                "latency": self.latency.snapshot()}
+
+
+class MacroRunner(object):
+    """Run IAIMLMacro adapters, within per-name deadlines."""
+
+    defaultPoolSize = 4
+
+    def __init__(self, reactor=None, maxCacheSize=1024):
+        self._reactor = reactor
+        # macro name (None for the default) -> (seconds, fallback)
+        self._deadlines = {}
+        # macro name -> _MacroStats
+        self._stats = {}
+        # (macro name, session id, arguments) -> Deferreds waiting for the
+        # running invocation of an idempotent macro
+        self._flights = {}
+        # (macro name, session id, arguments) -> (expiry time, result),
+        # least recently used first
+        self._results = collections.OrderedDict()
+        self.maxCacheSize = maxCacheSize
+        # statistics of the idempotent macros
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        # macro group -> WorkerPool
+        self._pools = {}
+
+    def setCacheSize(self, size):
+        """Keep at most size results of idempotent macros."""
+        self.maxCacheSize = size
+        self._evict()
+
+    def setPoolSize(self, group, size):
+        """Run at most size blocking macros of group at once."""
+        try:
+            self._pools[group].resize(size)
+        except KeyError:
+            self._pools[group] = WorkerPool(group, size, self._reactor)
+
+    def _pool(self, group):
+        try:
+            return self._pools[group]
+        except KeyError:
+            pool = self._pools[group] = WorkerPool(
+                group, self.defaultPoolSize, self._reactor)
+            return pool
+
+    def setTimeout(self, name, seconds, fallback=""):
+        """Cancel the macro called name if it runs for longer than
+        seconds, and use fallback as its result instead.
+
+        If name is None, the deadline applies to all the macros which
+        have none of their own.  If seconds is None, the deadline is
+        removed.
+
+        """
+        if seconds is None:
+            self._deadlines.pop(name, None)
+        else:
+            self._deadlines[name] = (seconds, fallback)
+
+    def run(self, name, macro, elem):
+        """Call macro.parse(elem), then macro.complete().
+
+        Returns a Deferred which fires with the macro's result, or with
+        the fallback of its deadline if it expired first.
+
+        If the macro is idempotent, a cached result is used if there is
+        one (parse() and complete() are not called then), and an
+        invocation with the same name and arguments as one still running
+        waits for the latter's result.  Unless the macro is shared, only
+        the results of the same session are used.
+
+        """
+        if not getattr(macro, "idempotent", False):
+            return self._run(name, macro, elem)[0]
+
+        session = None
+        if not getattr(macro, "shared", False):
+            request = getattr(macro, "request", None)
+            session = getattr(request, "session_id", None)
+        key = (name, session, macro.arguments(elem))
+        try:
+            expiry, result = self._results[key]
+        except KeyError:
+            pass
+        else:
+            if expiry > time.time():
+                self.cacheHits += 1
+                # move the result to the end: it was used most recently
+                del self._results[key]
+                self._results[key] = (expiry, result)
+                return defer.succeed(result)
+            del self._results[key]
+        try:
+            waiting = self._flights[key]
+        except KeyError:
+            pass
+        else:
+            self.coalesced += 1
+            d = defer.Deferred()
+            waiting.append(d)
+            return d
+
+        self.cacheMisses += 1
+        waiting = self._flights[key] = []
+        d, expired = self._run(name, macro, elem)
+
+        def _landed(result):
+            del self._flights[key]
+            if not expired and not isinstance(result, failure.Failure):
+                self._results[key] = (time.time() + macro.ttl, result)
+                self._evict()
+            for waiter in waiting:
+                if isinstance(result, failure.Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(result)
+            return result
+        return d.addBoth(_landed)
+
+    def _evict(self):
+        while len(self._results) > self.maxCacheSize:
+            self._results.popitem(last=False)
+            self.evictions += 1
+
+    def _run(self, name, macro, elem):
+        """Call the macro under its deadline.
+
+        Returns a Deferred firing with the macro's result, and a list
+        which is not empty if the deadline expired.
+
+        """
+        try:
+            stats = self._stats[name]
+        except KeyError:
+            stats = self._stats[name] = _MacroStats()
+        try:
+            seconds, fallback = self._deadlines[name]
+        except KeyError:
+            seconds, fallback = self._deadlines.get(None, (None, ""))
+
+        start = time.time()
+        if getattr(macro, "blocking", False):
+            # the Kernel must be read in the reactor thread
+            prepare = getattr(macro, "prepare", None)
+            if prepare is not None:
+                prepare()
+            d = self._pool(macro.pool).run(macro.parse, elem)
+        else:
+            d = defer.maybeDeferred(macro.parse, elem)
+        timer = None
+        expired = []
+        if seconds is not None and not d.called:
+            reactor = self._reactor
+            if reactor is None:
+                from twisted.internet import reactor
+
+            def _expire():
+                expired.append(True)
+                d.cancel()
+            timer = reactor.callLater(seconds, _expire)
+
+        def _done(result):
+            if timer is not None and timer.active():
+                timer.cancel()
+            stats.latency.add(time.time() - start)
+            if expired and isinstance(result, failure.Failure) \
+                    and result.check(defer.CancelledError):
+                stats.timeouts += 1
+                result = fallback
+            elif isinstance(result, failure.Failure):
+                stats.failures += 1
+            macro.complete()
+            return result
+        return d.addBoth(_done), expired
+
+    def stats(self):
+        """Return the statistics of each macro name as a dictionary: its
+        latency, and the number of times it timed out or failed.
+
+        """
+        return dict((name, stats.snapshot())
+                    for name, stats in self._stats.items())
+
+    def poolStats(self):
+        """Return the statistics of the thread pool of each macro group as
+        a dictionary.
+
+        """
+        return dict((group, pool.stats())
+                    for group, pool in self._pools.items())
+
+    def cacheStats(self):
+        """Return the statistics of the results of idempotent macros as a
+        dictionary.
+
+        """
+        lookups = self.cacheHits + self.cacheMisses + self.coalesced
+        hitRate = 0.0
+        if lookups:
+            hitRate = float(self.cacheHits + self.coalesced) / lookups
+        return {"hits": self.cacheHits,
+                "misses": self.cacheMisses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "hitRate": hitRate,
+                "size": len(self._results),
+                "maxSize": self.maxCacheSize}
@@ -8,13 +8,40 @@ from bit.aiml.async.interfaces import IAIMLMacro
 class AIMLMacro(object):
     implements(IAIMLMacro)
 
+    # An idempotent macro's result only depends on its name, arguments()
+    # and session: the kernel merges concurrent invocations, and keeps
+    # their results for ttl seconds.  Those of a shared macro do not
+    # depend on the session, and are used by every session.
+    idempotent = False
+    ttl = 0
+    shared = False
+    # A blocking macro's parse() is called in the thread pool of its
+    # group, rather than in the reactor thread, after prepare() is called
+    # in the reactor thread.
+    blocking = False
+    pool = "default"
+
     def __init__(self, kernel, request):
         self.kernel = kernel
         self.request = request
+        self._star = None
 
     @property
     def star(self):
-        return  self.kernel._processElement(['star',{}], self.request)            
+        if self._star is None:
+            self._star = self.kernel._processElement(['star', {}],
+                                                     self.request)
+        return self._star
+
+    def prepare(self):
+        """Read the Kernel state parse() needs, in the reactor thread,
+        before a blocking macro's parse() is called in its thread pool,
+        where the Kernel must not be used.
+
+        By default, the star is resolved.
+
+        """
+        self.star
 
     def _asker(self,jid):
         # this is very bad! - we should check against my bot's jid domain!                                                                            
@@ -42,6 +69,16 @@ class AIMLMacro(object):
             proto.speak(jid, resp)
 
 
+    def arguments(self, elem):
+        """Return the arguments of an invocation, as a hashable value.
+
+        By default these are the attributes of the <system> element;
+        idempotent macros which depend on anything else (such as the
+        star) must extend them.
+
+        """
+        return tuple(sorted(elem[1].items()))
+
     def complete(self):
         pass
 
@@ -0,0 +1,62 @@
+"""This module implements the SraiMemo class, the per-request memo table
+of <srai> results used by the Kernel.
+
+Within a single call to respond(), templates often reach the same <srai>
+input more than once (through <condition> branches and nested reductions
+for instance).  A result is only stored if nothing with side effects or
+with an unrepeatable result was evaluated while computing it, and the
+whole table is discarded as soon as anything with side effects (such as a
+<set> element) is evaluated, since stored results may depend on the state
+it changed.
+
+"""
+
+
+class SraiMemo(object):
+    """Memo table of the <srai> results of one request."""
+
+    def __init__(self):
+        self.table = {}
+        self.hits = 0
+        self.misses = 0
+        # number of elements with side effects evaluated so far
+        self.writes = 0
+        # number of elements with unrepeatable results evaluated so far
+        self.volatiles = 0
+
+    def get(self, key):
+        """Return the stored result for key, or None."""
+        try:
+            result = self.table[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def mark(self):
+        """Return a token which changes whenever something is evaluated
+        that prevents a result from being stored.
+
+        """
+        return (self.writes, self.volatiles)
+
+    def store(self, key, result, mark):
+        """Store result under key, unless the mark has changed since the
+        evaluation which computed it started.
+
+        """
+        if mark == self.mark():
+            self.table[key] = result
+
+    def write(self):
+        """Record the evaluation of an element with side effects."""
+        self.writes += 1
+        self.table.clear()
+
+    def volatile(self):
+        """Record the evaluation of an element with an unrepeatable
+        result.
+
+        """
+        self.volatiles += 1
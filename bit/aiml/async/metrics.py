@@ -0,0 +1,219 @@
+"""This module implements KernelMetrics, a twisted.web resource which
+serves the statistics of a Kernel in the Prometheus text format, and the
+ReactorLagProbe it uses to measure how late the reactor runs timed
+calls.
+
+Mount it next to the bot's other resources, for instance:
+
+    root.putChild("metrics", KernelMetrics(kernel))
+
+"""
+
+from twisted.internet import task
+from twisted.web import resource
+
+from stats import Histogram
+
+
+class ReactorLagProbe(object):
+    """Measure how late the reactor runs a call scheduled every interval
+    seconds.
+
+    """
+
+    def __init__(self, interval=0.5, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.interval = interval
+        self.lag = Histogram()
+        self.last = 0.0
+        self._expected = None
+        self._reactor = reactor
+        self._call = task.LoopingCall(self._tick)
+        self._call.clock = reactor
+        self._trigger = None
+
+    def start(self):
+        """Start probing, until stop() is called or the reactor shuts
+        down.
+
+        """
+        if self._call.running:
+            return
+        self._expected = None
+        self._call.start(self.interval, now=True)
+        self._trigger = self._reactor.addSystemEventTrigger(
+            "before", "shutdown", self.stop)
+
+    def stop(self):
+        """Stop probing."""
+        if self._call.running:
+            self._call.stop()
+        if self._trigger is not None:
+            try:
+                self._reactor.removeSystemEventTrigger(self._trigger)
+            except ValueError:
+                # stopped by the trigger itself
+                pass
+            self._trigger = None
+
+    def _tick(self):
+        now = self._call.clock.seconds()
+        if self._expected is not None:
+            self.last = max(0.0, now - self._expected)
+            self.lag.add(self.last)
+        self._expected = now + self.interval
+
+
+class _Exposition(object):
+    """Lines of the Prometheus text format."""
+
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, kind, help):
+        self.lines.append("# HELP %s %s" % (name, help))
+        self.lines.append("# TYPE %s %s" % (name, kind))
+
+    def sample(self, name, value, labels=None):
+        if labels:
+            name += "{%s}" % ",".join(
+                ['%s="%s"' % (label, _escape(text))
+                 for label, text in sorted(labels.items())])
+        self.lines.append("%s %s" % (name, _number(value)))
+
+    def histogram(self, name, snapshot, labels=None):
+        labels = labels or {}
+        for bound, count in snapshot["buckets"]:
+            le = dict(labels)
+            le["le"] = _number(bound)
+            self.sample(name + "_bucket", count, le)
+        self.sample(name + "_sum", snapshot["sum"], labels)
+        self.sample(name + "_count", snapshot["count"], labels)
+
+    def text(self):
+        return "\n".join(self.lines) + "\n"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+class KernelMetrics(resource.Resource):
+    """Serve the statistics of kernel in the Prometheus text format.
+
+    The reactor lag probe runs until stop() is called or the reactor
+    shuts down.
+
+    """
+
+    isLeaf = True
+
+    def __init__(self, kernel, lagInterval=0.5, reactor=None):
+        resource.Resource.__init__(self)
+        self.kernel = kernel
+        self.probe = ReactorLagProbe(lagInterval, reactor)
+        self.probe.start()
+
+    def stop(self):
+        """Stop the reactor lag probe."""
+        self.probe.stop()
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/plain; version=0.0.4")
+        return self.exposition()
+
+    def exposition(self):
+        """Return the metrics as a string."""
+        stats = self.kernel.stats()
+        out = _Exposition()
+
+        responses = stats["responses"]
+        out.metric("aiml_responses_total", "counter",
+                   "Responses returned by respond().")
+        out.sample("aiml_responses_total", responses["latency"]["count"])
+        out.metric("aiml_response_failures_total", "counter",
+                   "Calls to respond() which failed.")
+        out.sample("aiml_response_failures_total", responses["failures"])
+        out.metric("aiml_response_seconds", "histogram",
+                   "Latency of respond().")
+        out.histogram("aiml_response_seconds", responses["latency"])
+
+        out.metric("aiml_matches_total", "counter",
+                   "Matches, by how they were answered.")
+        for source, count in sorted(stats["matches"].items()):
+            out.sample("aiml_matches_total", count, {"source": source})
+        out.metric("aiml_srai_memo_total", "counter",
+                   "Lookups in the srai memo, by result.")
+        out.sample("aiml_srai_memo_total", stats["memo"]["hits"],
+                   {"result": "hit"})
+        out.sample("aiml_srai_memo_total", stats["memo"]["misses"],
+                   {"result": "miss"})
+        macros = stats["macros"]
+        out.metric("aiml_macro_factory_lookups_total", "counter",
+                   "IAIMLMacro factory lookups, by result.")
+        out.sample("aiml_macro_factory_lookups_total", macros["hits"],
+                   {"result": "hit"})
+        out.sample("aiml_macro_factory_lookups_total", macros["lookups"],
+                   {"result": "miss"})
+        results = macros["results"]
+        out.metric("aiml_macro_results_total", "counter",
+                   "Invocations of idempotent macros, by result.")
+        for result in ("hits", "misses", "coalesced"):
+            out.sample("aiml_macro_results_total", results[result],
+                       {"result": result})
+
+        out.metric("aiml_sessions", "gauge", "Sessions.")
+        out.sample("aiml_sessions", stats["sessions"])
+        out.metric("aiml_brain_categories", "gauge",
+                   "Categories in the brain.")
+        out.sample("aiml_brain_categories", stats["brain"]["categories"])
+        out.metric("aiml_brain_generation", "gauge",
+                   "Generation of the brain, bumped whenever its contents "
+                   "change.")
+        out.sample("aiml_brain_generation", stats["brain"]["generation"])
+
+        out.metric("aiml_macro_seconds", "histogram",
+                   "Latency of IAIMLMacro adapters.")
+        for name, macro in sorted(macros["macros"].items()):
+            out.histogram("aiml_macro_seconds", macro["latency"],
+                          {"macro": name})
+        out.metric("aiml_macro_timeouts_total", "counter",
+                   "IAIMLMacro adapters cancelled by their deadline.")
+        for name, macro in sorted(macros["macros"].items()):
+            out.sample("aiml_macro_timeouts_total", macro["timeouts"],
+                       {"macro": name})
+        out.metric("aiml_macro_pool_queued", "gauge",
+                   "Blocking macros waiting for a thread.")
+        for group, pool in sorted(macros["pools"].items()):
+            out.sample("aiml_macro_pool_queued", pool["queued"],
+                       {"pool": group})
+        out.metric("aiml_system_seconds", "histogram",
+                   "Latency of shell commands.")
+        out.histogram("aiml_system_seconds", stats["system"]["latency"])
+
+        events = stats["events"]
+        out.metric("aiml_events_total", "counter",
+                   "Events, by outcome.")
+        for outcome in ("sent", "delivered", "dropped"):
+            out.sample("aiml_events_total", events[outcome],
+                       {"outcome": outcome})
+
+        out.metric("aiml_phase_seconds", "histogram",
+                   "Latency of the instrumented phases of responses.")
+        for phase, timing in sorted(stats["phases"].items()):
+            out.histogram("aiml_phase_seconds", timing, {"phase": phase})
+
+        out.metric("aiml_reactor_lag_seconds", "histogram",
+                   "Delay of the reactor in running timed calls.")
+        out.histogram("aiml_reactor_lag_seconds", self.probe.lag.snapshot())
+        return out.text()
@@ -7,6 +7,8 @@ import xml.sax.handler
 
 from twisted.python import log
 
+from elements import freeze
+
 
 class AimlParserError(Exception):
     pass
@@ -409,11 +411,11 @@ class AimlHandler(ContentHandler):
                     "Unexpected </category> tag " + self._location())
             self._state = self._STATE_InsideAiml
             # End the current category.
-            # Store the current pattern/that/topic and
+            # Store the current pattern/that/topic and the frozen
             # element in the categories dictionary.
             key = (self._currentPattern.strip(),
                    self._currentThat.strip(), self._currentTopic.strip())
-            self.categories[key] = self._elemStack[-1]
+            self.categories[key] = freeze(self._elemStack[-1])
             #print self.categories[key]
             self._whitespaceBehaviorStack.pop()
         elif name == "pattern" and (not self._insideLearn):
@@ -2,6 +2,7 @@
 # by Dr. Richard Wallace at the following site:
 # http://www.alicebot.org/documentation/matching.html
 
+import marshal
 import pickle
 import pprint
 import re
@@ -17,14 +18,32 @@ class PatternMgr:
     _TOPIC = 4
     _BOT_NAME = 5
 
+    # returned by _matchStatic() when the match depends on 'that' or 'topic'
+    _AMBIGUOUS = object()
+    # number of nodes iterMatch() visits between two pauses
+    _pauseEvery = 256
+
     def __init__(self):
         self._root = {}
         self._templateCount = 0
         self._botName = u"Nameless"
+        # the ids of the nodes shared since minimize(), which add() must
+        # copy before changing them
+        self._shared = set()
+        # the ids of the nodes created since the last snapshot(), which
+        # add() may change in place; None if no snapshot shares the nodes
+        self._owned = None
         punctuation = "\"`~!@#$%^&*()-_=+[{]}\|;:',<.>/?"
         self._puncStripRE = re.compile("[" + re.escape(punctuation) + "]")
         self._whitespaceRE = re.compile("\s", re.LOCALE | re.UNICODE)
 
+    def _tree(self):
+        """Return the root of the tree of nodes which patterns are
+        matched against.
+
+        """
+        return self._root
+
     def numTemplates(self):
         """Return the number of templates currently stored."""
         return self._templateCount
@@ -62,10 +81,65 @@ class PatternMgr:
             self._botName = pickle.load(inFile)
             self._root = pickle.load(inFile)
             inFile.close()
+            self._owned = None
+            # pickle keeps the nodes shared by minimize()
+            self._markShared()
         except Exception, e:
             print "Error restoring PatternMgr from file %s:" % filename
             raise Exception(e)
 
+    def dumps(self, encode=None):
+        """Return the patterns as a string in the marshal format, which
+        loads() reads back much faster than restore() unpickles.
+
+        Each template is written once, however many categories share it.
+        encode, if given, is called to turn each template into something
+        marshal can write; the decode argument of loads() turns it back.
+
+        """
+        templates = []
+        root = self._encodeNode(self._root, templates, {}, encode)
+        return marshal.dumps((self._templateCount, self._botName, root,
+                              templates), 2)
+
+    def _encodeNode(self, node, templates, indexes, encode):
+        # indexes maps the ids of the templates to their index in
+        # templates
+        copy = {}
+        for key, value in node.iteritems():
+            if key == self._TEMPLATE:
+                index = indexes.get(id(value))
+                if index is None:
+                    index = indexes[id(value)] = len(templates)
+                    if encode is not None:
+                        value = encode(value)
+                    templates.append(value)
+                copy[key] = index
+            else:
+                copy[key] = self._encodeNode(value, templates, indexes,
+                                             encode)
+        return copy
+
+    def loads(self, data, decode=None):
+        """Replace the patterns with those of a string returned by
+        dumps().
+
+        """
+        self._templateCount, self._botName, self._root, templates = \
+            marshal.loads(data)
+        if decode is not None:
+            templates = [decode(template) for template in templates]
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            for key, value in node.iteritems():
+                if key == self._TEMPLATE:
+                    node[key] = templates[value]
+                else:
+                    stack.append(value)
+        self._shared = set()
+        self._owned = None
+
     def add(self, (pattern, that, topic), template):
         """Add a [pattern/that/topic] tuple and its corresponding template
         to the node tree.
@@ -80,45 +154,142 @@ class PatternMgr:
                 key = self._STAR
             elif key == u"BOT_NAME":
                 key = self._BOT_NAME
-            if not key in node:
-                node[key] = {}
-            node = node[key]
+            node = self._child(node, key)
 
         # navigate further down, if a non-empty "that" pattern was included
         if len(that) > 0:
-            if not self._THAT in node:
-                node[self._THAT] = {}
-            node = node[self._THAT]
+            node = self._child(node, self._THAT)
             for word in string.split(that):
                 key = word
                 if key == u"_":
                     key = self._UNDERSCORE
                 elif key == u"*":
                     key = self._STAR
-                if not key in node:
-                    node[key] = {}
-                node = node[key]
+                node = self._child(node, key)
 
         # navigate yet further down, if a non-empty "topic" string was included
         if len(topic) > 0:
-            if not self._TOPIC in node:
-                node[self._TOPIC] = {}
-            node = node[self._TOPIC]
+            node = self._child(node, self._TOPIC)
             for word in string.split(topic):
                 key = word
                 if key == u"_":
                     key = self._UNDERSCORE
                 elif key == u"*":
                     key = self._STAR
-                if not key in node:
-                    node[key] = {}
-                node = node[key]
+                node = self._child(node, key)
 
         # add the template.
         if not self._TEMPLATE in node:
             self._templateCount += 1
         node[self._TEMPLATE] = template
 
+    def _child(self, node, key):
+        """Return the child key of node for add(), creating it if needed,
+        and copying it first if it is shared.
+
+        """
+        child = node.get(key)
+        if child is None:
+            child = node[key] = {}
+        elif (self._shared and id(child) in self._shared) \
+                or (self._owned is not None and id(child) not in self._owned):
+            child = node[key] = dict(child)
+        else:
+            return child
+        if self._owned is not None:
+            self._owned.add(id(child))
+        return child
+
+    def minimize(self):
+        """Merge the identical subtrees of the tree of nodes (such as the
+        'that' and 'topic' parts repeated under many patterns) into
+        shared nodes, and the identical templates into shared templates.
+        Matching is unchanged.
+
+        Returns the tuple (before, after) of the numbers of nodes.  The
+        nodes stay shared through save() and restore(), but not through
+        dumps() and loads(), which only keep the templates shared.
+
+        """
+        before = self._markShared()
+        canonical = {}
+        templates = {}
+        done = {}
+        for key, child in self._root.items():
+            if key != self._TEMPLATE:
+                self._root[key] = self._minimize(child, canonical,
+                                                 templates, done)
+        # the canonical nodes are all new: no snapshot shares them
+        self._owned = None
+        return (before, self._markShared())
+
+    def _minimize(self, node, canonical, templates, done):
+        """Return the canonical node identical to node, after replacing
+        its children by their canonical nodes.
+
+        canonical maps the signatures of the nodes to their canonical
+        node, templates the templates (or the marshal strings of those
+        made of lists) to their canonical template, and done the ids of
+        the nodes already minimized to their canonical node.
+
+        """
+        if id(node) in done:
+            return done[id(node)]
+        items = []
+        for key, child in node.iteritems():
+            if key == self._TEMPLATE:
+                try:
+                    child = templates.setdefault(child, child)
+                except TypeError:
+                    try:
+                        child = templates.setdefault(marshal.dumps(child),
+                                                     child)
+                    except ValueError:
+                        # cannot tell whether it is identical to another
+                        pass
+            else:
+                child = self._minimize(child, canonical, templates, done)
+            items.append((key, child))
+        signature = frozenset([(key, id(child)) for key, child in items])
+        result = canonical.get(signature)
+        if result is None:
+            result = canonical[signature] = dict(items)
+        done[id(node)] = result
+        return result
+
+    def _markShared(self):
+        """Find the nodes which add() must copy before changing them:
+        those with several parents, and the nodes below them.
+
+        Returns the number of nodes.
+
+        """
+        parents = {}
+        nodes = {}
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            for key, child in node.iteritems():
+                if key == self._TEMPLATE:
+                    continue
+                count = parents.get(id(child), 0)
+                parents[id(child)] = count + 1
+                if count == 0:
+                    nodes[id(child)] = child
+                    stack.append(child)
+        shared = set()
+        stack = [nodes[key] for key, count in parents.iteritems()
+                 if count > 1]
+        while stack:
+            node = stack.pop()
+            if id(node) in shared:
+                continue
+            shared.add(id(node))
+            stack.extend([child for key, child in node.iteritems()
+                          if key != self._TEMPLATE])
+        self._shared = shared
+        return len(nodes) + 1
+
     def match(self, pattern, that, topic):
         """Return the template which is the closest match to pattern. The
         'that' parameter contains the bot's previous response. The 'topic'
@@ -126,9 +297,111 @@ class PatternMgr:
 
         Returns None if no template is found.
 
+        """
+        return self.matchPath(pattern, that, topic)[1]
+
+    def matchPath(self, pattern, that, topic):
+        """Like match(), but return a tuple (path, template), where path
+        is the list of the keys leading from the root to the template:
+        words, and the special keys for wildcards and the 'that' and
+        'topic' parts.
+
+        Returns (None, None) if no template is found.
+
         """
         if len(pattern) == 0:
+            return (None, None)
+        words, thatWords, topicWords = self._matchWords(pattern, that, topic)
+        # Pass the input off to the recursive call
+        return self._match(words, thatWords, topicWords, self._tree())
+
+    def firstWord(self, pattern):
+        """Return the first word of pattern as it is matched, or None if
+        pattern is empty.
+
+        """
+        words = self._matchWords(pattern, u"", u"")[0]
+        if len(words) == 0:
             return None
+        return words[0]
+
+    def matchBranch(self, pattern, that, topic, key):
+        """Like matchPath(), but only try the patterns starting with key:
+        a word, or one of the special keys _UNDERSCORE, _STAR and
+        _BOT_NAME.
+
+        """
+        root = self._tree()
+        if len(pattern) == 0 or key not in root:
+            return (None, None)
+        words, thatWords, topicWords = self._matchWords(pattern, that, topic)
+        return self._match(words, thatWords, topicWords, {key: root[key]})
+
+    def branches(self):
+        """Return the keys of the first words of the stored patterns."""
+        return self._tree().keys()
+
+    def subset(self, keys):
+        """Return a PatternMgr holding the patterns starting with one of
+        keys.  The nodes are shared with this PatternMgr, except those
+        where the patterns of an OverlayPatternMgr and of its base meet,
+        which are merged.
+
+        """
+        subset = PatternMgr()
+        subset._botName = self._botName
+        tree = self._tree()
+        for key in keys:
+            if key in tree:
+                node = subset._root[key] = self._merged(tree[key])
+                subset._templateCount += self._countTemplates(node)
+        return subset
+
+    def _merged(self, node):
+        """Return node, or a copy merging its layers if it is a node of
+        an OverlayPatternMgr over a node of its base.
+
+        """
+        if not isinstance(node, _LayeredNode):
+            return node
+        merged = {}
+        for key in node.keys():
+            if key == self._TEMPLATE:
+                merged[key] = node[key]
+            else:
+                merged[key] = self._merged(node[key])
+        return merged
+
+    def _countTemplates(self, node):
+        count = 0
+        for key, value in node.iteritems():
+            if key == self._TEMPLATE:
+                count += 1
+            else:
+                count += self._countTemplates(value)
+        return count
+
+    def iterMatch(self, pattern, that, topic):
+        """Generator version of matchPath().
+
+        The generator yields None after every _pauseEvery nodes it
+        visits, so that a caller can pause a long match, and finally the
+        (path, template) tuple matchPath() would return.
+
+        """
+        if len(pattern) == 0:
+            yield (None, None)
+            return
+        words, thatWords, topicWords = self._matchWords(pattern, that, topic)
+        for item in self._iterMatch(words, thatWords, topicWords,
+                                    self._tree(), [0]):
+            yield item
+
+    def _matchWords(self, pattern, that, topic):
+        """Return the lists of the words of pattern, that and topic, as
+        they are matched.
+
+        """
         # Mutilate the input.  Remove all punctuation and convert the
         # text to all caps.
         input = string.upper(pattern)
@@ -144,10 +417,7 @@ class PatternMgr:
             topic = u"ULTRABOGUSDUMMYTOPIC"
         topicInput = string.upper(topic)
         topicInput = re.sub(self._puncStripRE, "", topicInput)
-        # Pass the input off to the recursive call
-        patMatch, template = self._match(
-            input.split(), thatInput.split(), topicInput.split(), self._root)
-        return template
+        return input.split(), thatInput.split(), topicInput.split()
 
     def star(self, starType, pattern, that, topic, index):
         """Returns a string, the portion of pattern that was matched by a *.
@@ -159,41 +429,36 @@ class PatternMgr:
         - 'topicstar': matches a star in the topic pattern.
 
         """
-        # Mutilate the input.  Remove all punctuation and convert the
-        # text to all caps.
-        input = string.upper(pattern)
-        input = re.sub(self._puncStripRE, "", input)
-        # 'that' must never be empty
-        if that.strip() == u"":
-            that = u"ULTRABOGUSDUMMYTHAT"
-        thatInput = string.upper(that)
-        thatInput = re.sub(self._whitespaceRE, " ", thatInput)
-        thatInput = re.sub(self._puncStripRE, "", thatInput)
-        # 'topic' must never be empty
-        if topic.strip() == u"":
-            topic = u"ULTRABOGUSDUMMYTOPIC"
-        topicInput = string.upper(topic)
-        topicInput = re.sub(self._puncStripRE, "", topicInput)
-
         # Pass the input off to the recursive pattern-matcher
+        words, thatWords, topicWords = self._matchWords(pattern, that, topic)
         patMatch, template = self._match(
-            input.split(), thatInput.split(), topicInput.split(), self._root)
+            words, thatWords, topicWords, self._tree())
         if template == None:
             return ""
+        return self.starFromPath(starType, patMatch, pattern, that, topic,
+                                 index)
+
+    def starFromPath(self, starType, patMatch, pattern, that, topic, index):
+        """Like star(), but using patMatch, the path matchPath() returned
+        for pattern, that and topic, instead of matching again.
+
+        """
+        inputWords, thatWords, topicWords = self._matchWords(
+            pattern, that, topic)
 
         # Extract the appropriate portion of the pattern, based on the
         # starType argument.
         words = None
         if starType == 'star':
             patMatch = patMatch[:patMatch.index(self._THAT)]
-            words = input.split()
+            words = inputWords
         elif starType == 'thatstar':
             patMatch = patMatch[patMatch.index(self._THAT)
                                 + 1: patMatch.index(self._TOPIC)]
-            words = thatInput.split()
+            words = thatWords
         elif starType == 'topicstar':
             patMatch = patMatch[patMatch.index(self._TOPIC) + 1:]
-            words = topicInput.split()
+            words = topicWords
         else:
             # unknown value
             raise ValueError(
@@ -253,6 +518,196 @@ class PatternMgr:
         else:
             return ""
 
+    def pathString(self, path):
+        """Return the match path returned by matchPath() as a string, in
+        the form "PATTERN <that> THAT <topic> TOPIC".
+
+        """
+        names = {self._UNDERSCORE: u"_", self._STAR: u"*",
+                 self._BOT_NAME: u"<bot name>", self._THAT: u"<that>",
+                 self._TOPIC: u"<topic>"}
+        return u" ".join([names.get(key, key) for key in path or []])
+
+    def snapshot(self):
+        """Return a copy of the PatternMgr which later calls to add()
+        leave unchanged.
+
+        The nodes are copied on write: the copy and this PatternMgr share
+        them, and add() copies those it changes, on either side.  Only
+        the root is copied, so that taking a snapshot is cheap.
+
+        """
+        copy = PatternMgr()
+        copy._templateCount = self._templateCount
+        copy._botName = self._botName
+        self._shareRoot(copy)
+        return copy
+
+    def _shareRoot(self, copy):
+        """Share the nodes with copy, for snapshot()."""
+        copy._root = self._root
+        copy._shared = self._shared
+        copy._owned = set()
+        self._root = dict(self._root)
+        self._owned = set()
+
+    def categories(self):
+        """Iterate over the stored categories, yielding a
+        ((pattern, that, topic), template) tuple for each one.
+
+        """
+        return self._categories(self._tree())
+
+    def _categories(self, root):
+        names = {self._UNDERSCORE: u"_",
+                 self._STAR: u"*",
+                 self._BOT_NAME: u"BOT_NAME"}
+        stack = [(root, 0, ((), (), ()))]
+        while stack:
+            node, section, words = stack.pop()
+            for key, child in node.items():
+                if key == self._TEMPLATE:
+                    yield (tuple([string.join(w) for w in words]), child)
+                elif key == self._THAT:
+                    stack.append((child, 1, words))
+                elif key == self._TOPIC:
+                    stack.append((child, 2, words))
+                else:
+                    path = list(words)
+                    path[section] = words[section] + (names.get(key, key),)
+                    stack.append((child, section, tuple(path)))
+
+    def template(self, (pattern, that, topic)):
+        """Return the template of the category with the key (pattern,
+        that, topic), as yielded by categories(), or None.
+
+        """
+        keys = {u"_": self._UNDERSCORE, u"*": self._STAR}
+        node = self._tree()
+        try:
+            for word in string.split(pattern):
+                if word == u"BOT_NAME":
+                    word = self._BOT_NAME
+                node = node[keys.get(word, word)]
+            if len(that) > 0:
+                node = node[self._THAT]
+                for word in string.split(that):
+                    node = node[keys.get(word, word)]
+            if len(topic) > 0:
+                node = node[self._TOPIC]
+                for word in string.split(topic):
+                    node = node[keys.get(word, word)]
+            return node[self._TEMPLATE]
+        except KeyError:
+            return None
+
+    def categoryKey(self, path):
+        """Return the key, as yielded by categories(), of the category
+        whose template matchPath() returned with path, or None.
+
+        Several categories may share a template object (see minimize()),
+        so the template alone does not tell which category matched.
+
+        """
+        if path is None:
+            return None
+        return self._categoryKey(path, self._tree(), 0, ([], [], []))
+
+    def _categoryKey(self, path, node, section, words):
+        names = {self._UNDERSCORE: u"_",
+                 self._STAR: u"*",
+                 self._BOT_NAME: u"BOT_NAME"}
+        if len(path) == 0:
+            if self._TEMPLATE not in node:
+                return None
+            return tuple([string.join(w) for w in words])
+        key = path[0]
+        if key == self._THAT or key == self._TOPIC:
+            if key not in node:
+                return None
+            section = {self._THAT: 1, self._TOPIC: 2}[key]
+            return self._categoryKey(path[1:], node[key], section, words)
+        # _match() records the bot name as the word it matched, after
+        # trying the word itself
+        candidates = [key]
+        if key == self._botName:
+            candidates.append(self._BOT_NAME)
+        for candidate in candidates:
+            if candidate not in node:
+                continue
+            nextWords = list(words)
+            nextWords[section] = words[section] + [names.get(candidate,
+                                                         candidate)]
+            found = self._categoryKey(path[1:], node[candidate], section,
+                                      nextWords)
+            if found is not None:
+                return found
+        return None
+
+    def matchStatic(self, pattern):
+        """Return the template which pattern matches whatever the 'that'
+        and 'topic' are.
+
+        Returns None if there is no match, or if the match depends on the
+        bot's previous response or the current topic.
+
+        """
+        if len(pattern) == 0:
+            return None
+        input = string.upper(pattern)
+        input = re.sub(self._puncStripRE, "", input)
+        template = self._matchStatic(input.split(), self._tree())
+        if template is self._AMBIGUOUS:
+            return None
+        return template
+
+    def _matchStatic(self, words, root):
+        """Context-free counterpart of _match().
+
+        Nodes are visited in the same order as _match() visits them.  The
+        first node at which the words run out and which could yield a
+        template decides the result: its template if every 'that' and
+        'topic' lead to the same one, _AMBIGUOUS otherwise.
+
+        """
+        if len(words) == 0:
+            if self._THAT not in root:
+                return root.get(self._TEMPLATE)
+            # only a lone wildcard 'that' and 'topic' match everything
+            node = root[self._THAT]
+            for section in (self._TOPIC, self._TEMPLATE):
+                if len(node) != 1:
+                    return self._AMBIGUOUS
+                wildcard = node.get(self._STAR, node.get(self._UNDERSCORE))
+                if wildcard is None or len(wildcard) != 1 \
+                        or section not in wildcard:
+                    return self._AMBIGUOUS
+                node = wildcard[section]
+            return node
+
+        first = words[0]
+        suffix = words[1:]
+        if self._UNDERSCORE in root:
+            for j in range(len(suffix) + 1):
+                template = self._matchStatic(
+                    suffix[j:], root[self._UNDERSCORE])
+                if template is not None:
+                    return template
+        if first in root:
+            template = self._matchStatic(suffix, root[first])
+            if template is not None:
+                return template
+        if self._BOT_NAME in root and first == self._botName:
+            template = self._matchStatic(suffix, root[self._BOT_NAME])
+            if template is not None:
+                return template
+        if self._STAR in root:
+            for j in range(len(suffix) + 1):
+                template = self._matchStatic(suffix[j:], root[self._STAR])
+                if template is not None:
+                    return template
+        return None
+
     def _match(self, words, thatWords, topicWords, root):
         """Return a tuple (pat, tem) where pat is a list of nodes, starting
         at the root and leading to the matching pattern, and tem is the
@@ -344,3 +799,193 @@ class PatternMgr:
 
         # No matches were found.
         return (None, None)
+
+    def _iterMatch(self, words, thatWords, topicWords, root, visits):
+        """Generator version of _match(), used by iterMatch().
+
+        The nodes are visited in the same order.  visits is a one-item
+        list counting the nodes visited so far.
+
+        """
+        visits[0] += 1
+        if visits[0] % self._pauseEvery == 0:
+            yield None
+
+        if len(words) == 0:
+            pattern = []
+            template = None
+            if len(thatWords) > 0:
+                if self._THAT in root:
+                    for item in self._iterMatch(thatWords, [], topicWords,
+                                                root[self._THAT], visits):
+                        if item is None:
+                            yield None
+                        else:
+                            pattern, template = item
+                    if pattern != None:
+                        pattern = [self._THAT] + pattern
+            elif len(topicWords) > 0:
+                if self._TOPIC in root:
+                    for item in self._iterMatch(topicWords, [], [],
+                                                root[self._TOPIC], visits):
+                        if item is None:
+                            yield None
+                        else:
+                            pattern, template = item
+                    if pattern != None:
+                        pattern = [self._TOPIC] + pattern
+            if template == None:
+                pattern = []
+                template = root.get(self._TEMPLATE)
+            yield (pattern, template)
+            return
+
+        first = words[0]
+        suffix = words[1:]
+
+        # the branches to try, in the order _match() tries them
+        branches = []
+        if self._UNDERSCORE in root:
+            for j in range(len(suffix) + 1):
+                branches.append((suffix[j:], root[self._UNDERSCORE],
+                                 self._UNDERSCORE))
+        if first in root:
+            branches.append((suffix, root[first], first))
+        if self._BOT_NAME in root and first == self._botName:
+            branches.append((suffix, root[self._BOT_NAME], first))
+        if self._STAR in root:
+            for j in range(len(suffix) + 1):
+                branches.append((suffix[j:], root[self._STAR], self._STAR))
+
+        for suf, node, key in branches:
+            template = None
+            for item in self._iterMatch(suf, thatWords, topicWords, node,
+                                        visits):
+                if item is None:
+                    yield None
+                else:
+                    pattern, template = item
+            if template is not None:
+                yield ([key] + pattern, template)
+                return
+
+        # No matches were found.
+        yield (None, None)
+
+
+class _LayeredNode(object):
+    """A read-only view of a node of an OverlayPatternMgr over the node
+    at the same place in its base.  The template of the overlay node, if
+    any, hides that of the base node.
+
+    """
+
+    __slots__ = ("over", "base")
+
+    def __init__(self, over, base):
+        self.over = over
+        self.base = base
+
+    def __contains__(self, key):
+        return key in self.over or key in self.base
+
+    def __getitem__(self, key):
+        over = self.over.get(key)
+        base = self.base.get(key)
+        if over is None:
+            if base is None:
+                raise KeyError(key)
+            return base
+        if base is None or key == PatternMgr._TEMPLATE:
+            return over
+        return _LayeredNode(over, base)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = self.over.keys()
+        over = self.over
+        keys.extend([key for key in self.base if key not in over])
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def iteritems(self):
+        return iter(self.items())
+
+
+class OverlayPatternMgr(PatternMgr):
+    """A PatternMgr adding its own patterns to those of base, a shared
+    PatternMgr which it never changes.
+
+    Patterns are matched against both sets at once, in the usual order,
+    as if they had all been learned by one PatternMgr; a category added
+    to the overlay replaces a category of base with the same pattern,
+    that and topic.  The bot name is that of the overlay, whatever the
+    bot name of base.
+
+    """
+
+    def __init__(self, base):
+        PatternMgr.__init__(self)
+        self.base = base
+        # categories of the overlay hiding one of base
+        self._hidden = 0
+
+    def _tree(self):
+        if not self._root:
+            return self.base._tree()
+        return _LayeredNode(self._root, self.base._tree())
+
+    def numTemplates(self):
+        """Return the number of templates of the overlay and base."""
+        return self.base.numTemplates() + self._templateCount - self._hidden
+
+    def add(self, key, template):
+        count = self._templateCount
+        PatternMgr.add(self, key, template)
+        if self._templateCount != count \
+                and self.base.template(key) is not None:
+            self._hidden += 1
+
+    def loads(self, data, decode=None):
+        """Replace the patterns of the overlay with those of a string
+        returned by dumps(), which only holds the overlay.
+
+        """
+        PatternMgr.loads(self, data, decode)
+        self._countHidden()
+
+    def restore(self, filename):
+        PatternMgr.restore(self, filename)
+        self._countHidden()
+
+    def _countHidden(self):
+        base = self.base
+        self._hidden = 0
+        for key, template in self._categories(self._root):
+            if base.template(key) is not None:
+                self._hidden += 1
+
+    def snapshot(self):
+        """Return a copy of the OverlayPatternMgr which later calls to
+        add() leave unchanged.  base is shared, not copied.
+
+        """
+        copy = OverlayPatternMgr(self.base)
+        copy._templateCount = self._templateCount
+        copy._hidden = self._hidden
+        copy._botName = self._botName
+        self._shareRoot(copy)
+        return copy
@@ -0,0 +1,113 @@
+"""This module implements the WorkerPool class, a bounded thread pool in
+which the Kernel runs blocking IAIMLMacro adapters (and, with threaded
+matching, the matching of inputs).
+
+Each group of blocking macros gets a pool of its own, so that a slow
+integration can only exhaust its own threads, and never stalls the
+reactor or the macros of other groups.  Calls made while every thread
+of a pool is busy wait in the pool's queue.
+
+"""
+
+import threading
+import time
+
+from twisted.internet import threads
+from twisted.python import threadpool
+
+from stats import Histogram
+
+
+class WorkerPool(object):
+    """A named pool of at most size threads."""
+
+    def __init__(self, name, size, reactor=None, prefix="aiml-macros"):
+        self.name = name
+        self.prefix = prefix
+        self.size = size
+        self._reactor = reactor
+        self._pool = None
+        self._lock = threading.Lock()
+        # calls waiting for a thread, and calls running
+        self.queued = 0
+        self.running = 0
+        # statistics
+        self.calls = 0
+        self.saturated = 0
+        self.maxQueued = 0
+        self.wait = Histogram()
+
+    def _start(self):
+        reactor = self._reactor
+        if reactor is None:
+            from twisted.internet import reactor
+        self._pool = threadpool.ThreadPool(0, self.size,
+                                           "%s-%s" % (self.prefix, self.name))
+        self._pool.start()
+        reactor.addSystemEventTrigger("during", "shutdown", self.stop)
+        return reactor
+
+    def resize(self, size):
+        """Allow at most size threads to run at once."""
+        self.size = size
+        if self._pool is not None:
+            self._pool.adjustPoolsize(min(self._pool.min, size), size)
+
+    def stop(self):
+        """Stop the threads of the pool."""
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            pool.stop()
+
+    def run(self, f, *args, **kwargs):
+        """Call f(*args, **kwargs) in one of the pool's threads.
+
+        Returns a Deferred which fires (in the reactor thread) with the
+        result of the call.
+
+        """
+        reactor = self._reactor
+        if self._pool is None:
+            reactor = self._start()
+        elif reactor is None:
+            from twisted.internet import reactor
+
+        submitted = time.time()
+        with self._lock:
+            self.calls += 1
+            if self.running + self.queued >= self.size:
+                self.saturated += 1
+            self.queued += 1
+            self.maxQueued = max(self.maxQueued, self.queued)
+
+        def _call():
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+                self.wait.add(time.time() - submitted)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.running -= 1
+        return threads.deferToThreadPool(reactor, self._pool, _call)
+
+    def stats(self):
+        """Return the statistics of the pool as a dictionary: its size,
+        the calls queued and running, how many calls were made and how
+        many found every thread busy, the deepest the queue got, and the
+        time calls spent waiting for a thread.
+
+        """
+        with self._lock:
+            utilization = 0.0
+            if self.size:
+                utilization = float(self.running) / self.size
+            return {"size": self.size,
+                    "queued": self.queued,
+                    "running": self.running,
+                    "utilization": utilization,
+                    "calls": self.calls,
+                    "saturated": self.saturated,
+                    "maxQueued": self.maxQueued,
+                    "wait": self.wait.snapshot()}
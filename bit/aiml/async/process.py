@@ -0,0 +1,165 @@
+"""This module implements the CommandRunner class, which runs the shell
+commands of <system> elements without blocking the reactor.
+
+Commands are started with reactor.spawnProcess().  The number of commands
+running at once is limited (further commands wait in a queue), each
+command is killed if it runs for longer than a timeout, and only the
+first bytes of its output are kept.
+
+"""
+
+import collections
+import os
+import time
+
+from twisted.internet import defer, error, protocol
+
+from stats import Histogram
+
+
+class CommandTimeout(Exception):
+    """Raised when a command is killed for running too long."""
+    pass
+
+
+class _CommandProtocol(protocol.ProcessProtocol):
+    """Collect the standard output of a command, up to maxOutput bytes."""
+
+    def __init__(self, deferred, maxOutput):
+        self.deferred = deferred
+        self.maxOutput = maxOutput
+        self.output = []
+        self.size = 0
+        self.truncated = False
+        self.timedOut = False
+
+    def connectionMade(self):
+        self.transport.closeStdin()
+
+    def outReceived(self, data):
+        if self.truncated:
+            return
+        room = self.maxOutput - self.size
+        if len(data) > room:
+            # We have all the output we are going to use.
+            data = data[:room]
+            self.truncated = True
+            self.kill()
+        self.output.append(data)
+        self.size += len(data)
+
+    def kill(self):
+        try:
+            self.transport.signalProcess('KILL')
+        except error.ProcessExitedAlready:
+            pass
+        # Children of the shell may still hold the output pipes open.
+        self.transport.loseConnection()
+
+    def timeout(self):
+        self.timedOut = True
+        self.kill()
+
+    def processEnded(self, reason):
+        # Like os.popen(), ignore the exit status of the command.
+        if self.timedOut:
+            self.deferred.errback(CommandTimeout(
+                    "command killed after running too long"))
+        else:
+            self.deferred.callback("".join(self.output))
+
+
+class CommandRunner(object):
+    """Run shell commands asynchronously, within limits."""
+
+    def __init__(self, maxConcurrent=4, timeout=10.0, maxOutput=65536,
+                 reactor=None):
+        self.maxConcurrent = maxConcurrent
+        self.timeout = timeout
+        self.maxOutput = maxOutput
+        self._reactor = reactor
+        self._active = 0
+        self._waiting = collections.deque()
+        # statistics
+        self.latency = Histogram()
+        self.timeouts = 0
+        self.truncations = 0
+        self.failures = 0
+
+    def setLimits(self, maxConcurrent=None, timeout=None, maxOutput=None):
+        """Change the limits applied to the commands started from now on.
+
+        Arguments left as None keep their current value.
+
+        """
+        if maxConcurrent is not None:
+            self.maxConcurrent = maxConcurrent
+        if timeout is not None:
+            self.timeout = timeout
+        if maxOutput is not None:
+            self.maxOutput = maxOutput
+        self._startWaiting()
+
+    def run(self, command):
+        """Run command with the shell.
+
+        Returns a Deferred which fires with the command's standard output,
+        or fails with CommandTimeout if the command had to be killed.
+
+        """
+        d = defer.Deferred()
+        self._waiting.append((command, d))
+        self._startWaiting()
+        return d
+
+    def _startWaiting(self):
+        while self._waiting and self._active < self.maxConcurrent:
+            command, d = self._waiting.popleft()
+            self._active += 1
+            self._spawn(command).addBoth(self._finished).chainDeferred(d)
+
+    def _finished(self, result):
+        self._active -= 1
+        self._startWaiting()
+        return result
+
+    def _spawn(self, command):
+        reactor = self._reactor
+        if reactor is None:
+            from twisted.internet import reactor
+        if os.name == "nt":
+            shell = os.environ.get("COMSPEC", "cmd.exe")
+            args = [shell, "/c", command]
+        else:
+            shell = "/bin/sh"
+            args = [shell, "-c", command]
+
+        d = defer.Deferred()
+        proto = _CommandProtocol(d, self.maxOutput)
+        start = time.time()
+        try:
+            reactor.spawnProcess(proto, shell, args, env=os.environ)
+        except:
+            self.failures += 1
+            return defer.fail()
+        timer = reactor.callLater(self.timeout, proto.timeout)
+
+        def _done(result):
+            if timer.active():
+                timer.cancel()
+            self.latency.add(time.time() - start)
+            if proto.timedOut:
+                self.timeouts += 1
+            if proto.truncated:
+                self.truncations += 1
+            return result
+        return d.addBoth(_done)
+
+    def stats(self):
+        """Return the runner's statistics as a dictionary."""
+        return {"active": self._active,
+                "waiting": len(self._waiting),
+                "timeouts": self.timeouts,
+                "truncations": self.truncations,
+                "failures": self.failures,
+                "latency": self.latency.snapshot()}
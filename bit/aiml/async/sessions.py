@@ -0,0 +1,344 @@
+"""This module implements the compact binary encoding of Kernel sessions,
+used to move sessions between Kernels (the workers of a
+KernelSupervisor, for instance) and to save many of them at once.
+
+A session is encoded as its id, its predicates (which include the
+topic), and its input and output histories.  The state of an exchange in
+progress (the input stack, the srai memo and the request trace) is not
+encoded.
+
+The encoding starts with a header: the magic string "AIS" and a version
+byte.  Then come the sessions, each as its length and its body:
+
+  body     count(predicates) count(inputs) count(outputs) head* bytes text
+  head     varint(length << 1 | unicode)
+
+with a head for each string of the session (its id, the name and value
+of each predicate, the inputs and the outputs, in this order).  The
+byte strings are concatenated in bytes, and the unicode strings in
+text, which is encoded in UTF-8; the length of a unicode string is its
+number of characters.  Counts and heads are unsigned LEB128 varints, so
+that the heads of short strings take one byte.  A single session is the
+header followed by one session; a stream holds any number of them.
+
+LazySessions holds the sessions restored from a Kernel checkpoint, and
+only decodes each one when it is first used.
+
+"""
+
+import copy
+
+_MAGIC = "AIS"
+VERSION = 1
+_HEADER = _MAGIC + chr(VERSION)
+
+# one-byte varints
+_smallInts = [chr(i) for i in xrange(128)]
+
+
+class SessionFormatError(ValueError):
+    """The data is not a valid encoding of sessions."""
+
+
+def _writeVarint(out, n):
+    if n < 128:
+        out.append(_smallInts[n])
+        return
+    bytes = []
+    while n >= 128:
+        bytes.append(chr(n & 0x7f | 0x80))
+        n >>= 7
+    bytes.append(chr(n))
+    out.append("".join(bytes))
+
+
+def encodeBody(sessionID, predicates, inputs, outputs):
+    """Return the body of the encoding of a session: the predicates
+    dictionary and the lists of the inputs and the outputs.
+
+    """
+    strings = [sessionID]
+    for item in predicates.iteritems():
+        strings.extend(item)
+    strings.extend(inputs)
+    strings.extend(outputs)
+    texts = []
+    bytes = []
+    heads = []
+    for s in strings:
+        if isinstance(s, unicode):
+            texts.append(s)
+            heads.append(len(s) << 1 | 1)
+        elif isinstance(s, str):
+            bytes.append(s)
+            heads.append(len(s) << 1)
+        else:
+            raise TypeError("cannot encode %r in a session" % (s,))
+    out = []
+    for n in (len(predicates), len(inputs), len(outputs)):
+        _writeVarint(out, n)
+    if max(heads) < 128:
+        out.append(str(bytearray(heads)))
+    else:
+        for head in heads:
+            _writeVarint(out, head)
+    out.append("".join(bytes))
+    out.append(u"".join(texts).encode("utf-8"))
+    return "".join(out)
+
+
+def _frame(body):
+    out = []
+    _writeVarint(out, len(body))
+    out.append(body)
+    return "".join(out)
+
+
+def encodeSession(sessionID, predicates, inputs, outputs):
+    """Return the encoding of one session."""
+    return _HEADER + _frame(encodeBody(sessionID, predicates, inputs,
+                                       outputs))
+
+
+class _Decoder(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def varint(self):
+        data = self.data
+        pos = self.pos
+        try:
+            byte = ord(data[pos])
+            pos += 1
+            n = byte & 0x7f
+            shift = 7
+            while byte & 0x80:
+                byte = ord(data[pos])
+                pos += 1
+                n |= (byte & 0x7f) << shift
+                shift += 7
+        except IndexError:
+            raise SessionFormatError("truncated session data")
+        self.pos = pos
+        return n
+
+    def strings(self, count):
+        """Return the count strings making up the rest of the data."""
+        data = self.data
+        heads = bytearray(data[self.pos:self.pos + count])
+        if len(heads) == count and max(heads or [0]) < 128:
+            # one byte each
+            self.pos += count
+        else:
+            heads = [self.varint() for i in xrange(count)]
+        pos = self.pos
+        for head in heads:
+            if not head & 1:
+                pos += head >> 1
+        if pos > len(data):
+            raise SessionFormatError("truncated session data")
+        try:
+            text = data[pos:].decode("utf-8")
+        except UnicodeError:
+            raise SessionFormatError("invalid UTF-8 in session data")
+        strings = []
+        append = strings.append
+        pos = self.pos
+        textPos = 0
+        for head in heads:
+            if head & 1:
+                end = textPos + (head >> 1)
+                append(text[textPos:end])
+                textPos = end
+            else:
+                end = pos + (head >> 1)
+                append(data[pos:end])
+                pos = end
+        if textPos != len(text):
+            raise SessionFormatError("bad lengths in session data")
+        self.pos = len(data)
+        return strings
+
+
+def decodeBody(body):
+    """Return the tuple (sessionID, predicates, inputs, outputs) encoded
+    by encodeBody().
+
+    """
+    decoder = _Decoder(body)
+    counts = [decoder.varint() for i in xrange(3)]
+    strings = decoder.strings(1 + 2 * counts[0] + counts[1] + counts[2])
+    end = 1 + 2 * counts[0]
+    predicates = dict(zip(strings[1:end:2], strings[2:end:2]))
+    inputs = strings[end:end + counts[1]]
+    outputs = strings[end + counts[1]:]
+    return strings[0], predicates, inputs, outputs
+
+
+def _checkHeader(header):
+    if len(header) < len(_HEADER) or header[:len(_MAGIC)] != _MAGIC:
+        raise SessionFormatError("not session data")
+    if ord(header[len(_MAGIC)]) != VERSION:
+        raise SessionFormatError("unsupported session data version %d"
+                                 % ord(header[len(_MAGIC)]))
+
+
+def decodeSession(data):
+    """Return the tuple (sessionID, predicates, inputs, outputs) of the
+    session encoded by encodeSession().
+
+    """
+    _checkHeader(data[:len(_HEADER)])
+    decoder = _Decoder(data)
+    decoder.pos = len(_HEADER)
+    length = decoder.varint()
+    if decoder.pos + length != len(data):
+        raise SessionFormatError("not a single session")
+    return decodeBody(data[decoder.pos:])
+
+
+class SessionWriter(object):
+    """Write a stream of sessions to the file-like object f."""
+
+    def __init__(self, f):
+        self._file = f
+        f.write(_HEADER)
+        self.count = 0
+
+    def write(self, sessionID, predicates, inputs, outputs):
+        self._file.write(_frame(encodeBody(sessionID, predicates, inputs,
+                                           outputs)))
+        self.count += 1
+
+
+class SessionReader(object):
+    """Iterate over the sessions of a stream read from the file-like
+    object f, yielding (sessionID, predicates, inputs, outputs) tuples.
+
+    """
+
+    def __init__(self, f):
+        self._file = f
+        _checkHeader(f.read(len(_HEADER)))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        length = self._length()
+        if length is None:
+            raise StopIteration
+        body = self._file.read(length)
+        if len(body) != length:
+            raise SessionFormatError("truncated session data")
+        return decodeBody(body)
+
+    def _length(self):
+        n = shift = 0
+        while True:
+            byte = self._file.read(1)
+            if not byte:
+                if shift:
+                    raise SessionFormatError("truncated session data")
+                return None
+            byte = ord(byte)
+            n |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return n
+            shift += 7
+
+
+class LazySessions(dict):
+    """A dictionary of sessions, holding encoded sessions which are only
+    decoded the first time they are used.
+
+    encoded maps session ids to the (start, end) offsets of their
+    encoded bodies in data (a string or an mmap), and make(predicates,
+    inputs, outputs) returns a new session.
+
+    """
+
+    def __init__(self, data, encoded, make):
+        dict.__init__(self)
+        self._data = data
+        self._encoded = encoded
+        self._make = make
+
+    def _decode(self, key):
+        start, end = self._encoded.pop(key)
+        sessionID, predicates, inputs, outputs = decodeBody(
+            self._data[start:end])
+        session = self._make(predicates, inputs, outputs)
+        dict.__setitem__(self, key, session)
+        if not self._encoded:
+            # let the data go
+            self._data = None
+        return session
+
+    def decodeAll(self):
+        """Decode every session still encoded."""
+        for key in self._encoded.keys():
+            self._decode(key)
+
+    def __missing__(self, key):
+        if key in self._encoded:
+            return self._decode(key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self._encoded
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self._encoded.pop(key, None)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if self._encoded.pop(key, None) is None:
+            dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        if key in self._encoded:
+            self._decode(key)
+        return dict.pop(self, key, *default)
+
+    def __len__(self):
+        return dict.__len__(self) + len(self._encoded)
+
+    def keys(self):
+        return dict.keys(self) + self._encoded.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def values(self):
+        self.decodeAll()
+        return dict.values(self)
+
+    def items(self):
+        self.decodeAll()
+        return dict.items(self)
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def copy(self):
+        self.decodeAll()
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self.copy(), memo)
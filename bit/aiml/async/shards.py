@@ -0,0 +1,186 @@
+"""This module implements the ShardedBrain class, which splits the brain
+of a bot across several shard processes by the first word of the
+patterns, so that no process holds all of it.
+
+The patterns starting with a word go to the shard of that word (by
+consistent hashing, see bit.aiml.async.workers.HashRing), and those
+starting with "_", "*" or the bot's name go to an extra wildcard shard.
+To match a normalized input, the ShardedBrain asks in parallel the
+wildcard shard for its "_", bot name and "*" branches, and the shard of
+the input's first word for its branch, and keeps the first match in the
+standard priority order: "_", the word, the bot name, then "*".
+
+The ShardedBrain learns the AIML files once, when it is started, and
+saves the part of the brain of each shard to a file which that shard
+loads.  The Kernel matches its inputs through the ShardedBrain given to
+Kernel.setShardedBrain():
+
+    shards = ShardedBrain(4, learnFiles="bot/*.aiml", botName=u"Alice")
+    shards.start()
+    kernel.setShardedBrain(shards)
+
+The Kernel cannot learn categories while its brain is sharded.
+
+"""
+
+import json
+import os
+import sys
+
+from twisted.internet import defer, protocol, task
+from twisted.protocols import amp
+
+from bit.aiml.async.elements import freeze
+from bit.aiml.async.pattern import PatternMgr
+from bit.aiml.async.workers import (BigString, HashRing, Ping,
+                                    ProcessSupervisor, _checkParent)
+
+
+class MatchBranch(amp.Command):
+    arguments = [("input", amp.Unicode()),
+                 ("that", amp.Unicode()),
+                 ("topic", amp.Unicode()),
+                 ("key", amp.String())]
+    # the JSON of the tuple (path, template)
+    response = [("match", BigString())]
+
+
+class ShardedBrain(ProcessSupervisor):
+    """The brain of a bot, split across count word shards and a wildcard
+    shard.
+
+    The other keyword arguments are those of ProcessSupervisor.
+
+    """
+
+    module = "bit.aiml.async.shards"
+
+    def __init__(self, count, brainFile=None, learnFiles=[],
+                 botName=u"Nameless", **kwargs):
+        ProcessSupervisor.__init__(self, count + 1, **kwargs)
+        self.shards = count
+        self.brainFile = brainFile
+        self.learnFiles = learnFiles
+        self._ring = HashRing(range(count))
+        # matches the input words and extracts the stars, but holds no
+        # patterns
+        self._patterns = PatternMgr()
+        self.botName = u" ".join(botName.split())
+        self._categories = 0
+
+    def _prepare(self):
+        """Learn the AIML files of the bot, and save the part of the
+        brain of each shard.
+
+        """
+        from bit.aiml.async.kernel import Kernel
+        kernel = Kernel()
+        kernel.verbose(False)
+        kernel.bootstrap(self.brainFile, self.learnFiles)
+        brain = kernel._brain
+        self._categories = brain.numTemplates()
+        keys = [[] for i in xrange(self.count)]
+        for key in brain.branches():
+            if isinstance(key, int):
+                # a wildcard or the bot name
+                keys[self.shards].append(key)
+            else:
+                keys[self._ring.node(key)].append(key)
+        for index in xrange(self.count):
+            shard = brain.subset(keys[index])
+            shard.setBotName(self.botName)
+            shard.save(self._shardFile(index))
+
+    def _shardFile(self, index):
+        return os.path.join(self._directory, "shard-%d" % index)
+
+    def _arguments(self, index):
+        return json.dumps({"brainFile": self._shardFile(index)})
+
+    def numTemplates(self):
+        """Return the number of categories in the shards."""
+        return self._categories
+
+    def matchPath(self, pattern, that, topic):
+        """Return a Deferred firing with the tuple (path, template) of the
+        match of the normalized pattern, that and topic, like
+        PatternMgr.matchPath().
+
+        """
+        first = self._patterns.firstWord(pattern)
+        if first is None:
+            return defer.succeed((None, None))
+        wildcards = self._workers[self.shards]
+        queries = [(wildcards, PatternMgr._UNDERSCORE),
+                   (self._workers[self._ring.node(first)], first)]
+        if first == self.botName:
+            queries.append((wildcards, PatternMgr._BOT_NAME))
+        queries.append((wildcards, PatternMgr._STAR))
+        d = defer.gatherResults(
+            [self.call(shard, MatchBranch, input=pattern, that=that,
+                       topic=topic, key=json.dumps(key))
+             for shard, key in queries], consumeErrors=True)
+
+        def _combine(results):
+            for result in results:
+                path, template = json.loads(result["match"])
+                if template is not None:
+                    return (path, freeze(template))
+            return (None, None)
+
+        def _failed(failure):
+            # report the error of the shard which failed
+            failure.trap(defer.FirstError)
+            return failure.value.subFailure
+        return d.addCallbacks(_combine, _failed)
+
+    def star(self, starType, path, pattern, that, topic, index):
+        """Like PatternMgr.star(), using path, the path returned by
+        matchPath() for pattern, that and topic.
+
+        """
+        return self._patterns.starFromPath(starType, path, pattern, that,
+                                           topic, index)
+
+    def pathString(self, path):
+        return self._patterns.pathString(path)
+
+
+class _ShardServer(amp.AMP):
+    """The AMP server of a shard process."""
+
+    def __init__(self, brain):
+        amp.AMP.__init__(self)
+        self.brain = brain
+
+    @MatchBranch.responder
+    def matchBranch(self, input, that, topic, key):
+        match = self.brain.matchBranch(input, that, topic, json.loads(key))
+        return {"match": json.dumps(match)}
+
+    @Ping.responder
+    def ping(self):
+        return {"sessions": 0,
+                "categories": self.brain.numTemplates()}
+
+
+def main(argv):
+    """Run a shard process: load its part of the brain, and serve it on
+    the UNIX socket argv[1].
+
+    """
+    from twisted.internet import reactor
+    parent = os.getppid()
+    socket, arguments = argv[1], json.loads(argv[2])
+    brain = PatternMgr()
+    brain.restore(arguments["brainFile"])
+    factory = protocol.Factory()
+    factory.protocol = lambda: _ShardServer(brain)
+    # the supervisor connects once the socket exists
+    reactor.listenUNIX(socket, factory)
+    task.LoopingCall(_checkParent, parent).start(1.0, now=False)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,127 @@
+"""This module implements the SlowRequestLog class, which records the
+exchanges with the Kernel that took longer than a threshold.
+
+While the log is enabled, the Kernel traces every exchange, and hands
+the finished RequestTraces to the log, which only keeps the slow ones.
+Timing the matches of an exchange slows it down, so only the sampleRate
+fraction of the exchanges (and the ones sampled by
+Kernel.setTraceSampling()) are traced in detail; the others record what
+they matched and the macros they ran, but not the time each phase took.
+Each slow exchange is written as one JSON object per
+line to a rotating file (twisted.python.logfile.LogFile) or, when no
+file is given, sent to the Twisted log observers as a log event with a
+"slowRequest" key.  A record holds:
+
+  time        when the exchange ended (seconds since the epoch)
+  session     the session id
+  input       the input
+  response    the response
+  wallTime    the duration of the exchange, in seconds
+  categories  the pattern path matched for each sentence
+  sraiDepth   the deepest reduction
+  hops        the number of reductions, including srai results reused
+              from the memo
+  memoHits    the number of those
+  macros      the name, kind, duration and status of each <system>
+              macro or command
+  detailed    whether the exchange was traced in detail; the following
+              key is only there if it was
+  phases      the total time spent matching, reducing the <srai>
+              inputs of the sentences' templates, and running <system>
+              macros and commands
+
+"""
+
+import json
+import os
+
+from twisted.python import log, logfile
+
+
+class SlowRequestLog(object):
+    """Log of the exchanges slower than threshold seconds."""
+
+    def __init__(self, threshold, path=None, rotateLength=1000000,
+                 maxRotatedFiles=5, sampleRate=0.01):
+        self.threshold = threshold
+        # fraction of the exchanges traced in detail
+        self.sampleRate = sampleRate
+        self._file = None
+        if path is not None:
+            directory, name = os.path.split(os.path.abspath(path))
+            self._file = logfile.LogFile(name, directory,
+                                         rotateLength=rotateLength,
+                                         maxRotatedFiles=maxRotatedFiles)
+        # statistics
+        self.checked = 0
+        self.logged = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def check(self, sessionID, trace, pathOf=None):
+        """Log the finished trace of an exchange if it was slow.
+
+        pathOf(input, that, topic) returns the path matched by the
+        normalized input, that and topic, for the matches of the trace
+        which did not record it.
+
+        """
+        self.checked += 1
+        if trace.wallTime < self.threshold:
+            return
+        self.logged += 1
+        record = self.record(sessionID, trace, pathOf)
+        if self._file is None:
+            log.msg(format="slow AIML request (%(wallTime).3f s): "
+                    "%(input)r", wallTime=trace.wallTime,
+                    input=trace.input, slowRequest=record)
+        else:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+
+    def record(self, sessionID, trace, pathOf=None):
+        """Return the summary of a trace written to the log."""
+        categories = []
+        depth = 0
+        matching = sraiTime = 0.0
+        for hop in trace.hops:
+            depth = max(depth, hop["depth"])
+            if hop["depth"] == 0 and hop["matches"]:
+                # the last match of a sentence is its category
+                match = hop["matches"][-1]
+                path = match["path"]
+                if path is None and pathOf is not None:
+                    path = pathOf(match["input"], match["that"],
+                                  match["topic"])
+                categories.append(path)
+            elif hop["depth"] == 1 and hop["time"] is not None:
+                # deeper reductions are part of these
+                sraiTime += hop["time"]
+            for match in hop["matches"]:
+                matching += match["time"] or 0.0
+        record = {"time": trace.end,
+                  "session": sessionID,
+                  "input": trace.input,
+                  "response": trace.response,
+                  "wallTime": trace.wallTime,
+                  "categories": categories,
+                  "sraiDepth": depth,
+                  "hops": len(trace.hops),
+                  "memoHits": trace.memoHits,
+                  "macros": trace.macros,
+                  "detailed": trace.detailed}
+        if trace.detailed:
+            systemTime = sum([macro["time"] for macro in trace.macros])
+            record["phases"] = {"match": matching,
+                                "srai": sraiTime,
+                                "system": systemTime}
+        return record
+
+    def stats(self):
+        return {"threshold": self.threshold,
+                "sampleRate": self.sampleRate,
+                "checked": self.checked,
+                "logged": self.logged}
@@ -0,0 +1,161 @@
+"""This module implements a static analysis of the <srai> elements of a
+learned brain.
+
+A <srai> element is literal if its contents are plain text, so that its
+input is known at learn time.  If that input matches the same category
+whatever the bot's previous response and the current topic are, the
+category containing the <srai> has an edge to the target category.  The
+resulting graph is used to report srai cycles, and to link literal srai
+inputs directly to their target templates.
+
+"""
+
+import utils
+
+
+class SraiGraph(object):
+    """The graph of the literal <srai> targets of a Kernel's brain."""
+
+    def __init__(self, kernel):
+        self._kernel = kernel
+        # normalized literal srai input -> target template
+        self.links = {}
+        # category key -> list of the category keys its srais target
+        self.edges = {}
+        # ids of the templates which start an endless chain of tail srais
+        self.loops = set()
+        self._build()
+
+    def _build(self):
+        """Walk every learned template, and resolve its literal <srai>
+        elements.
+
+        """
+        kernel = self._kernel
+        brain = kernel._brain
+        # template id -> keys of the categories sharing the template
+        keys = {}
+        templates = []
+        for key, template in brain.categories():
+            keys.setdefault(id(template), []).append(key)
+            templates.append((key, template))
+
+        # normalized input -> (target template, target category key)
+        resolved = {}
+        # template id -> target template id, for templates which are a
+        # lone literal <srai>.
+        tails = {}
+        for key, template in templates:
+            targets = []
+            tail = kernel._tailSrai(template)
+            for srai, input in utils.literalElements(template, "srai"):
+                input = kernel._normalize(input)
+                try:
+                    target, targetKey = resolved[input]
+                except KeyError:
+                    target = brain.matchStatic(input)
+                    targetKey = None
+                    if target is not None:
+                        self.links[input] = target
+                        targetKey = self._targetKey(input, keys[id(target)])
+                    resolved[input] = (target, targetKey)
+                if target is None:
+                    continue
+                if targetKey not in targets:
+                    targets.append(targetKey)
+                if srai is tail:
+                    tails[id(template)] = id(target)
+            if len(targets) > 0:
+                self.edges[key] = targets
+        self._findLoops(tails)
+
+    def _targetKey(self, input, owners):
+        """Return the key of the category which input matches, among
+        owners, the keys of the categories sharing its template.
+
+        """
+        if len(owners) == 1:
+            return owners[0]
+        brain = self._kernel._brain
+        # input matches whatever the 'that' and 'topic' are
+        path = brain.matchPath(input, u"", u"")[0]
+        return brain.categoryKey(path) or owners[0]
+
+    def _findLoops(self, tails):
+        """Find the templates from which following tail srais never ends.
+
+        Each template has at most one tail srai, so every chain either
+        ends or runs into a cycle.
+
+        """
+        done = set()
+        for start in tails:
+            if start in done:
+                continue
+            chain = []
+            seen = set()
+            node = start
+            while node in tails and node not in done and node not in seen:
+                chain.append(node)
+                seen.add(node)
+                node = tails[node]
+            # the chain loops if it ran into itself or into a known loop
+            looping = node in seen or node in self.loops
+            for node in chain:
+                done.add(node)
+                if looping:
+                    self.loops.add(node)
+
+    def cycles(self):
+        """Return the srai cycles of the graph, each as a list of category
+        keys.
+
+        Every strongly connected group of categories is reported, as well
+        as any category whose srai targets itself.  Cycles through <srai>
+        elements inside <condition> or <random> elements may still end at
+        runtime.
+
+        """
+        # Tarjan's algorithm, without recursion.
+        index = {}
+        low = {}
+        stack = []
+        onStack = set()
+        cycles = []
+        for root in self.edges:
+            if root in index:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            onStack.add(root)
+            work = [(root, iter(self.edges[root]))]
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if child not in index:
+                        index[child] = low[child] = len(index)
+                        stack.append(child)
+                        onStack.add(child)
+                        work.append((child, iter(self.edges.get(child, []))))
+                        break
+                    elif child in onStack:
+                        low[node] = min(low[node], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+                    if low[node] != index[node]:
+                        continue
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        onStack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    if len(component) > 1 \
+                            or node in self.edges.get(node, []):
+                        component.reverse()
+                        cycles.append(component)
+        return cycles
@@ -0,0 +1,67 @@
+"""This module contains the helpers the Kernel uses to keep performance
+statistics.
+
+"""
+
+import bisect
+
+
+class Histogram(object):
+    """Cumulative histogram of latencies (in seconds).
+
+    Each value is counted in the first bucket whose upper bound is greater
+    than or equal to it; values above the largest bound are counted in an
+    extra, unbounded bucket.
+
+    """
+
+    defaultBounds = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                     0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, bounds=defaultBounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        """Count one value."""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Estimate the q-quantile (0 <= q <= 1) of the values counted so
+        far, as the upper bound of the bucket it falls in.
+
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        """Return the statistics as a dictionary."""
+        mean = 0.0
+        if self.count:
+            mean = self.sum / self.count
+        cumulative = []
+        seen = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            seen += count
+            cumulative.append((bound, seen))
+        return {"count": self.count,
+                "sum": self.sum,
+                "mean": mean,
+                "max": self.max,
+                "p50": self.quantile(0.5),
+                "p99": self.quantile(0.99),
+                "buckets": cumulative}
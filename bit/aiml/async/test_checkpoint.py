@@ -0,0 +1,61 @@
+"""Tests of bit.aiml.async.checkpoint."""
+
+import os
+
+from twisted.trial import unittest
+
+from bit.aiml.async.checkpoint import (CheckpointError, CheckpointFile,
+                                       writeCheckpoint)
+
+
+class CheckpointFileTests(unittest.TestCase):
+    """writeCheckpoint() and CheckpointFile."""
+
+    def setUp(self):
+        self.directory = self.mktemp()
+        os.mkdir(self.directory)
+        self.path = os.path.join(self.directory, "checkpoint")
+
+    def test_roundTrip(self):
+        sections = [("meta", "some metadata"),
+                    ("empty", ""),
+                    ("big", "".join([chr(i % 256) for i in xrange(100000)]))]
+        writeCheckpoint(self.path, sections)
+        checkpoint = CheckpointFile(self.path)
+        for name, contents in sections:
+            self.assertEqual(checkpoint.section(name), contents)
+            start, end = checkpoint.bounds(name)
+            self.assertEqual(checkpoint.data[start:end], contents)
+        self.assertRaises(CheckpointError, checkpoint.section, "missing")
+
+    def test_replaced(self):
+        writeCheckpoint(self.path, [("meta", "old")])
+        writeCheckpoint(self.path, [("meta", "new")])
+        self.assertEqual(CheckpointFile(self.path).section("meta"), "new")
+        # no temporary file is left behind
+        self.assertEqual(os.listdir(self.directory), ["checkpoint"])
+
+    def test_failedWrite(self):
+        """A checkpoint which cannot be written leaves the previous one
+        in place.
+
+        """
+        writeCheckpoint(self.path, [("meta", "old")])
+        self.assertRaises(TypeError, writeCheckpoint, self.path,
+                          [("meta", None)])
+        self.assertEqual(CheckpointFile(self.path).section("meta"), "old")
+        self.assertEqual(os.listdir(self.directory), ["checkpoint"])
+
+    def test_notACheckpoint(self):
+        f = open(self.path, "wb")
+        f.write("AIML is not a checkpoint")
+        f.close()
+        self.assertRaises(CheckpointError, CheckpointFile, self.path)
+
+    def test_truncated(self):
+        writeCheckpoint(self.path, [("meta", "some metadata")])
+        data = open(self.path, "rb").read()
+        f = open(self.path, "wb")
+        f.write(data[:-1])
+        f.close()
+        self.assertRaises(CheckpointError, CheckpointFile, self.path)
@@ -0,0 +1,229 @@
+"""Tests of bit.aiml.async.kernel, beyond the self-test of kernel.py."""
+
+import cStringIO
+import os
+
+from twisted.trial import unittest
+
+from bit.aiml.async.brains import BrainRegistry
+from bit.aiml.async.kernel import Kernel
+
+_selfTest = os.path.join(os.path.dirname(__file__), "self-test.aiml")
+
+
+class _Request(object):
+
+    def __init__(self, sessionID):
+        self.session_id = sessionID
+
+
+def _kernel():
+    """Return a quiet Kernel which has learned the self-test."""
+    kernel = Kernel()
+    kernel.verbose(False)
+    kernel.bootstrap(learnFiles=_selfTest)
+    return kernel
+
+
+class _KernelTestCase(unittest.TestCase):
+
+    def respond(self, kernel, sessionID, input):
+        """Return the response of kernel to input in the session
+        sessionID.
+
+        """
+        return self.successResultOf(kernel.respond(_Request(sessionID),
+                                                   input))
+
+    def learn(self, kernel, aiml):
+        """Make kernel learn the categories of the string aiml."""
+        path = self.mktemp()
+        f = open(path, "w")
+        f.write('<aiml version="1.0">%s</aiml>' % aiml)
+        f.close()
+        kernel.learn(path)
+
+
+class SessionTransferTests(_KernelTestCase):
+    """exportSession(), importSession() and their stream versions."""
+
+    def setUp(self):
+        self.kernel = _kernel()
+        self.respond(self.kernel, "ann", u"test get and set")
+        self.respond(self.kernel, "ann", u"test thatstar")
+        self.kernel.setPredicate(u"mood", u"caf\xe9", "ann")
+
+    def assertSameSession(self, other, sessionID):
+        self.assertEqual(other.getSessionData(sessionID),
+                         self.kernel.getSessionData(sessionID))
+        # the session carries on where it was
+        self.assertEqual(self.respond(other, sessionID, u"test thatstar"),
+                         'I just said "beans"')
+
+    def test_roundTrip(self):
+        other = _kernel()
+        data = self.kernel.exportSession("ann")
+        self.assertEqual(other.importSession(data), "ann")
+        self.assertSameSession(other, "ann")
+        self.assertEqual(other.getPredicate(u"food", "ann"), u"cheese")
+        self.assertEqual(other.getPredicate(u"mood", "ann"), u"caf\xe9")
+
+    def test_remove(self):
+        data = self.kernel.exportSession("ann", remove=True)
+        self.assertNotEqual(data, None)
+        self.assertEqual(self.kernel.exportSession("ann"), None)
+
+    def test_stream(self):
+        self.respond(self.kernel, "bob", u"test bot")
+        stream = cStringIO.StringIO()
+        self.assertEqual(
+            self.kernel.exportSessions(stream, ["ann", "bob", "nobody"]), 2)
+        stream.seek(0)
+        other = _kernel()
+        self.assertEqual(other.importSessions(stream), 2)
+        self.assertEqual(other.getSessionData("bob"),
+                         self.kernel.getSessionData("bob"))
+        self.assertSameSession(other, "ann")
+
+
+class CheckpointTests(_KernelTestCase):
+    """checkpoint() and restore()."""
+
+    # inputs whose responses depend on neither time nor chance
+    inputs = [u"test bot", u"test gender", u"test person",
+              u"test person2 I was there", u"test srai",
+              u"test nested sr test srai", u"test star end of story",
+              u"test topic", u"test thatstar multiple",
+              u"test thatstar multiple"]
+
+    def setUp(self):
+        self.kernel = _kernel()
+        self.kernel.setBotPredicate(u"name", u"Checkpointed")
+        self.respond(self.kernel, "ann", u"test get and set")
+        self.respond(self.kernel, "ann", u"test thatstar")
+        self.path = self.mktemp()
+        self.kernel.checkpoint(self.path)
+
+    def restored(self):
+        kernel = Kernel()
+        kernel.verbose(False)
+        kernel.restore(self.path)
+        return kernel
+
+    def test_sameResponses(self):
+        other = self.restored()
+        self.assertEqual(other.numCategories(), self.kernel.numCategories())
+        self.assertEqual(other.getBotPredicate(u"name"), u"Checkpointed")
+        for input in self.inputs:
+            self.assertEqual(self.respond(other, "new", input),
+                             self.respond(self.kernel, "new", input))
+
+    def test_sraiAnalysis(self):
+        other = self.restored()
+        self.assertEqual(sorted(other._sraiLinks.keys()),
+                         sorted(self.kernel._sraiLinks.keys()))
+        self.assertEqual(len(other._sraiLoops), len(self.kernel._sraiLoops))
+        self.assertEqual(self.respond(other, "new", u"test srai infinite"),
+                         self.respond(self.kernel, "new",
+                                      u"test srai infinite"))
+
+    def test_sessions(self):
+        """The sessions are restored, and decoded when first used."""
+        other = self.restored()
+        self.assertEqual(dict.get(other._sessions, "ann"), None)
+        self.assertEqual(other.getSessionData("ann"),
+                         self.kernel.getSessionData("ann"))
+        self.assertEqual(self.respond(other, "ann", u"test thatstar"),
+                         'I just said "beans"')
+        self.assertEqual(other.getPredicate(u"food", "ann"), u"cheese")
+
+    def test_checkpointRestored(self):
+        """A restored Kernel can be checkpointed again, before its
+        sessions are decoded.
+
+        """
+        other = self.restored()
+        path = self.mktemp()
+        other.checkpoint(path)
+        third = Kernel()
+        third.verbose(False)
+        third.restore(path)
+        self.assertEqual(third.getSessionData("ann"),
+                         self.kernel.getSessionData("ann"))
+
+
+class SharedBrainTests(_KernelTestCase):
+    """Kernels sharing a base brain through setBaseBrain()."""
+
+    def setUp(self):
+        self.base = BrainRegistry().load("self-test", learnFiles=_selfTest)
+        self.categories = self.base.numTemplates()
+        self.kernels = []
+        for name in (u"Ann", u"Bob"):
+            kernel = Kernel()
+            kernel.verbose(False)
+            kernel.setBotPredicate(u"name", name)
+            kernel.setBaseBrain(self.base)
+            self.kernels.append(kernel)
+
+    def test_privateCategories(self):
+        ann, bob = self.kernels
+        self.learn(ann, "<category><pattern>TEST BOT</pattern>"
+                   "<template>I am the overlay</template></category>"
+                   "<category><pattern>TEST OVERLAY</pattern>"
+                   "<template>Ann only</template></category>")
+        self.assertEqual(self.respond(ann, "s", u"test bot"),
+                         "I am the overlay")
+        self.assertEqual(self.respond(ann, "s", u"test overlay"),
+                         "Ann only")
+        self.assertEqual(self.respond(bob, "s", u"test bot"),
+                         "My name is Bob")
+        self.assertEqual(self.respond(bob, "s", u"test overlay"), "")
+        self.assertEqual(ann.numCategories(), self.categories + 1)
+        self.assertEqual(bob.numCategories(), self.categories)
+        self.assertEqual(self.base.numTemplates(), self.categories)
+
+    def test_sraiIntoBase(self):
+        """The categories of the overlay reduce to those of the base, and
+        the other way around.
+
+        """
+        ann = self.kernels[0]
+        self.learn(ann, "<category><pattern>SRAI TARGET</pattern>"
+                   "<template>overlay target</template></category>"
+                   "<category><pattern>TEST OVERLAY SRAI</pattern>"
+                   "<template><srai>test bot</srai></template></category>")
+        self.assertEqual(self.respond(ann, "s", u"test srai"),
+                         "overlay target")
+        self.assertEqual(self.respond(ann, "s", u"test overlay srai"),
+                         "My name is Ann")
+
+
+class MinimizeBrainTests(_KernelTestCase):
+    """minimizeBrain() leaves the responses unchanged."""
+
+    # categories repeating their template, 'that' and 'topic'
+    colours = "".join([
+        "<topic name=\"COLOURS\"><category><pattern>I LIKE %s</pattern>"
+        "<that>WHAT COLOUR *</that><template>Nice colour.</template>"
+        "</category></topic>" % colour
+        for colour in ("RED", "GREEN", "BLUE")])
+
+    def test_sameResponses(self):
+        kernel = _kernel()
+        minimized = _kernel()
+        for k in (kernel, minimized):
+            self.learn(k, self.colours)
+        before, after = minimized.minimizeBrain()
+        self.assertTrue(after < before)
+        self.assertEqual(minimized.numCategories(), kernel.numCategories())
+        for input in CheckpointTests.inputs + [u"test srai infinite"]:
+            self.assertEqual(self.respond(minimized, "s", input),
+                             self.respond(kernel, "s", input))
+        for k in (kernel, minimized):
+            k.setPredicate(u"topic", u"colours", "s")
+            k._sessions["s"][k._outputHistory].append(u"What colour is it?")
+        self.assertEqual(self.respond(minimized, "s", u"I like green"),
+                         "Nice colour.")
+        self.assertEqual(self.respond(kernel, "s", u"I like green"),
+                         "Nice colour.")
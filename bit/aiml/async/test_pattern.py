@@ -0,0 +1,275 @@
+"""Tests of bit.aiml.async.pattern."""
+
+from twisted.trial import unittest
+
+from bit.aiml.async.pattern import OverlayPatternMgr, PatternMgr
+
+
+def _brain(categories):
+    """Return a PatternMgr holding the ((pattern, that, topic), template)
+    pairs of categories.
+
+    """
+    brain = PatternMgr()
+    for key, template in categories:
+        brain.add(key, template)
+    return brain
+
+
+_categories = [
+    ((u"HELLO", u"*", u"*"), "hello"),
+    ((u"HELLO *", u"*", u"*"), "hello star"),
+    ((u"HELLO THERE", u"*", u"*"), "hello there"),
+    ((u"YES", u"DO YOU LIKE *", u"*"), "yes like"),
+    ((u"YES", u"*", u"*"), "yes"),
+    ((u"_ BYE", u"*", u"GAMES"), "bye games"),
+]
+
+# (input, that, topic) and the template they match in _categories
+_matches = [
+    ((u"HELLO", u"", u""), "hello"),
+    ((u"HELLO WORLD", u"", u""), "hello star"),
+    ((u"HELLO THERE", u"", u""), "hello there"),
+    ((u"YES", u"DO YOU LIKE TEA", u""), "yes like"),
+    ((u"YES", u"I DO", u""), "yes"),
+    ((u"OK BYE", u"", u"GAMES"), "bye games"),
+    ((u"OK BYE", u"", u""), None),
+]
+
+
+class SnapshotTests(unittest.TestCase):
+    """PatternMgr.snapshot() and the copy-on-write of the nodes."""
+
+    def setUp(self):
+        self.brain = _brain(_categories)
+        self.snapshot = self.brain.snapshot()
+
+    def test_sameMatches(self):
+        for (input, that, topic), template in _matches:
+            self.assertEqual(self.snapshot.match(input, that, topic),
+                             template)
+        self.assertEqual(self.snapshot.numTemplates(),
+                         self.brain.numTemplates())
+
+    def test_addAfterSnapshot(self):
+        """Categories added to the brain, even below nodes the snapshot
+        shares, are not seen by the snapshot.
+
+        """
+        self.brain.add((u"HELLO YOU", u"*", u"*"), "hello you")
+        self.brain.add((u"HELLO", u"*", u"*"), "hello again")
+        self.assertEqual(self.brain.match(u"HELLO YOU", u"", u""),
+                         "hello you")
+        self.assertEqual(self.brain.match(u"HELLO", u"", u""),
+                         "hello again")
+        self.assertEqual(self.snapshot.match(u"HELLO YOU", u"", u""),
+                         "hello star")
+        self.assertEqual(self.snapshot.match(u"HELLO", u"", u""), "hello")
+        self.assertEqual(self.snapshot.numTemplates(), len(_categories))
+
+    def test_addToSnapshot(self):
+        """Categories added to the snapshot are not seen by the brain."""
+        self.snapshot.add((u"YES", u"*", u"GAMES"), "yes games")
+        self.assertEqual(self.snapshot.match(u"YES", u"", u"GAMES"),
+                         "yes games")
+        self.assertEqual(self.brain.match(u"YES", u"", u"GAMES"), "yes")
+
+    def test_snapshotOfSnapshot(self):
+        second = self.brain.snapshot()
+        self.brain.add((u"HELLO THERE", u"*", u"*"),
+                       "hello there again")
+        self.assertEqual(self.snapshot.match(u"HELLO THERE", u"", u""),
+                         "hello there")
+        self.assertEqual(second.match(u"HELLO THERE", u"", u""),
+                         "hello there")
+        self.assertEqual(self.brain.match(u"HELLO THERE", u"", u""),
+                         "hello there again")
+
+
+class OverlayTests(unittest.TestCase):
+    """OverlayPatternMgr matches its own patterns and those of its base
+    as if one PatternMgr held them all.
+
+    """
+
+    def setUp(self):
+        self.base = _brain(_categories)
+        self.base.add((u"WHO IS BOT_NAME", u"*", u"*"), "who is bot")
+        self.overlay = OverlayPatternMgr(self.base)
+
+    def assertMatches(self, brain, matches):
+        for (input, that, topic), template in matches:
+            self.assertEqual(brain.match(input, that, topic), template)
+
+    def test_base(self):
+        """An empty overlay matches like its base."""
+        self.assertMatches(self.overlay, _matches)
+        self.assertEqual(self.overlay.numTemplates(),
+                         self.base.numTemplates())
+
+    def test_replace(self):
+        """A category of the overlay replaces the category of base with
+        the same pattern, that and topic, which base keeps.
+
+        """
+        self.overlay.add((u"HELLO", u"*", u"*"), "overlay hello")
+        self.assertEqual(self.overlay.match(u"HELLO", u"", u""),
+                         "overlay hello")
+        self.assertEqual(self.overlay.template((u"HELLO", u"*", u"*")),
+                         "overlay hello")
+        self.assertEqual(self.base.match(u"HELLO", u"", u""), "hello")
+        self.assertEqual(self.overlay.numTemplates(),
+                         self.base.numTemplates())
+
+    def test_order(self):
+        """The patterns of the overlay and base are tried in the usual
+        order: "_", then the words, then "*".
+
+        """
+        self.overlay.add((u"HELLO * THERE", u"*", u"*"), "overlay star")
+        self.overlay.add((u"_ WORLD", u"*", u"*"), "overlay underscore")
+        self.overlay.add((u"YES", u"*", u"GAMES"), "overlay yes games")
+        self.assertMatches(self.overlay, [
+            # the word of base beats the star of the overlay
+            ((u"HELLO THERE", u"", u""), "hello there"),
+            ((u"HELLO YOU THERE", u"", u""), "overlay star"),
+            # the underscore of the overlay beats the word of base
+            ((u"HELLO WORLD", u"", u""), "overlay underscore"),
+            # the 'that' of base beats the wildcard 'that' of the overlay
+            ((u"YES", u"DO YOU LIKE TEA", u"GAMES"), "yes like"),
+            ((u"YES", u"I DO", u"GAMES"), "overlay yes games"),
+        ])
+        self.assertEqual(self.overlay.star(u"star", u"HELLO YOU THERE",
+                                           u"", u"", 1), u"YOU")
+        self.assertEqual(self.overlay.numTemplates(),
+                         self.base.numTemplates() + 3)
+        self.assertMatches(self.base, _matches)
+
+    def test_botName(self):
+        """The bot name of each overlay is its own."""
+        other = OverlayPatternMgr(self.base)
+        self.overlay.setBotName(u"ANN")
+        other.setBotName(u"BOB")
+        self.assertEqual(self.overlay.match(u"WHO IS ANN", u"", u""),
+                         "who is bot")
+        self.assertEqual(self.overlay.match(u"WHO IS BOB", u"", u""), None)
+        self.assertEqual(other.match(u"WHO IS BOB", u"", u""), "who is bot")
+
+    def test_dumps(self):
+        """dumps() only holds the overlay."""
+        self.overlay.add((u"HELLO", u"*", u"*"), "overlay hello")
+        self.overlay.add((u"GOOD MORNING", u"*", u"*"), "morning")
+        copy = OverlayPatternMgr(self.base)
+        copy.loads(self.overlay.dumps())
+        self.assertEqual(copy.numTemplates(), self.overlay.numTemplates())
+        self.assertEqual(copy.match(u"HELLO", u"", u""), "overlay hello")
+        self.assertEqual(copy.match(u"GOOD MORNING", u"", u""), "morning")
+        self.assertEqual(copy.match(u"HELLO WORLD", u"", u""), "hello star")
+        self.assertTrue(len(copy.dumps()) < len(self.base.dumps()))
+
+
+class MinimizeTests(unittest.TestCase):
+    """PatternMgr.minimize() shares the identical subtrees, and leaves
+    matching unchanged.
+
+    """
+
+    def setUp(self):
+        self.brain = _brain(_categories)
+        # the same 'that' and 'topic' tails under many patterns, and equal
+        # templates
+        for word in (u"RED", u"GREEN", u"BLUE"):
+            self.brain.add((u"I LIKE %s" % word, u"WHAT COLOUR *",
+                            u"COLOURS"), ["template", {}, u"nice"])
+            self.brain.add((u"%s *" % word, u"*", u"COLOURS"),
+                           ["template", {}, u"colour"])
+        self.matches = _matches + [
+            ((u"I LIKE RED", u"WHAT COLOUR IS IT", u"COLOURS"),
+             ["template", {}, u"nice"]),
+            ((u"I LIKE RED", u"", u"COLOURS"), None),
+            ((u"GREEN TEA", u"", u"COLOURS"), ["template", {}, u"colour"]),
+        ]
+        self.before, self.after = self.brain.minimize()
+
+    def assertMatches(self, brain):
+        for (input, that, topic), template in self.matches:
+            self.assertEqual(brain.match(input, that, topic), template)
+
+    def test_smaller(self):
+        self.assertTrue(self.after < self.before)
+        self.assertEqual(self.brain.numTemplates(), len(_categories) + 6)
+        self.assertMatches(self.brain)
+
+    def test_sharedTemplates(self):
+        first = self.brain.match(u"I LIKE RED", u"WHAT COLOUR IS IT",
+                                 u"COLOURS")
+        second = self.brain.match(u"I LIKE BLUE", u"WHAT COLOUR IS IT",
+                                  u"COLOURS")
+        self.assertNotEqual(first, None)
+        self.assertIdentical(first, second)
+
+    def test_stars(self):
+        self.assertEqual(self.brain.star(u"star", u"BLUE SKY", u"",
+                                         u"COLOURS", 1), u"SKY")
+        self.assertEqual(self.brain.star(u"thatstar", u"I LIKE GREEN",
+                                         u"WHAT COLOUR IS GRASS",
+                                         u"COLOURS", 1), u"IS GRASS")
+
+    def test_addAfterMinimize(self):
+        """Adding below a shared node leaves the categories sharing it
+        unchanged.
+
+        """
+        self.brain.add((u"I LIKE RED", u"WHAT COLOUR *", u"COLOURS AGAIN"),
+                       "again")
+        that = u"WHAT COLOUR IS IT"
+        self.assertEqual(
+            self.brain.match(u"I LIKE RED", that, u"COLOURS AGAIN"), "again")
+        self.assertEqual(
+            self.brain.match(u"I LIKE BLUE", that, u"COLOURS AGAIN"), None)
+        self.assertMatches(self.brain)
+
+    def test_saveRestore(self):
+        path = self.mktemp()
+        self.brain.save(path)
+        restored = PatternMgr()
+        restored.restore(path)
+        self.assertMatches(restored)
+        self.assertEqual(restored.numTemplates(), self.brain.numTemplates())
+
+
+class MatchStaticTests(unittest.TestCase):
+    """PatternMgr.matchStatic() only answers when 'that' and 'topic'
+    cannot change the match.
+
+    """
+
+    def setUp(self):
+        self.brain = _brain(_categories)
+
+    def test_static(self):
+        self.assertEqual(self.brain.matchStatic(u"hello"), "hello")
+        self.assertEqual(self.brain.matchStatic(u"Hello, world!"),
+                         "hello star")
+        self.assertEqual(self.brain.matchStatic(u"hello there"),
+                         "hello there")
+
+    def test_ambiguous(self):
+        """A pattern with categories for some 'that' or 'topic' only has
+        no static match.
+
+        """
+        self.assertEqual(self.brain.matchStatic(u"yes"), None)
+        self.assertEqual(self.brain.matchStatic(u"ok bye"), None)
+
+    def test_noMatch(self):
+        self.assertEqual(self.brain.matchStatic(u""), None)
+        self.assertEqual(self.brain.matchStatic(u"goodbye"), None)
+
+    def test_overlay(self):
+        overlay = OverlayPatternMgr(self.brain)
+        overlay.add((u"GOODBYE", u"*", u"*"), "goodbye")
+        overlay.add((u"HELLO", u"*", u"GAMES"), "hello games")
+        self.assertEqual(overlay.matchStatic(u"goodbye"), "goodbye")
+        self.assertEqual(overlay.matchStatic(u"hello there"), "hello there")
+        self.assertEqual(overlay.matchStatic(u"hello"), None)
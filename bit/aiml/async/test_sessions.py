@@ -0,0 +1,127 @@
+"""Tests of bit.aiml.async.sessions."""
+
+import cStringIO
+
+from twisted.trial import unittest
+
+from bit.aiml.async import sessions
+
+
+# (sessionID, predicates, inputs, outputs)
+_session = (u"user-1",
+            {u"name": u"Ann", u"topic": u"CAF\xc9", "raw": "\xff\x00"},
+            [u"hello", u"what is your name", u"caf\xe9 \u2603"],
+            [u"Hi there!", u"My name is Nameless"])
+
+
+class CodecTests(unittest.TestCase):
+    """encodeSession() and decodeSession()."""
+
+    def assertRoundTrip(self, session):
+        decoded = sessions.decodeSession(sessions.encodeSession(*session))
+        self.assertEqual(decoded, session)
+        # byte strings stay byte strings, unicode strings unicode
+        for original, copy in zip(session[2] + session[3],
+                                  decoded[2] + decoded[3]):
+            self.assertEqual(type(copy), type(original))
+        for name, value in session[1].items():
+            self.assertEqual(type(decoded[1][name]), type(value))
+
+    def test_roundTrip(self):
+        self.assertRoundTrip(_session)
+
+    def test_empty(self):
+        self.assertRoundTrip((u"", {}, [], []))
+
+    def test_longStrings(self):
+        """The lengths of long strings take several varint bytes."""
+        for length in (127, 128, 16383, 16384, 300000):
+            self.assertRoundTrip(("id", {u"long": u"x" * length},
+                                  ["y" * length], [u"\u2603" * length]))
+
+    def test_shortHeads(self):
+        """Short strings cost one byte more than their contents."""
+        data = sessions.encodeSession("s", {}, ["a", "bc"], [])
+        # header, length, 3 counts, 3 heads, 4 bytes, no text
+        self.assertEqual(len(data), 4 + 1 + 3 + 3 + 4)
+
+    def test_badHeader(self):
+        data = sessions.encodeSession(*_session)
+        self.assertRaises(sessions.SessionFormatError,
+                          sessions.decodeSession, "XYZ" + data[3:])
+        self.assertRaises(sessions.SessionFormatError,
+                          sessions.decodeSession,
+                          data[:3] + chr(sessions.VERSION + 1) + data[4:])
+
+    def test_truncated(self):
+        data = sessions.encodeSession(*_session)
+        self.assertRaises(sessions.SessionFormatError,
+                          sessions.decodeSession, data[:-1])
+        self.assertRaises(sessions.SessionFormatError,
+                          sessions.decodeSession, data + "x")
+
+
+class StreamTests(unittest.TestCase):
+    """SessionWriter and SessionReader."""
+
+    def test_roundTrip(self):
+        stream = cStringIO.StringIO()
+        writer = sessions.SessionWriter(stream)
+        written = [(u"s%d" % i, {u"n": unicode(i)}, [u"in"] * i, [])
+                   for i in xrange(200)]
+        written.append(_session)
+        for session in written:
+            writer.write(*session)
+        self.assertEqual(writer.count, len(written))
+        stream.seek(0)
+        self.assertEqual(list(sessions.SessionReader(stream)), written)
+
+    def test_truncated(self):
+        stream = cStringIO.StringIO()
+        sessions.SessionWriter(stream).write(*_session)
+        truncated = cStringIO.StringIO(stream.getvalue()[:-2])
+        self.assertRaises(sessions.SessionFormatError, list,
+                          sessions.SessionReader(truncated))
+
+
+class LazySessionsTests(unittest.TestCase):
+    """LazySessions only decodes the sessions used."""
+
+    def setUp(self):
+        bodies = []
+        encoded = {}
+        offset = 0
+        for sessionID in (u"a", u"b"):
+            body = sessions.encodeBody(sessionID, {u"name": sessionID},
+                                       [u"hi"], [u"hello"])
+            encoded[sessionID] = (offset, offset + len(body))
+            bodies.append(body)
+            offset += len(body)
+        self.made = []
+        self.sessions = sessions.LazySessions("".join(bodies), encoded,
+                                              self.make)
+
+    def make(self, predicates, inputs, outputs):
+        self.made.append(predicates[u"name"])
+        return {"predicates": predicates, "inputs": inputs,
+                "outputs": outputs}
+
+    def test_decodedOnUse(self):
+        self.assertEqual(len(self.sessions), 2)
+        self.assertIn(u"a", self.sessions)
+        self.assertEqual(self.made, [])
+        self.assertEqual(self.sessions[u"b"]["predicates"],
+                         {u"name": u"b"})
+        self.assertEqual(self.made, [u"b"])
+        self.assertEqual(dict.get(self.sessions, u"a"), None)
+        self.assertEqual(self.sessions.get(u"a")["inputs"], [u"hi"])
+        self.assertEqual(self.made, [u"b", u"a"])
+
+    def test_missing(self):
+        self.assertRaises(KeyError, lambda: self.sessions[u"c"])
+        self.assertEqual(self.sessions.get(u"c"), None)
+
+    def test_decodeAll(self):
+        self.sessions.decodeAll()
+        self.assertEqual(sorted(self.made), [u"a", u"b"])
+        self.assertEqual(sorted(dict.keys(self.sessions)), [u"a", u"b"])
@@ -0,0 +1,137 @@
+"""This module implements the RequestTrace class, which records how the
+Kernel computed the response to one input.
+
+A trace is attached to a request as its aiml_trace attribute, either by
+the caller before calling respond() or by the Kernel itself for the
+sampled fraction of requests set by Kernel.setTraceSampling() and, while
+the slow request log is enabled, for every request.  It records:
+
+  - every reduction ("hop"): the top-level sentences and the inputs of
+    <srai> and <sr> elements, with their depth and how long they took;
+  - within each hop, every match: the normalized input, 'that' and
+    'topic', and the path of the pattern that matched;
+  - the srai results reused from the request's memo;
+  - the macros and shell commands run by <system> elements;
+  - the total wall time of the exchange.
+
+A trace which is not detailed records the same, except for the paths
+matched and the time spent matching: its matches take the fast paths
+(the srai links and the batch cache), and only record the normalized
+input, 'that' and 'topic' matched.  The Kernel traces every exchange
+this way for its slow request log, which costs little.
+
+"""
+
+import time
+
+
+class RequestTrace(object):
+    """The trace of one exchange with the Kernel."""
+
+    def __init__(self, detailed=True):
+        self.detailed = detailed
+        self.input = None
+        self.response = None
+        self.start = None
+        self.end = None
+        self.hops = []
+        self.macros = []
+        self.memoHits = 0
+
+    def begin(self, input):
+        self.input = input
+        self.start = time.time()
+
+    def finish(self, response):
+        self.response = response
+        self.end = time.time()
+
+    @property
+    def finished(self):
+        return self.end is not None
+
+    @property
+    def wallTime(self):
+        """The duration of the exchange in seconds, or None if it is not
+        finished.
+
+        """
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def enter(self, input, depth, memo=False):
+        """Record the start of a reduction, and return its hop."""
+        hop = {"input": input,
+               "depth": depth,
+               "start": time.time(),
+               "time": None,
+               "memo": memo,
+               "matches": []}
+        self.hops.append(hop)
+        if memo:
+            self.memoHits += 1
+            hop["time"] = 0.0
+        return hop
+
+    def leave(self, hop):
+        hop["time"] = time.time() - hop["start"]
+
+    def matched(self, hop, input, that, topic, path, duration):
+        """Record a match made for hop.  The path and duration of the
+        matches of a trace which is not detailed may be None.
+
+        """
+        hop["matches"].append({"input": input,
+                               "that": that,
+                               "topic": topic,
+                               "path": path,
+                               "time": duration})
+
+    def macro(self, name, kind, duration, ok):
+        """Record a macro or shell command run by a <system> element."""
+        self.macros.append({"name": name,
+                            "kind": kind,
+                            "time": duration,
+                            "ok": ok})
+
+    def asDict(self):
+        """Return the trace as a dictionary."""
+        return {"input": self.input,
+                "response": self.response,
+                "wallTime": self.wallTime,
+                "memoHits": self.memoHits,
+                "hops": self.hops,
+                "macros": self.macros}
+
+    def format(self):
+        """Return the trace as human-readable text."""
+        lines = [u"input %r -> %r (%s)"
+                 % (self.input, self.response, _ms(self.wallTime))]
+        for hop in self.hops:
+            indent = u"  " * hop["depth"]
+            if hop["memo"]:
+                lines.append(u"%s%r (memo)" % (indent, hop["input"]))
+                continue
+            lines.append(u"%s%r (%s)"
+                         % (indent, hop["input"], _ms(hop["time"])))
+            for match in hop["matches"]:
+                if match["path"] is None:
+                    # not detailed
+                    lines.append(u"%s  match %r" % (indent, match["input"]))
+                    continue
+                lines.append(u"%s  match %s [%s]"
+                             % (indent, match["path"], _ms(match["time"])))
+        for macro in self.macros:
+            status = u"ok"
+            if not macro["ok"]:
+                status = u"failed"
+            lines.append(u"%s %s: %s (%s)" % (macro["kind"], macro["name"],
+                                              status, _ms(macro["time"])))
+        return u"\n".join(lines)
+
+
+def _ms(seconds):
+    if seconds is None:
+        return u"pending"
+    return u"%.3f ms" % (seconds * 1000)
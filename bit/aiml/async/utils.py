@@ -3,6 +3,8 @@ modules in the PyAIML package.
 
 """
 
+import re
+
 
 def sentences(s):
     """Split the string s into a list of sentences."""
@@ -36,6 +38,34 @@ def sentences(s):
     return sentenceList
 
 
+def literalElements(template, tag):
+    """Iterate over the <tag> elements of template whose contents are
+    plain text, yielding an (element, text) tuple for each one.
+
+    The text is what the contents evaluate to, with whitespace handled
+    the same way Kernel._processText() does.
+
+    """
+    stack = [template]
+    while stack:
+        elem = stack.pop()
+        if elem[0] == "text":
+            continue
+        if elem[0] == tag and len(elem) > 2:
+            text = ""
+            for e in elem[2:]:
+                if e[0] != "text":
+                    break
+                if e[1]["xml:space"] == "default":
+                    text += re.sub("\s+", " ", e[2])
+                else:
+                    text += e[2]
+            else:
+                yield (elem, text)
+                continue
+        stack.extend(elem[2:])
+
+
 # Self test
 if __name__ == "__main__":
     # sentences
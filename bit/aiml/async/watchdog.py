@@ -0,0 +1,158 @@
+"""This module implements the StallWatchdog class, which detects when the
+reactor thread is kept busy for too long, and captures what it is doing.
+
+A heartbeat scheduled on the reactor every interval seconds records the
+time it last ran.  A separate thread checks the heartbeat; when it is
+late by more than the threshold, the thread captures the stack of the
+reactor thread and the exchange the Kernel is processing (its session,
+the input stack and the AIML elements being processed).  The stall is
+reported once the reactor runs again, with its total duration, to the
+Twisted log (as an event with a "reactorStall" key) and kept in the
+watchdog's list of recent stalls.
+
+"""
+
+import collections
+import re
+import sys
+import thread
+import threading
+import time
+import traceback
+
+from twisted.internet import task
+from twisted.python import log
+
+
+# the element processors of the Kernel, as they appear in a stack
+_processorRE = re.compile(r"_process([A-Z]\w*)$")
+# helpers which are not the processor of an element
+_notTags = ("element", "contents")
+
+
+class StallWatchdog(object):
+    """Watch the reactor thread of kernel for stalls longer than
+    threshold seconds.
+
+    """
+
+    def __init__(self, kernel, threshold=0.25, interval=0.05,
+                 maxStalls=20, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._kernel = kernel
+        self._reactor = reactor
+        self.threshold = threshold
+        self.interval = interval
+        self._heartbeat = task.LoopingCall(self._beat)
+        self._heartbeat.clock = reactor
+        self._thread = None
+        self._trigger = None
+        self._stopped = threading.Event()
+        self._reactorThread = None
+        self._lastBeat = None
+        # the stall being reported, if any
+        self._stall = None
+        # statistics
+        self.stalls = 0
+        self.longest = 0.0
+        self.recent = collections.deque(maxlen=maxStalls)
+
+    def start(self):
+        """Start the heartbeat and the watching thread."""
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._heartbeat.start(self.interval, now=True)
+        self._thread = threading.Thread(target=self._watch,
+                                        name="aiml-stall-watchdog")
+        self._thread.setDaemon(True)
+        self._thread.start()
+        self._trigger = self._reactor.addSystemEventTrigger(
+            "before", "shutdown", self.stop)
+
+    def stop(self):
+        """Stop watching."""
+        if self._thread is None:
+            return
+        self._stopped.set()
+        if self._heartbeat.running:
+            self._heartbeat.stop()
+        self._thread.join(self.interval * 2)
+        self._thread = None
+        try:
+            self._reactor.removeSystemEventTrigger(self._trigger)
+        except ValueError:
+            # stopped by the trigger itself
+            pass
+
+    def _beat(self):
+        # runs in the reactor thread
+        self._reactorThread = thread.get_ident()
+        self._lastBeat = time.time()
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            lastBeat = self._lastBeat
+            if lastBeat is None:
+                continue
+            late = time.time() - lastBeat - self.interval
+            if late < self.threshold:
+                continue
+            if self._stall is not None and self._stall["beat"] == lastBeat:
+                # already captured
+                continue
+            self._stall = self._capture(lastBeat, late)
+            self._reactor.callFromThread(self._report, self._stall)
+
+    def _capture(self, lastBeat, late):
+        """Return the state of the reactor thread, stalled for late
+        seconds.
+
+        """
+        frame = sys._current_frames().get(self._reactorThread)
+        stack = []
+        tags = []
+        if frame is not None:
+            stack = traceback.format_stack(frame)
+            for name in [f[2] for f in traceback.extract_stack(frame)]:
+                match = _processorRE.match(name)
+                if match is not None \
+                        and match.group(1).lower() not in _notTags:
+                    tags.append(match.group(1).lower())
+        kernel = self._kernel
+        request = kernel._inFlight
+        session = None
+        inputs = []
+        if request is not None:
+            session = request.session_id
+            # the session of the request in flight is decoded already:
+            # never decode one (see LazySessions) off the reactor thread
+            state = dict.get(kernel._sessions, session)
+            if state is not None:
+                inputs = list(state.get(kernel._inputStack, []))
+        return {"beat": lastBeat,
+                "time": time.time(),
+                "capturedAfter": late,
+                "duration": None,
+                "session": session,
+                "inputs": inputs,
+                "tags": tags,
+                "stack": "".join(stack)}
+
+    def _report(self, stall):
+        # runs in the reactor thread, once it is free again
+        stall["duration"] = time.time() - stall["beat"] - self.interval
+        self.stalls += 1
+        self.longest = max(self.longest, stall["duration"])
+        self.recent.append(stall)
+        log.msg(format="reactor stalled for %(duration).3f s "
+                "(session %(session)r, inputs %(inputs)r, tags %(tags)s)",
+                duration=stall["duration"], session=stall["session"],
+                inputs=stall["inputs"], tags="/".join(stall["tags"]),
+                reactorStall=stall)
+
+    def stats(self):
+        return {"stalls": self.stalls,
+                "longest": self.longest,
+                "recent": list(self.recent)}
@@ -73,6 +73,25 @@ class WordSub(dict):
         super(type(self), self).__setitem__(
             string.upper(i), string.upper(y))
 
+    def table(self):
+        """Return the substitutions as a dictionary, including the case
+        variants added by __setitem__().
+
+        """
+        return dict(self)
+
+    @classmethod
+    def fromTable(cls, table):
+        """Return a WordSub holding the substitutions of a dictionary
+        returned by table().
+
+        The regex is compiled when the WordSub is first used.
+
+        """
+        subber = cls()
+        dict.update(subber, table)
+        return subber
+
     def sub(self, text):
         """Translate text, returns the modified text."""
         if self._regexIsDirty:
@@ -0,0 +1,757 @@
+"""This module implements the KernelSupervisor class, which spreads the
+conversations of a bot over several worker processes, each running a
+Kernel of its own, so that a bot can use every core of its host.
+
+The supervisor spawns one process which loads the brain, and forks the
+workers from it, before they start a reactor, so that they share the
+pages of the brain copy-on-write instead of holding a copy each; each
+worker serves its Kernel over AMP on a UNIX socket.  Requests
+are routed by consistent hashing of their session_id (see HashRing), so
+that every session lives in one worker, and respond() returns a Deferred
+like Kernel.respond().  The supervisor pings every worker regularly, and
+kills and restarts the ones which stop answering or exit.  The sessions
+of a restarted worker are lost.  The management of the worker processes
+is done by ProcessSupervisor, which bit.aiml.async.shards reuses.
+
+When learnFiles are given, the supervisor learns them once, and saves
+the brain to a file which the forking process loads, which is much
+faster than parsing the AIML again.  The pages the workers write to are
+still copied, the reference counts of the objects they use included, so
+their memory grows with the part of the brain they use, but the brain
+is loaded once, and a restarted worker is forked again from it.
+
+IAIMLMacro adapters and event subscribers must be registered in the
+workers: setup names a function ("package.module.function") called with
+the Kernel of each worker once it is forked.  Events are delivered in
+the workers.
+
+Start the supervisor before the reactor runs, or once it is running:
+
+    supervisor = KernelSupervisor(4, learnFiles="bot/*.aiml",
+                                  setup="mybot.macros.register")
+    supervisor.start()
+    d = supervisor.respond(request, u"Hello")
+
+"""
+
+import bisect
+import cStringIO
+import gc
+import hashlib
+import json
+import os
+import select
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import traceback
+
+from twisted.internet import defer, error, protocol, task
+from twisted.protocols import amp
+from twisted.python import failure, log, reflect
+
+
+class BigString(amp.Argument):
+    """A string argument of any length, split across as many AMP values
+    as needed: AMP values are limited to 64K.
+
+    """
+
+    def toBox(self, name, strings, objects, proto):
+        value = cStringIO.StringIO(objects[name])
+        strings[name] = value.read(amp.MAX_VALUE_LENGTH)
+        count = 2
+        while True:
+            chunk = value.read(amp.MAX_VALUE_LENGTH)
+            if not chunk:
+                break
+            strings["%s.%d" % (name, count)] = chunk
+            count += 1
+
+    def fromBox(self, name, strings, objects, proto):
+        value = cStringIO.StringIO()
+        value.write(strings[name])
+        count = 2
+        while True:
+            chunk = strings.get("%s.%d" % (name, count))
+            if chunk is None:
+                break
+            value.write(chunk)
+            count += 1
+        objects[name] = value.getvalue()
+
+
+class Respond(amp.Command):
+    arguments = [("sessionID", amp.Unicode()),
+                 ("input", amp.Unicode())]
+    response = [("response", BigString())]
+
+
+class Ping(amp.Command):
+    arguments = []
+    response = [("sessions", amp.Integer()),
+                ("categories", amp.Integer())]
+
+
+class HashRing(object):
+    """A consistent hash ring mapping keys to nodes.
+
+    Each node is placed at replicas points of the ring, so that keys are
+    spread evenly, and only the keys of a node move when it is skipped.
+
+    """
+
+    def __init__(self, nodes, replicas=64):
+        self._points = []
+        for node in nodes:
+            for i in xrange(replicas):
+                self._points.append((_hash("%s-%d" % (node, i)), node))
+        self._points.sort()
+        self._hashes = [point for point, node in self._points]
+
+    def nodes(self, key):
+        """Iterate over the nodes in the order they are tried for key:
+        its node first, then the next distinct ones around the ring.
+
+        """
+        if not self._points:
+            return
+        start = bisect.bisect(self._hashes, _hash(key))
+        seen = set()
+        for i in xrange(len(self._points)):
+            node = self._points[(start + i) % len(self._points)][1]
+            if node not in seen:
+                seen.add(node)
+                yield node
+
+    def node(self, key):
+        """Return the node of key."""
+        for node in self.nodes(key):
+            return node
+
+
+def _hash(key):
+    if isinstance(key, unicode):
+        key = key.encode("utf-8")
+    return int(hashlib.md5(str(key)).hexdigest()[:16], 16)
+
+
+class _Worker(protocol.ProcessProtocol):
+    """A worker process, and the AMP connection to it."""
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.socket = os.path.join(supervisor._directory,
+                                   "worker-%d.sock" % index)
+        self.process = None
+        self.amp = None
+        self.started = None
+        self.missed = 0
+        self._waiting = []
+        # statistics
+        self.restarts = 0
+        self.requests = 0
+        self.failures = 0
+
+    @property
+    def pid(self):
+        return self.process and self.process.pid
+
+    @property
+    def ready(self):
+        return self.amp is not None
+
+    def whenReady(self):
+        """Return a Deferred firing with the AMP connection to the worker
+        once it is up.
+
+        """
+        if self.amp is not None:
+            return defer.succeed(self.amp)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+    def attach(self, connection):
+        self.amp = connection
+        self.missed = 0
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(connection)
+
+    def detach(self, reason):
+        self.amp = None
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.errback(reason)
+
+    def outReceived(self, data):
+        # the Kernel prints its progress in verbose mode
+        for line in data.splitlines():
+            log.msg("aiml worker %d: %s" % (self.index, line))
+
+    errReceived = outReceived
+
+    def processEnded(self, reason):
+        self.process = None
+        if self.amp is not None:
+            self.amp.transport.loseConnection()
+        self.detach(reason)
+        self.supervisor._workerEnded(self, reason)
+
+
+class _Connection(amp.AMP):
+
+    def __init__(self, worker):
+        amp.AMP.__init__(self)
+        self.worker = worker
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        if self.worker.amp is self:
+            self.worker.detach(reason)
+
+
+class ProcessSupervisor(object):
+    """Run count worker processes serving AMP, and keep them up.
+
+    ProcessSupervisor is an abstract base class.  The workers run
+    "python -m <module> <socket> <arguments>", where module is a class
+    attribute, and arguments the string returned by _arguments() for each
+    worker; subclasses must define both, or start the workers otherwise
+    in _startProcess().  They may also prepare the files the workers
+    need in _prepare(), which is called by start().
+
+    """
+
+    module = None
+
+    def __init__(self, count, directory=None, pingInterval=5.0,
+                 pingTimeout=5.0, maxMissed=2, startTimeout=60.0,
+                 restartDelay=1.0, requestTimeout=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self.count = count
+        self.pingInterval = pingInterval
+        self.pingTimeout = pingTimeout
+        self.maxMissed = maxMissed
+        self.startTimeout = startTimeout
+        self.restartDelay = restartDelay
+        self.requestTimeout = requestTimeout
+        self._directory = directory
+        self._ownDirectory = False
+        self._workers = []
+        self._health = task.LoopingCall(self._checkHealth)
+        self._health.clock = reactor
+        self._trigger = None
+        self.running = False
+
+    def start(self):
+        """Start the workers.
+
+        Returns a Deferred which fires once they are all up.
+
+        """
+        if self.running:
+            return defer.succeed(None)
+        self.running = True
+        if self._directory is None:
+            self._directory = tempfile.mkdtemp(prefix="aiml-workers-")
+            self._ownDirectory = True
+        self._prepare()
+        self._workers = [_Worker(self, i) for i in xrange(self.count)]
+        for worker in self._workers:
+            self._spawn(worker)
+        self._health.start(self.pingInterval, now=False)
+        self._trigger = self._reactor.addSystemEventTrigger(
+            "before", "shutdown", self.stop)
+        return defer.DeferredList([worker.whenReady()
+                                   for worker in self._workers])
+
+    def _prepare(self):
+        """Prepare what the workers need, before they are spawned."""
+        pass
+
+    def _arguments(self, index):
+        """Return the command line arguments of the worker index, as a
+        string.  Subclasses must define it.
+
+        """
+        raise NotImplementedError("%s does not define _arguments()"
+                                  % self.__class__.__name__)
+
+    def stop(self):
+        """Stop the workers."""
+        if not self.running:
+            return
+        self.running = False
+        if self._health.running:
+            self._health.stop()
+        for worker in self._workers:
+            if worker.amp is not None:
+                worker.amp.transport.loseConnection()
+            if worker.process is not None:
+                try:
+                    worker.process.signalProcess("TERM")
+                except error.ProcessExitedAlready:
+                    pass
+        if self._ownDirectory:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+            self._ownDirectory = False
+        try:
+            self._reactor.removeSystemEventTrigger(self._trigger)
+        except ValueError:
+            # stopped by the trigger itself
+            pass
+
+    def _spawn(self, worker):
+        if os.path.exists(worker.socket):
+            os.unlink(worker.socket)
+        worker.process = self._startProcess(worker)
+        worker.started = time.time()
+        self._connect(worker, worker.process)
+
+    def _startProcess(self, worker):
+        """Start the process of worker, and return its process transport.
+
+        """
+        return self._reactor.spawnProcess(
+            worker, sys.executable,
+            [sys.executable, "-m", self.module,
+             worker.socket, self._arguments(worker.index)],
+            env=_environment())
+
+    def _connect(self, worker, process):
+        """Connect to worker once its socket is up."""
+        if not self.running or worker.process is not process:
+            return
+        if not os.path.exists(worker.socket):
+            if time.time() - worker.started > self.startTimeout:
+                log.msg("aiml worker %d did not start, killing it"
+                        % worker.index)
+                self._kill(worker)
+            else:
+                self._reactor.callLater(0.1, self._connect, worker, process)
+            return
+        d = protocol.ClientCreator(self._reactor, _Connection,
+                                   worker).connectUNIX(worker.socket)
+
+        def _failed(failure):
+            self._reactor.callLater(0.1, self._connect, worker, process)
+        d.addCallbacks(worker.attach, _failed)
+
+    def _kill(self, worker):
+        if worker.process is not None:
+            try:
+                worker.process.signalProcess("KILL")
+            except error.ProcessExitedAlready:
+                pass
+
+    def _workerEnded(self, worker, reason):
+        if not self.running:
+            return
+        log.msg("aiml worker %d ended (%s), restarting it"
+                % (worker.index, reason.getErrorMessage()))
+        worker.restarts += 1
+        self._reactor.callLater(self.restartDelay, self._restart, worker)
+
+    def _restart(self, worker):
+        if self.running and worker.process is None:
+            self._spawn(worker)
+
+    def _checkHealth(self):
+        for worker in self._workers:
+            if worker.amp is None:
+                continue
+            d = worker.amp.callRemote(Ping)
+            d.addTimeout(self.pingTimeout, self._reactor)
+            d.addCallbacks(self._pinged, self._missed,
+                           callbackArgs=(worker,), errbackArgs=(worker,))
+
+    def _pinged(self, result, worker):
+        worker.missed = 0
+
+    def _missed(self, failure, worker):
+        worker.missed += 1
+        if worker.missed >= self.maxMissed:
+            log.msg("aiml worker %d is not answering, killing it"
+                    % worker.index)
+            self._kill(worker)
+
+    def call(self, worker, command, **kwargs):
+        """Call command on worker once it is up, and return a Deferred
+        firing with the result.
+
+        """
+        worker.requests += 1
+
+        def _call(connection):
+            d = connection.callRemote(command, **kwargs)
+            if self.requestTimeout is not None:
+                d.addTimeout(self.requestTimeout, self._reactor)
+            return d
+
+        def _failed(failure):
+            worker.failures += 1
+            return failure
+        return worker.whenReady().addCallback(_call).addErrback(_failed)
+
+    def stats(self):
+        """Return the state and statistics of each worker as a list of
+        dictionaries.
+
+        """
+        return [{"pid": worker.pid,
+                 "ready": worker.ready,
+                 "restarts": worker.restarts,
+                 "requests": worker.requests,
+                 "failures": worker.failures,
+                 "missedPings": worker.missed}
+                for worker in self._workers]
+
+
+class KernelSupervisor(ProcessSupervisor):
+    """Run the Kernels of a bot in count worker processes.
+
+    The other keyword arguments are those of ProcessSupervisor.
+
+    """
+
+    module = "bit.aiml.async.workers"
+
+    def __init__(self, count, brainFile=None, learnFiles=[], commands=[],
+                 setup=None, **kwargs):
+        ProcessSupervisor.__init__(self, count, **kwargs)
+        self.brainFile = brainFile
+        self.learnFiles = learnFiles
+        self.commands = commands
+        self.setup = setup
+        self._ring = HashRing(range(count))
+        self._brainFile = None
+        self._zygote = None
+
+    def _prepare(self):
+        """Learn the AIML files of the bot once, save the brain, and start
+        the process which loads it and forks the workers.
+
+        """
+        self._brainFile = self.brainFile
+        if self.learnFiles:
+            from bit.aiml.async.kernel import Kernel
+            kernel = Kernel()
+            kernel.verbose(False)
+            kernel.bootstrap(self.brainFile, self.learnFiles)
+            self._brainFile = os.path.join(self._directory, "brain")
+            kernel.saveBrain(self._brainFile)
+        self._startZygote()
+
+    def _startZygote(self):
+        self._zygote = _Zygote(self)
+        arguments = json.dumps({"brainFile": self._brainFile,
+                                "commands": self.commands,
+                                "setup": self.setup})
+        self._reactor.spawnProcess(
+            self._zygote, sys.executable,
+            [sys.executable, "-m", self.module, "--zygote", arguments],
+            env=_environment(), childFDs={0: "w", 1: "r", 2: "r", 3: "r"})
+
+    def _startProcess(self, worker):
+        return self._zygote.fork(worker)
+
+    def _zygoteEnded(self, zygote, reason):
+        if zygote is not self._zygote or not self.running:
+            return
+        log.msg("aiml zygote ended (%s), restarting it"
+                % reason.getErrorMessage())
+        # before the workers it forked are restarted
+        self._startZygote()
+
+    def stop(self):
+        """Stop the workers, and the process forking them."""
+        running = self.running
+        ProcessSupervisor.stop(self)
+        if running and self._zygote is not None:
+            zygote, self._zygote = self._zygote, None
+            zygote.stop()
+
+    def worker(self, sessionID):
+        """Return the worker of the session sessionID: the first worker
+        which is up along its hash ring, or its own worker if none is.
+
+        """
+        for index in self._ring.nodes(sessionID):
+            if self._workers[index].ready:
+                return self._workers[index]
+        return self._workers[self._ring.node(sessionID)]
+
+    def respond(self, request, input):
+        """Return a Deferred firing with the response of the worker of
+        request.session_id to the input string.
+
+        """
+        if not self.running:
+            return defer.fail(RuntimeError("the supervisor is not running"))
+        if len(input) == 0:
+            return defer.succeed("")
+        if not isinstance(input, unicode):
+            input = input.decode("utf-8", "replace")
+        sessionID = request.session_id
+        d = self.call(self.worker(sessionID), Respond,
+                      sessionID=unicode(sessionID), input=input)
+        return d.addCallback(lambda result: result["response"])
+
+
+class _Zygote(protocol.ProcessProtocol):
+    """The process which loads the brain of a KernelSupervisor, and forks
+    its workers.
+
+    It is told the worker to fork on its standard input, and reports the
+    pid of each worker, and its exit status once it has ended, on its
+    file descriptor 3.
+
+    """
+
+    def __init__(self, supervisor):
+        self.supervisor = supervisor
+        self.process = None
+        self._forking = {}
+        self._forked = {}
+        self._buffer = ""
+
+    def connectionMade(self):
+        self.process = self.transport
+
+    def fork(self, worker):
+        """Ask for a new process for worker, and return it."""
+        child = _ForkedProcess(worker)
+        self._forking[worker.index] = child
+        self.process.writeToChild(0, json.dumps(
+            {"index": worker.index, "socket": worker.socket}) + "\n")
+        return child
+
+    def stop(self):
+        """Stop forking; the workers left are stopped too."""
+        if self.process is not None:
+            self.process.closeStdin()
+
+    def childDataReceived(self, fd, data):
+        if fd != 3:
+            # the Kernels print their progress in verbose mode
+            for line in data.splitlines():
+                log.msg("aiml zygote: %s" % line)
+            return
+        self._buffer += data
+        while "\n" in self._buffer:
+            line, self._buffer = self._buffer.split("\n", 1)
+            event, first, second = line.split()
+            if event == "started":
+                child = self._forking.pop(int(first), None)
+                if child is not None:
+                    self._forked[int(second)] = child
+                    child.started(int(second))
+            else:
+                child = self._forked.pop(int(first), None)
+                if child is not None:
+                    child.ended(int(second))
+
+    def processExited(self, reason):
+        # its workers keep its standard output open
+        self.process = None
+        children = self._forking.values() + self._forked.values()
+        self._forking, self._forked = {}, {}
+        for child in children:
+            # rather than wait for it to notice it has no parent
+            try:
+                child.signalProcess("KILL")
+            except error.ProcessExitedAlready:
+                pass
+            child.ended(None)
+        self.supervisor._zygoteEnded(self, reason)
+
+
+class _ForkedProcess(object):
+    """A worker process forked by the zygote, standing for its process
+    transport.
+
+    """
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.pid = None
+        self._signal = None
+        self._ended = False
+
+    def signalProcess(self, signalID):
+        if self._ended:
+            raise error.ProcessExitedAlready()
+        if self.pid is None:
+            # sent once the process is forked
+            self._signal = signalID
+            return
+        if not isinstance(signalID, int):
+            signalID = getattr(signal, "SIG%s" % signalID)
+        try:
+            os.kill(self.pid, signalID)
+        except OSError:
+            raise error.ProcessExitedAlready()
+
+    def started(self, pid):
+        self.pid = pid
+        if self._signal is not None:
+            self.signalProcess(self._signal)
+
+    def ended(self, status):
+        if self._ended:
+            return
+        self._ended = True
+        if status is None:
+            reason = error.ProcessTerminated()
+        elif os.WIFSIGNALED(status):
+            reason = error.ProcessTerminated(signal=os.WTERMSIG(status),
+                                             status=status)
+        elif os.WEXITSTATUS(status) != 0:
+            reason = error.ProcessTerminated(os.WEXITSTATUS(status),
+                                             status=status)
+        else:
+            reason = error.ProcessDone(status)
+        self.worker.processEnded(failure.Failure(reason))
+
+
+class _Request(object):
+
+    def __init__(self, sessionID):
+        self.session_id = sessionID
+
+
+class _WorkerServer(amp.AMP):
+    """The AMP server of a worker process, answering for its Kernel."""
+
+    def __init__(self, kernel):
+        amp.AMP.__init__(self)
+        self.kernel = kernel
+
+    @Respond.responder
+    def respond(self, sessionID, input):
+        d = defer.maybeDeferred(self.kernel.respond, _Request(sessionID),
+                                input)
+
+        def _encoded(response):
+            if response is None:
+                # the Kernel failed, and printed why
+                response = ""
+            if isinstance(response, unicode):
+                response = response.encode("utf-8")
+            return {"response": response}
+        return d.addCallback(_encoded)
+
+    @Ping.responder
+    def ping(self):
+        return {"sessions": len(self.kernel._sessions),
+                "categories": self.kernel.numCategories()}
+
+
+def _environment():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(sys.path)
+    return env
+
+
+def _checkParent(parent):
+    """Stop the worker if the supervisor, its parent, is gone."""
+    from twisted.internet import reactor
+    if os.getppid() != parent:
+        reactor.stop()
+
+
+def _zygote(arguments):
+    """Load the brain, and fork a worker for each line read on the
+    standard input, until it is closed or the supervisor is gone.
+
+    The reactor is not installed yet: each worker starts its own.
+
+    """
+    from bit.aiml.async.kernel import Kernel
+    parent = os.getppid()
+    kernel = Kernel()
+    kernel.verbose(False)
+    kernel.bootstrap(arguments["brainFile"])
+    # the brain is not garbage, and should not be copied to be collected
+    gc.collect()
+    reports = os.fdopen(3, "w", 0)
+    children = set()
+    buffer = ""
+    done = False
+    while not done and os.getppid() == parent:
+        if select.select([0], [], [], 0.5)[0]:
+            data = os.read(0, 4096)
+            done = not data
+            buffer += data
+        while "\n" in buffer:
+            line, buffer = buffer.split("\n", 1)
+            request = json.loads(line)
+            sys.stdout.flush()
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    reports.close()
+                    os.close(0)
+                    _serve(kernel, request["socket"], arguments)
+                    status = 0
+                except:
+                    traceback.print_exc()
+                finally:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(status)
+            children.add(pid)
+            reports.write("started %d %d\n" % (request["index"], pid))
+        while children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            children.discard(pid)
+            reports.write("ended %d %d\n" % (pid, status))
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+
+def _serve(kernel, socket, arguments):
+    """Run a worker process forked by the zygote: run the commands and
+    the setup of the bot, and serve kernel on the UNIX socket socket.
+
+    """
+    from twisted.internet import reactor
+    from bit.aiml.async.kernel import _printResponse
+    parent = os.getppid()
+    for command in arguments["commands"]:
+        d = kernel.respond(_Request(kernel._globalSessionID), command)
+        d.addCallback(_printResponse)
+    if arguments["setup"]:
+        reflect.namedAny(arguments["setup"])(kernel)
+    factory = protocol.Factory()
+    factory.protocol = lambda: _WorkerServer(kernel)
+    # the supervisor connects once the socket exists
+    reactor.listenUNIX(socket, factory)
+    task.LoopingCall(_checkParent, parent).start(1.0, now=False)
+    reactor.run()
+
+
+def main(argv):
+    """Run the process forking the workers, with the JSON arguments
+    argv[2] (argv[1] is "--zygote").
+
+    """
+    _zygote(json.loads(argv[2]))
+
+
+if __name__ == "__main__":
+    main(sys.argv)